@@ -5,7 +5,7 @@ import numpy as np
 import torch as th
 from torch.nn import functional as F
 from stable_baselines3.common.buffers import ReplayBuffer
-from stable_baselines3.common.noise import ActionNoise
+from stable_baselines3.common.noise import ActionNoise, VectorizedActionNoise
 from stable_baselines3.common.off_policy_algorithm import OffPolicyAlgorithm
 from stable_baselines3.common.policies import BasePolicy
 from stable_baselines3.common.type_aliases import GymEnv, MaybeCallback, Schedule, TrainFreq, TrainFrequencyUnit, RolloutReturn 
@@ -18,6 +18,7 @@ from stable_baselines3.common.preprocessing import get_flattened_obs_dim
 
 from stable_baselines3.common.preprocessing import get_action_dim
 from .controllers import RL_withController
+from .controller_worker import ControllerPool
 
 SelfTD3 = TypeVar("SelfTD3", bound="TD3")
 
@@ -329,6 +330,7 @@ class TD3Controller(OffPolicyAlgorithm):
     def _setup_model(self) -> None:
         super()._setup_model()
         self._create_aliases()
+        self.ctrl_pool = None # ControllerPool of the training env, created at the first rollout.
         # Running mean and running var
         self.actor_batch_norm_stats = get_parameters_by_name(self.actor, ["running_"])
         self.critic_batch_norm_stats = get_parameters_by_name(self.critic, ["running_"])
@@ -410,17 +412,41 @@ class TD3Controller(OffPolicyAlgorithm):
         progress_bar: bool = False,
     ) -> SelfTD3:
 
-        return super().learn(
-            total_timesteps=total_timesteps,
-            callback=callback,
-            log_interval=log_interval,
-            tb_log_name=tb_log_name,
-            reset_num_timesteps=reset_num_timesteps,
-            progress_bar=progress_bar,
-        )
+        try:
+            return super().learn(
+                total_timesteps=total_timesteps,
+                callback=callback,
+                log_interval=log_interval,
+                tb_log_name=tb_log_name,
+                reset_num_timesteps=reset_num_timesteps,
+                progress_bar=progress_bar,
+            )
+        finally:
+            if self.ctrl_pool is not None:
+                self.ctrl_pool.shutdown()
+                self.ctrl_pool = None
 
     def _excluded_save_params(self) -> List[str]:
-        return super()._excluded_save_params() + ["actor", "critic", "actor_target", "critic_target"]
+        return super()._excluded_save_params() + ["actor", "critic", "actor_target", "critic_target", "ctrl_pool"]
+
+    def _submit_controller(self, env: VecEnv, learning_starts: int, action_noise: Optional[ActionNoise] = None):
+        """
+        Sample the actions of the current observations (self._last_obs) and submit them to the controller, one per env.
+        The actions of all envs are submitted before any of them is awaited, so that the controller workers solve them together.
+        :return: buffer_actions of the replay buffer and the ControllerFutures of the final actions
+        """
+        # actions: Range-[low, high], shape: [num_envs, num_of_stocks], buffer_actions: [-1, 1] for actor and critic agent training
+        actions, buffer_actions = self._sample_action(learning_starts, action_noise, env.num_envs)
+        a_rl_lst = []
+        for idx in range(env.num_envs):
+            a_rlonly = np.array(actions[idx]) # [num_envs, num_of_stocks] -> [num_of_stocks, ]
+            a_rl = a_rlonly
+            if np.sum(np.abs(a_rl)) == 0:
+                a_rl = np.array([1/len(a_rl)]*len(a_rl)) * env.envs[idx].bound_flag
+            else:
+                a_rl = a_rl / np.sum(np.abs(a_rl))
+            a_rl_lst.append(a_rl)
+        return buffer_actions, [self.ctrl_pool.submit(a_rl=a_rl, env=env.envs[idx].unwrapped) for idx, a_rl in enumerate(a_rl_lst)]
 
     def _get_torch_save_params(self) -> Tuple[List[str], List[str]]:
         state_dicts = ["policy", "actor.optimizer", "critic.optimizer"]
@@ -463,8 +489,8 @@ class TD3Controller(OffPolicyAlgorithm):
         assert isinstance(env, VecEnv), "You must pass a VecEnv"
         assert train_freq.frequency > 0, "Should at least collect one step or episode."
 
-        if env.num_envs > 1:
-            assert train_freq.unit == TrainFrequencyUnit.STEP, "You must use only one env when doing episodic training."
+        # With several envs and the episode unit, the rollout ends when train_freq.frequency episodes of any envs are done.
+        # The envs run in lockstep, an env whose episode is done is reset by the VecEnv and its next episode goes on into the next rollout.
 
         # Vectorize action noise if needed
         if action_noise is not None and env.num_envs > 1 and not isinstance(action_noise, VectorizedActionNoise):
@@ -473,8 +499,13 @@ class TD3Controller(OffPolicyAlgorithm):
         if self.use_sde:
             self.actor.reset_noise(env.num_envs)
 
+        if self.ctrl_pool is None:
+            config = env.envs[0].config
+            self.ctrl_pool = ControllerPool(num_workers=config.ctrl_workers, backend=config.ctrl_worker_backend)
+
         callback.on_rollout_start()
         continue_training = True
+        ctrl_future_lst = None # Controller actions of the next step of all envs, submitted before the current step is stored.
 
         while should_collect_more_steps(train_freq, num_collected_steps, num_collected_episodes):
             if self.use_sde and self.sde_sample_freq > 0 and num_collected_steps % self.sde_sample_freq == 0:
@@ -482,28 +513,34 @@ class TD3Controller(OffPolicyAlgorithm):
                 self.actor.reset_noise(env.num_envs)
 
             # Select action randomly or according to policy
-            # actions: Range-[low, high], shape: [1, num_of_stocks], buffer_actions: [-1, 1] for actor and critic agent training
-            actions, buffer_actions = self._sample_action(learning_starts, action_noise, env.num_envs)
-            a_rlonly = np.array(actions[0]) # [1, num_of_stocks] -> [num_of_stocks, ]
-            a_rl = a_rlonly
-            if np.sum(np.abs(a_rl)) == 0:
-                a_rl = np.array([1/len(a_rl)]*len(a_rl)) * env.envs[0].bound_flag
-            else:
-                a_rl = a_rl / np.sum(np.abs(a_rl))
-
-            a_final = RL_withController(a_rl=a_rl, env=env.envs[0])
-            a_final = a_final / np.sum(np.abs(a_final))
+            if ctrl_future_lst is None:
+                buffer_actions, ctrl_future_lst = self._submit_controller(env, learning_starts, action_noise)
+            a_final_lst = []
+            for ctrl_future in ctrl_future_lst:
+                a_final = ctrl_future.result()
+                a_final_lst.append(a_final / np.sum(np.abs(a_final)))
+            ctrl_future_lst = None
 
             # Rescale and perform action
-            a_final = np.array([a_final])
+            a_final = np.array(a_final_lst) # (num_envs, num_of_stocks)
             new_obs, rewards, dones, infos = env.step(a_final)
             self.num_timesteps += env.num_envs
             num_collected_steps += 1
 
+            if self.ctrl_pool.is_async and (not np.any(dones)) and should_collect_more_steps(train_freq, num_collected_steps, num_collected_episodes):
+                # Solve the next step in the worker while this one is stored and logged, the policy is not updated in between.
+                last_obs = self._last_obs
+                self._last_obs = new_obs
+                next_buffer_actions, ctrl_future_lst = self._submit_controller(env, learning_starts, action_noise)
+                self._last_obs = last_obs
+
             # Give access to local variables
             callback.update_locals(locals())
             # Only stop training if return value is False, not when it is None.
             if callback.on_step() is False:
+                if ctrl_future_lst is not None:
+                    for ctrl_future in ctrl_future_lst:
+                        ctrl_future.cancel()
                 return RolloutReturn(num_collected_steps * env.num_envs, num_collected_episodes, continue_training=False)
 
             # Retrieve reward and episode length if using Monitor wrapper
@@ -511,6 +548,8 @@ class TD3Controller(OffPolicyAlgorithm):
 
             # Store data in replay buffer (normalized action and unnormalized observation)
             self._store_transition(replay_buffer, buffer_actions, new_obs, rewards, dones, infos)
+            if ctrl_future_lst is not None:
+                buffer_actions = next_buffer_actions
 
             self._update_current_progress_remaining(self.num_timesteps, self._total_timesteps)
 
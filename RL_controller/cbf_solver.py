@@ -0,0 +1,815 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         cbf_solver.py
+ Description:  Solvers of the CBF risk-constrained correction used by the solver-based agent.
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+import time
+import cvxpy as cp
+
+class CbfSocpProblem:
+    """
+    The CBF-SOCP of the controller, built once per number of assets and re-solved with new parameter values every trading day.
+
+        min_x ||x||^2
+        s.t.  sum(a_rl + x) = 1
+              0 <= a_rl + x <= 1
+              ||cov_sqrt @ (a_rl + x)|| <= socp_d
+
+    The problem is written in DPP form so that cvxpy canonicalises it only on the first solve.
+    cov_sqrt @ a_rl is a product of two parameters, so it is passed as its own parameter (cov_a_rl).
+    """
+    def __init__(self, stock_num, solver=cp.ECOS):
+        self.stock_num = stock_num
+        self.solver = solver
+        N = self.stock_num
+        self.x = cp.Variable((N, 1))
+        self.a_rl = cp.Parameter((N, 1))
+        self.cov_sqrt = cp.Parameter((N, N))
+        self.cov_a_rl = cp.Parameter((N, 1))
+        self.socp_d = cp.Parameter()
+        constraints = [
+            cp.sum(self.x) + cp.sum(self.a_rl) == 1,
+            self.a_rl + self.x >= 0, # 0 <= (a_RL + a_cbf)
+            self.a_rl + self.x <= 1, # (a_RL + a_cbf) <= 1
+            cp.SOC(self.socp_d, self.cov_sqrt @ self.x + self.cov_a_rl),
+        ]
+        self.prob = cp.Problem(cp.Minimize(cp.sum_squares(self.x)), constraints)
+        if not self.prob.is_dcp(dpp=True):
+            raise ValueError("The CBF-SOCP is not DPP-compliant, cvxpy would re-canonicalise it on every solve.")
+        self.num_solves = 0
+        self.num_iters = 0
+        self.last_iters = 0
+
+    def set_data(self, a_rl, cov_sqrt):
+        a_rl = np.reshape(a_rl, (-1, 1))
+        self.a_rl.value = a_rl
+        self.cov_sqrt.value = cov_sqrt
+        self.cov_a_rl.value = np.matmul(cov_sqrt, a_rl)
+
+    def solve(self, socp_d):
+        """
+        Solve with the current data and the risk bound socp_d. Only the parameter values change between calls.
+        Solvers supporting warm starts (OSQP, SCS, ...) start from the previous solution of this problem, i.e. the previous day or ARS trial.
+        Returns (is_optimal, a_cbf), a_cbf is None if the problem is not solved to optimality.
+        """
+        self.socp_d.value = socp_d
+        self.num_solves = self.num_solves + 1
+        self.last_iters = 0
+        try:
+            self.prob.solve(solver=self.solver, warm_start=True, verbose=False)
+        except cp.error.SolverError:
+            return False, None
+        if (self.prob.solver_stats is not None) and (self.prob.solver_stats.num_iters is not None):
+            self.last_iters = self.prob.solver_stats.num_iters
+            self.num_iters = self.num_iters + self.last_iters
+        if self.prob.status != 'optimal':
+            return False, None
+        return True, np.reshape(np.array(self.x.value), -1)
+
+class CbfFactorSocpProblem(CbfSocpProblem):
+    """
+    The CBF-SOCP of CbfSocpProblem with a low-rank-plus-diagonal covariance cov = L L' + diag(d), L (N, K), e.g. FactorRiskModel.
+    w'cov w = ||L'w||^2 + ||sqrt(d) * w||^2, so the cone is written over the K factor exposures L'w and the N diagonal terms:
+
+              ||[L'(a_rl + x); sqrt(d) * (a_rl + x)]|| <= socp_d
+
+    The cone matrix has K*N + N non-zeros instead of N^2, the solve cost grows with K*N. The same interface as CbfSocpProblem with set_data(a_rl, L, d).
+    """
+    def __init__(self, stock_num, num_factors, solver=cp.ECOS):
+        self.stock_num = stock_num
+        self.num_factors = num_factors
+        self.solver = solver
+        N, K = self.stock_num, self.num_factors
+        self.x = cp.Variable((N, 1))
+        self.a_rl = cp.Parameter((N, 1))
+        self.load_t = cp.Parameter((K, N)) # L'
+        self.load_a_rl = cp.Parameter((K, 1)) # L'a_rl
+        self.d_sqrt = cp.Parameter((N, 1), nonneg=True)
+        self.d_sqrt_a_rl = cp.Parameter((N, 1)) # sqrt(d) * a_rl
+        self.socp_d = cp.Parameter()
+        constraints = [
+            cp.sum(self.x) + cp.sum(self.a_rl) == 1,
+            self.a_rl + self.x >= 0, # 0 <= (a_RL + a_cbf)
+            self.a_rl + self.x <= 1, # (a_RL + a_cbf) <= 1
+            cp.SOC(self.socp_d, cp.vstack([self.load_t @ self.x + self.load_a_rl, cp.multiply(self.d_sqrt, self.x) + self.d_sqrt_a_rl])),
+        ]
+        self.prob = cp.Problem(cp.Minimize(cp.sum_squares(self.x)), constraints)
+        if not self.prob.is_dcp(dpp=True):
+            raise ValueError("The factor CBF-SOCP is not DPP-compliant, cvxpy would re-canonicalise it on every solve.")
+        self.num_solves = 0
+        self.num_iters = 0
+        self.last_iters = 0
+
+    def set_data(self, a_rl, L, d):
+        a_rl = np.reshape(a_rl, (-1, 1))
+        d_sqrt = np.sqrt(np.maximum(np.reshape(d, (-1, 1)), 0.0))
+        self.a_rl.value = a_rl
+        self.load_t.value = np.array(L).T
+        self.load_a_rl.value = np.matmul(np.array(L).T, a_rl)
+        self.d_sqrt.value = d_sqrt
+        self.d_sqrt_a_rl.value = d_sqrt * a_rl
+
+class CbfConeQpProblem:
+    """
+    The CBF-SOCP of the controller for cvxopt.solvers.coneqp, with the same interface as CbfSocpProblem.
+
+        min_x (1/2) x'Px,  P = 2I
+        s.t.  1'x = 1 - 1'a_rl                                        (A_eq x = b_eq)
+              [-I; I] x <= [a_rl; 1 - a_rl]                           (linear block, 2N rows)
+              (socp_d - 0'x, cov_sqrt (a_rl + x)) in the second-order cone (N+1 rows)
+
+    P, A_eq and the linear block of G are built once per number of assets. set_data() writes the cone block of G and h in place,
+    solve() only writes socp_d into h. With use_custom_kkt, the KKT systems are solved by a Cholesky factorisation of the reduced (N, N) matrix
+    P + G'W^{-1}W^{-T}G, where the diagonal P is added to the diagonal, and a Schur complement on the single equality row,
+    all with the BLAS/LAPACK of cvxopt and in place.
+    """
+    def __init__(self, stock_num, use_custom_kkt=True):
+        from cvxopt import matrix, solvers
+        self.matrix = matrix
+        self.solvers = solvers
+        self.stock_num = stock_num
+        self.use_custom_kkt = use_custom_kkt
+        N = self.stock_num
+        self.P_diag = np.ones(N) * 2 # (1/2) xP'x
+        self.P = matrix(np.diag(self.P_diag))
+        self.P_diag_m = matrix(self.P_diag)
+        self.ones_m = matrix(1.0, (N, 1))
+        self.q = matrix(np.zeros((N, 1))) # q'x
+        self.A_eq = matrix(np.ones((1, N)))
+        self.b_eq = matrix(np.zeros((1, 1)))
+        self.G_ay = np.zeros((3 * N + 1, N))
+        self.G_ay[:N] = -np.eye(N) # 0 <= (a_RL + a_cbf)
+        self.G_ay[N:2*N] = np.eye(N) # (a_RL + a_cbf) <= 1
+        # Row 2N is the scalar part of the cone (no dependence on x), rows 2N+1.. are the cone block -cov_sqrt.
+        self.G = matrix(self.G_ay)
+        self.h = matrix(np.zeros((3 * N + 1, 1)))
+        self.dims = {'l': 2 * N, 'q': [N + 1], 's': []}
+        self.num_solves = 0
+        self.num_iters = 0
+        self.last_iters = 0
+
+    def set_data(self, a_rl, cov_sqrt):
+        N = self.stock_num
+        a_rl = np.reshape(np.array(a_rl, dtype=float), -1)
+        self.b_eq[0] = 1.0 - np.sum(a_rl)
+        self.G_ay[2*N+1:] = -cov_sqrt # socp_ax
+        self.G[2*N+1:, :] = self.matrix(self.G_ay[2*N+1:])
+        self.h[:N] = self.matrix(a_rl) # linear_h3
+        self.h[N:2*N] = self.matrix(1 - a_rl) # linear_h4
+        self.h[2*N+1:] = self.matrix(np.matmul(cov_sqrt, a_rl)) # socp_b
+
+    def solve(self, socp_d):
+        """
+        Solve with the current data and the risk bound socp_d. Returns (is_optimal, a_cbf), a_cbf is None if the problem is not solved to optimality.
+        """
+        self.h[2 * self.stock_num] = socp_d
+        self.solvers.options['show_progress'] = False
+        self.num_solves = self.num_solves + 1
+        self.last_iters = 0
+        kktsolver = self._kkt_factor if self.use_custom_kkt else None
+        try:
+            sol = self.solvers.coneqp(self.P, self.q, self.G, self.h, self.dims, self.A_eq, self.b_eq, kktsolver=kktsolver)
+        except (ArithmeticError, ValueError):
+            return False, None
+        self.last_iters = sol['iterations']
+        self.num_iters = self.num_iters + self.last_iters
+        if sol['status'] != 'optimal':
+            return False, None
+        return True, np.reshape(np.array(sol['x']), -1)
+
+    def _kkt_factor(self, W):
+        # Solve [P A' G'; A 0 0; G 0 -W'W] [ux; uy; W^{-1}uz] = [bx; by; bz] for the scaling W of the current iteration.
+        # With Gs = W^{-T}G and H = P + Gs'Gs: H ux + A'uy = bx + Gs'W^{-T}bz, A ux = by, uz = Gs ux - W^{-T}bz.
+        from cvxopt import blas, lapack, misc
+        N = self.stock_num
+        Gs = self.matrix(self.G)
+        misc.scale(Gs, W, trans='T', inverse='I')
+        H = self.matrix(0.0, (N, N))
+        blas.syrk(Gs, H, trans='T') # Lower triangle of Gs'Gs
+        H[::N+1] += self.P_diag_m # Diagonal P
+        lapack.potrf(H)
+        H_inv_a = self.matrix(1.0, (N, 1))
+        lapack.potrs(H, H_inv_a)
+        s_aa = blas.dot(self.ones_m, H_inv_a) # A H^{-1} A'
+        def f(x, y, z):
+            misc.scale(z, W, trans='T', inverse='I') # z := W^{-T}bz
+            blas.gemv(Gs, z, x, trans='T', beta=1.0) # x := bx + Gs'z
+            lapack.potrs(H, x)
+            uy = (blas.dot(self.ones_m, x) - y[0]) / s_aa
+            blas.axpy(H_inv_a, x, alpha=-uy)
+            y[0] = uy
+            blas.gemv(Gs, x, z, alpha=1.0, beta=-1.0) # z := Gs ux - W^{-T}bz
+        return f
+
+class CovFactor:
+    """
+    Square-root factor F (N, N) of the sample covariance of a rolling return window, F'F = cov, in place of scipy.linalg.sqrtm(cov).
+    Any F with F'F = cov gives the same cone ||F w|| = sqrt(w'cov w).
+
+    The window is [the last (lookback-1) daily returns, the predicted return]. The daily returns are kept in a ring buffer with a running sum,
+    so sliding the window by one day replaces one column and updates the mean in O(N). The factor is the centred data matrix
+    D = (window - mean) / sqrt(T-1), (T, N), which is valid for rank-deficient windows (T <= N) without any decomposition:
+    it is zero-padded to (N, N). Only when T > N, D is compressed to (N, N) by a QR decomposition, F = R.
+    """
+    def __init__(self, stock_num, lookback):
+        self.stock_num = stock_num
+        self.lookback = lookback
+        self.hist_num = lookback - 1 # Number of observed daily returns in the window, the last column is the prediction.
+        self.buf = np.zeros((self.hist_num, stock_num)) # Ring buffer of daily returns, (lookback-1, N)
+        self.buf_sum = np.zeros(stock_num)
+        self.pos = 0 # Index of the oldest daily return in buf
+        self.is_loaded = False
+
+    def window(self):
+        # Daily returns in the buffer from the oldest to the latest, (N, lookback-1)
+        return np.roll(self.buf, -self.pos, axis=0).T
+
+    def load(self, hist_returns):
+        """
+        hist_returns: (N, lookback-1), the observed daily returns of the window, [[t-lookback+2, .., t-1, t]].
+        Reuses the buffer when the window has slid by one day since the last call.
+        """
+        hist_returns = np.reshape(np.array(hist_returns, dtype=float), (self.stock_num, self.hist_num))
+        if self.is_loaded and (self.hist_num > 1) and np.array_equal(self.window()[:, 1:], hist_returns[:, :-1]):
+            self.buf_sum = self.buf_sum - self.buf[self.pos] + hist_returns[:, -1]
+            self.buf[self.pos] = hist_returns[:, -1]
+            self.pos = (self.pos + 1) % self.hist_num
+            if self.pos == 0:
+                self.buf_sum = np.sum(self.buf, axis=0) # Drop the rounding error of the running sum once per cycle.
+        elif not (self.is_loaded and np.array_equal(self.window(), hist_returns)):
+            self.buf = np.array(hist_returns.T)
+            self.buf_sum = np.sum(self.buf, axis=0)
+            self.pos = 0
+            self.is_loaded = True
+
+    def factor(self, pred_returns):
+        """
+        pred_returns: (N,), the predicted return appended to the window.
+        Returns F (N, N) with F'F = np.cov([window, pred_returns]).
+        """
+        N = self.stock_num
+        T = self.lookback
+        pred_returns = np.reshape(np.array(pred_returns, dtype=float), -1)
+        mean = (self.buf_sum + pred_returns) / T
+        D = np.append(self.buf - mean, np.reshape(pred_returns - mean, (1, -1)), axis=0) / np.sqrt(T - 1) # (T, N)
+        if T <= N:
+            F = np.zeros((N, N))
+            F[:T, :] = D
+        else:
+            F = np.linalg.qr(D, mode='r')
+        return F
+
+def cov_sqrt_factor(cov):
+    """
+    Square-root factor F (N, N) of any covariance matrix, F'F = cov, by its eigendecomposition (negative round-off eigenvalues are clipped).
+    Used in place of CovFactor when the covariance is not the sample covariance of the window.
+    """
+    eig_val, eig_vec = np.linalg.eigh(cov)
+    return np.sqrt(np.maximum(eig_val, 0.0))[:, None] * eig_vec.T
+
+def proj_simplex(v):
+    """
+    Euclidean projection of v onto the probability simplex {w: sum(w) = 1, w >= 0}.
+    """
+    u = np.sort(v)[::-1]
+    css = np.cumsum(u) - 1.0
+    ind = np.arange(1, len(v) + 1)
+    rho = np.flatnonzero(u - css / ind > 0)[-1]
+    theta = css[rho] / (rho + 1.0)
+    return np.maximum(v - theta, 0.0)
+
+def qp_simplex(H, c, w, tol=1e-10, max_iter=None):
+    """
+    Primal active-set method for min 0.5*w'Hw - c'w on the simplex, H positive definite.
+    w must be a feasible starting point. tol applies to the step on the weights, and tol * max(diag(H)) to the multipliers of the bounds.
+    Returns (w, is_converged, num_of_iterations).
+    """
+    N = len(c)
+    if max_iter is None:
+        max_iter = 4 * N + 20
+    lam_tol = tol * np.max(np.abs(np.diag(H)))
+    w = np.array(w, dtype=float)
+    free = w > 0 # Complement of the working set {i: w_i = 0}
+    for it in range(1, max_iter + 1):
+        F = np.flatnonzero(free)
+        g = np.matmul(H, w) - c
+        rhs = np.ones((len(F), 2))
+        rhs[:, 0] = g[F]
+        try:
+            sol = np.linalg.solve(H[np.ix_(F, F)], rhs)
+        except np.linalg.LinAlgError:
+            return w, False, it
+        nu = -np.sum(sol[:, 0]) / np.sum(sol[:, 1])
+        p_F = -(sol[:, 0] + nu * sol[:, 1])
+        if np.max(np.abs(p_F)) <= tol:
+            # Stationary on the working set, check the multipliers of the active bounds.
+            lam = g + nu
+            lam[free] = np.inf
+            j = np.argmin(lam)
+            if lam[j] >= -lam_tol:
+                return w, True, it
+            free[j] = True
+        else:
+            neg = p_F < 0
+            alpha = 1.0
+            blocking = None
+            if np.any(neg):
+                ratios = -w[F][neg] / p_F[neg]
+                k = np.argmin(ratios)
+                if ratios[k] < 1.0:
+                    alpha = ratios[k]
+                    blocking = F[neg][k]
+            w[F] = w[F] + alpha * p_F
+            if blocking is not None:
+                w[blocking] = 0.0
+                free[blocking] = False
+            w[~free] = 0.0
+    return w, False, max_iter
+
+def min_risk_portfolio(cov, w_start=None):
+    """
+    Long-only minimum-variance portfolio min w'cov w on the simplex.
+    cov is at most rank (lookback - 1), so a small ridge keeps the active-set systems non-singular. w_start is an optional feasible starting point.
+    Returns (w, risk_lb, risk_ub, is_converged, num_of_iterations): w'cov w = risk_ub^2 holds for any returned w, and if converged the true minimum risk lies in [risk_lb, risk_ub].
+    """
+    N = cov.shape[0]
+    if N == 1:
+        risk = np.sqrt(max(cov[0, 0], 0.0))
+        return np.ones(1), risk, risk, True, 0
+    ridge = 1e-8 * max(np.trace(cov) / N, 1e-12)
+    H = cov + ridge * np.eye(N)
+    if w_start is None:
+        w_start = np.ones(N) / N
+    w, is_converged, iters = qp_simplex(H, np.zeros(N), w_start, max_iter=10 * N + 50)
+    var_ub = max(np.matmul(np.matmul(w, cov), w), 0.0)
+    # min (w'cov w + ridge*|w|^2) <= min w'cov w + ridge, since |w| <= 1 on the simplex.
+    var_lb = max(var_ub + ridge * np.sum(w**2) - ridge, 0.0)
+    return w, np.sqrt(var_lb), np.sqrt(var_ub), is_converged, iters
+
+class MinRiskFrontier:
+    """
+    Per-day bounds of the minimum long-only risk under cov_r_t1 of the controller, precomputed for a split.
+    cov_r_t1 is the sample covariance of [h_1, .., h_{T-1}, p]: the T-1 observed daily returns of the window and the predicted return p,
+    which depends on the price prediction / market observer. With m and S the mean and scatter matrix of the observed part,
+
+        (T-1) * w'cov_r_t1 w = w'S w + ((T-1)/T) * (w'(p - m))^2
+
+    so min_w w'S w / (T-1) over the simplex is a lower bound of the minimum variance for any p. It is precomputed per day together
+    with its minimiser w_s. Given p, the variance of w_s is an upper bound, updated in O(N).
+    """
+    def __init__(self, daily_return_lst):
+        # daily_return_lst: (num_of_days, num_of_stocks, lookback), the DAILYRETURNS window of each trading day.
+        R = np.array(daily_return_lst, dtype=float)
+        self.day_num, self.stock_num, self.lookback = R.shape
+        T = self.lookback
+        H = R[:, :, 1:] # Observed part of the window of cov_r_t1, (num_of_days, N, T-1)
+        self.hist_mean = np.mean(H, axis=2) # (num_of_days, N)
+        self.w_s = np.zeros((self.day_num, self.stock_num))
+        self.ss_w = np.zeros(self.day_num) # w_s'S w_s
+        self.risk_lb = np.zeros(self.day_num)
+        for day in range(self.day_num):
+            Hc = H[day] - self.hist_mean[day][:, None]
+            S = np.matmul(Hc, Hc.T)
+            w, risk_lb, _, is_converged, _ = min_risk_portfolio(S / (T - 1))
+            self.w_s[day] = w
+            self.ss_w[day] = np.matmul(np.matmul(w, S), w)
+            # Without convergence, w_s is still a valid point for the upper bound, but there is no lower bound.
+            self.risk_lb[day] = risk_lb if is_converged else 0.0
+
+    def bounds(self, day, pred_returns):
+        """
+        Returns (risk_lb, risk_ub) of the minimum long-only risk of the day for the predicted return pred_returns (N,).
+        """
+        T = self.lookback
+        proj = np.matmul(self.w_s[day], np.reshape(pred_returns, -1) - self.hist_mean[day])
+        var_ub = (self.ss_w[day] + ((T - 1) / T) * proj**2) / (T - 1)
+        return self.risk_lb[day], np.sqrt(max(var_ub, 0.0))
+
+class FactorRiskModel:
+    """
+    Low-rank-plus-diagonal model cov = L L' + diag(d) of cov_r_t1 of the controller, estimated per day for a split.
+    As in MinRiskFrontier, cov_r_t1 = S / (T-1) + (p - m)(p - m)' / T. The scatter part S / (T-1) is modelled per day by its num_factors
+    leading principal components, L_h = U_k s_k / sqrt(T-1), plus the residual variance of each asset, d = diag(S) / (T-1) - rowsum(L_h^2).
+    The prediction is one more factor, (p - m) / sqrt(T), so any p is handled in O(N*k) and L is (N, k+1).
+    num_factors: 0 keeps all components of the window (k = min(N, T-1)), then d = 0 and the model equals cov_r_t1.
+    """
+    def __init__(self, daily_return_lst, num_factors=0):
+        # daily_return_lst: (num_of_days, num_of_stocks, lookback), the DAILYRETURNS window of each trading day.
+        R = np.array(daily_return_lst, dtype=float)
+        self.day_num, self.stock_num, self.lookback = R.shape
+        T = self.lookback
+        H = R[:, :, 1:] # Observed part of the window of cov_r_t1, (num_of_days, N, T-1)
+        self.hist_mean = np.mean(H, axis=2) # (num_of_days, N)
+        Hc = H - self.hist_mean[:, :, None]
+        U, sv, _ = np.linalg.svd(Hc, full_matrices=False) # (num_of_days, N, r), (num_of_days, r), r = min(N, T-1)
+        k = np.shape(sv)[1] if num_factors <= 0 else min(num_factors, np.shape(sv)[1])
+        self.num_factors = k
+        self.loading = U[:, :, :k] * sv[:, None, :k] / np.sqrt(T - 1) # L_h, (num_of_days, N, k)
+        self.spec_var = np.maximum(np.sum(Hc**2, axis=2) / (T - 1) - np.sum(self.loading**2, axis=2), 0.0) # d, (num_of_days, N)
+        if k == np.shape(sv)[1]:
+            self.spec_var = np.zeros_like(self.spec_var) # Exact, drop the rounding error.
+        # Share of the variance of the window explained by the factors, per day.
+        self.explained = np.sum(sv[:, :k]**2, axis=1) / np.maximum(np.sum(sv**2, axis=1), 1e-300)
+
+    def factors(self, day, pred_returns):
+        """
+        Returns (L, d) of the day for the predicted return pred_returns (N,), L (N, k+1) and d (N,).
+        """
+        T = self.lookback
+        pred_factor = (np.reshape(pred_returns, -1) - self.hist_mean[day]) / np.sqrt(T)
+        return np.append(self.loading[day], np.reshape(pred_factor, (-1, 1)), axis=1), self.spec_var[day]
+
+    @staticmethod
+    def dense_cov(L, d):
+        # (N, N) covariance of the model.
+        return np.matmul(L, L.T) + np.diag(d)
+
+class CbfProjectionSolver:
+    """
+    Exact solver of the CBF risk-constrained correction without a modelling layer.
+    With w = a_rl + a_cbf, the controller problem is the projection
+
+        min_w ||w - a_rl||^2  s.t.  w on the simplex, w'cov w <= socp_d^2
+
+    If the projection of a_rl onto the simplex already satisfies the cone, it is the answer. Otherwise the cone is active and
+    w(mu) = argmin_{w on simplex} ||w - a_rl||^2 + mu * w'cov w is found for the cone multiplier mu by a safeguarded regula falsi
+    (Illinois) on w(mu)'cov w(mu) = socp_d^2. Each w(mu) is a small simplex QP solved by qp_simplex, warm-started along the mu path.
+    Feasibility is decided by the long-only minimum-variance risk. N = 1 and N = 2 are solved in closed form.
+
+    Consecutive trading days give nearly identical problems, so the solver keeps the last primal solution, cone multiplier and
+    minimum-variance portfolio, and starts the next solve from them (warm start). One solver is kept per env.
+
+    solve() returns (status, a_cbf), status in ['optimal', 'infeasible', 'numerical', 'timeout']. On 'numerical' the caller should fall back to a general-purpose solver.
+    With a deadline (time.perf_counter() value), the solve stops once it is passed and returns 'timeout' with the feasible point closest to a_rl
+    found so far (inside the cone, not optimal), or None if no feasible point was found yet.
+    """
+    def __init__(self, stock_num, tol=1e-9, max_mu_iter=100, warm_start=True, approx=False, approx_tol=1e-2):
+        self.stock_num = stock_num
+        self.tol = tol # Relative tolerance of the cone, |w'cov w - socp_d^2| <= tol * socp_d^2 at the returned point.
+        self.max_mu_iter = max_mu_iter
+        self.warm_start = warm_start
+        # Approximate projection: the regula falsi stops once w'cov w >= (1 - approx_tol) * socp_d^2, or after max_mu_iter steps with the
+        # feasible end of the bracket instead of 'numerical'. The point is still on the simplex and inside the cone, but not the closest one.
+        self.approx = approx
+        self.approx_tol = approx_tol
+        self.reset_warm_start()
+        self.num_solves = 0
+        self.num_iters = 0 # Active-set iterations of all simplex QPs
+        self.num_mu_iters = 0 # Evaluations of w(mu)
+        self.last_iters = 0
+        self.last_min_risk = None # Risk of the minimum-variance portfolio of the last solve, None if it was not needed.
+
+    def reset_warm_start(self):
+        self.warm_w = None # Last optimal w
+        self.warm_mu = 0.0 # Cone multiplier of the last optimal w, 0 if the cone was inactive.
+        self.warm_w_mv = None # Last minimum-variance portfolio
+
+    def solve(self, a_rl, cov, socp_d, is_feasible=False, deadline=None):
+        """
+        is_feasible: the caller already knows that the problem is feasible (e.g. from MinRiskFrontier), the minimum-variance check is skipped.
+        deadline: time.perf_counter() value after which the solve returns 'timeout', None for no limit. N <= 2 is closed form and never times out.
+        """
+        a_rl = np.reshape(np.array(a_rl, dtype=float), -1)
+        N = len(a_rl)
+        cov = np.reshape(np.array(cov, dtype=float), (N, N))
+        self.num_solves = self.num_solves + 1
+        self.last_iters = 0
+        self.last_min_risk = None
+        if socp_d < 0:
+            return 'infeasible', None
+        if N == 1:
+            status, w = self._solve_n1(cov, socp_d)
+        elif N == 2:
+            status, w = self._solve_n2(a_rl, cov, socp_d)
+        else:
+            status, w = self._solve_general(a_rl, cov, socp_d, is_feasible, deadline)
+        self.num_iters = self.num_iters + self.last_iters
+        if w is None:
+            return status, None
+        return status, w - a_rl
+
+    def _solve_n1(self, cov, socp_d):
+        # The only point on the simplex is w = [1].
+        if cov[0, 0] <= socp_d**2 * (1 + self.tol):
+            return 'optimal', np.ones(1)
+        return 'infeasible', None
+
+    def _solve_n2(self, a_rl, cov, socp_d):
+        # w = (t, 1-t), t in [0, 1]. The risk is the convex quadratic qa*t^2 + qb*t + qc, the objective is minimised at t_star.
+        qa = cov[0, 0] - 2 * cov[0, 1] + cov[1, 1]
+        qb = 2 * cov[0, 1] - 2 * cov[1, 1]
+        qc = cov[1, 1] - socp_d**2 * (1 + self.tol)
+        t_star = np.clip((a_rl[0] - a_rl[1] + 1) / 2, 0.0, 1.0)
+        if qa > 1e-15:
+            disc = qb**2 - 4 * qa * qc
+            if disc < 0:
+                return 'infeasible', None
+            sq = np.sqrt(disc)
+            t_lo, t_hi = (-qb - sq) / (2 * qa), (-qb + sq) / (2 * qa)
+        elif np.abs(qb) > 1e-15:
+            t_root = -qc / qb
+            t_lo, t_hi = (-np.inf, t_root) if qb > 0 else (t_root, np.inf)
+        else:
+            if qc > 0:
+                return 'infeasible', None
+            t_lo, t_hi = -np.inf, np.inf
+        t_lo, t_hi = max(t_lo, 0.0), min(t_hi, 1.0)
+        if t_lo > t_hi:
+            return 'infeasible', None
+        t = np.clip(t_star, t_lo, t_hi)
+        return 'optimal', np.array([t, 1.0 - t])
+
+    def _solve_general(self, a_rl, cov, socp_d, is_feasible=False, deadline=None):
+        N = len(a_rl)
+        d2 = socp_d**2
+        is_warm = self.warm_start and (self.warm_w is not None) and (len(self.warm_w) == N)
+        w0 = proj_simplex(a_rl)
+        if np.matmul(np.matmul(w0, cov), w0) <= d2 * (1 + self.tol):
+            # The cone is inactive.
+            self.warm_w, self.warm_mu = w0, 0.0
+            return 'optimal', w0
+
+        if not is_feasible:
+            # Any point on the simplex inside the cone proves feasibility, even before the minimum-variance QP has converged.
+            w_mv_start = self.warm_w_mv if (is_warm and (self.warm_w_mv is not None)) else None
+            w_mv, risk_lb, risk_ub, is_converged, iters = min_risk_portfolio(cov, w_start=w_mv_start)
+            self.last_iters = self.last_iters + iters
+            self.warm_w_mv = w_mv
+            self.last_min_risk = risk_ub
+            if risk_ub**2 > d2 * (1 + self.tol):
+                if is_converged and (risk_lb**2 > d2 * (1 + self.tol)):
+                    return 'infeasible', None
+                # Not converged, or within the ridge error of the minimum risk. Leave it to the general-purpose solver.
+                return 'numerical', None
+            w_feas = w_mv
+        else:
+            w_feas = None
+
+        def check_timeout(w_hi, rho_hi):
+            # The feasible point closest to a_rl so far: the upper end of the bracket once found, else the minimum-variance portfolio.
+            if (deadline is None) or (time.perf_counter() <= deadline):
+                return None
+            return 'timeout', (w_hi if rho_hi <= 0 else w_feas)
+
+        eye = np.eye(N)
+        def eval_mu(mu, w_start):
+            w, is_converged, iters = qp_simplex(eye + mu * cov, a_rl, w_start)
+            self.last_iters = self.last_iters + iters
+            self.num_mu_iters = self.num_mu_iters + 1
+            return w, np.matmul(np.matmul(w, cov), w) - d2, is_converged
+
+        # Bracket the root of rho(mu) = w(mu)'cov w(mu) - d2, rho(0) > 0.
+        # Cold: grow mu from 1/trace(cov). Warm: start from the last multiplier and search in both directions with a smaller factor.
+        mu_lo, rho_lo, w_lo = 0.0, np.matmul(np.matmul(w0, cov), w0) - d2, w0
+        if is_warm and (self.warm_mu > 0):
+            mu_hi, w_hi, factor = self.warm_mu, self.warm_w, 2.0
+        else:
+            mu_hi, w_hi, factor = 1.0 / max(np.trace(cov), 1e-12), w0, 8.0
+        w_hi, rho_hi, is_converged = eval_mu(mu_hi, w_hi)
+        if not is_converged:
+            return 'numerical', None
+        if rho_hi <= 0:
+            # Already an upper end, tighten the lower end. mu_lo = 0 remains a valid lower end if this does not succeed.
+            for _ in range(8):
+                res = check_timeout(w_hi, rho_hi)
+                if res is not None:
+                    return res
+                mu = mu_hi / factor
+                w, rho, is_converged = eval_mu(mu, w_hi)
+                if not is_converged:
+                    return 'numerical', None
+                if rho > 0:
+                    mu_lo, rho_lo, w_lo = mu, rho, w
+                    break
+                mu_hi, rho_hi, w_hi = mu, rho, w
+        else:
+            for _ in range(60):
+                res = check_timeout(w_hi, rho_hi)
+                if res is not None:
+                    return res
+                mu_lo, rho_lo, w_lo = mu_hi, rho_hi, w_hi
+                mu_hi = mu_hi * factor
+                w_hi, rho_hi, is_converged = eval_mu(mu_hi, w_hi)
+                if not is_converged:
+                    return 'numerical', None
+                if rho_hi <= 0:
+                    break
+            else:
+                return 'numerical', None
+
+        # Illinois regula falsi, the returned point stays on the feasible side (rho <= 0).
+        side = 0
+        for _ in range(self.max_mu_iter):
+            stop_tol = self.approx_tol if self.approx else self.tol
+            if (rho_hi >= -stop_tol * d2) or (mu_hi - mu_lo <= 1e-12 * mu_hi):
+                self.warm_w, self.warm_mu = w_hi, mu_hi
+                return 'optimal', w_hi
+            res = check_timeout(w_hi, rho_hi)
+            if res is not None:
+                return res
+            mu = (mu_lo * rho_hi - mu_hi * rho_lo) / (rho_hi - rho_lo)
+            if not (mu_lo < mu < mu_hi):
+                mu = 0.5 * (mu_lo + mu_hi)
+            w, rho, is_converged = eval_mu(mu, w_hi if rho_hi > -rho_lo else w_lo)
+            if not is_converged:
+                return 'numerical', None
+            if rho <= 0:
+                mu_hi, rho_hi, w_hi = mu, rho, w
+                if side == -1:
+                    rho_lo = rho_lo / 2
+                side = -1
+            else:
+                mu_lo, rho_lo, w_lo = mu, rho, w
+                if side == 1:
+                    rho_hi = rho_hi / 2
+                side = 1
+        if self.approx:
+            self.warm_w, self.warm_mu = w_hi, mu_hi
+            return 'optimal', w_hi
+        return 'numerical', None
+
+def blend_into_cone(a_rl, w_anchor, cov, socp_d):
+    """
+    Smallest theta in [0, 1] such that w = a_rl + theta * (w_anchor - a_rl) satisfies w'cov w <= socp_d^2, in closed form.
+    The risk is a convex quadratic in theta, its first root is taken. Returns 1 if even w_anchor is outside the cone.
+    """
+    v = w_anchor - a_rl
+    cov_v = np.matmul(cov, v)
+    qa = np.matmul(v, cov_v)
+    qb = np.matmul(a_rl, cov_v)
+    qc = np.matmul(np.matmul(a_rl, cov), a_rl) - socp_d**2 * (1 - 1e-9)
+    if qc <= 0:
+        return 0.0
+    disc = qb**2 - qa * qc
+    den = -qb + np.sqrt(max(disc, 0.0))
+    if (disc < 0) or (den <= 0):
+        return 1.0
+    return float(min(qc / den, 1.0))
+
+def proj_simplex_batch(V):
+    """
+    Row-wise Euclidean projection of V (B, N) onto the probability simplex.
+    """
+    B, N = V.shape
+    U = -np.sort(-V, axis=1)
+    css = np.cumsum(U, axis=1) - 1.0
+    ind = np.arange(1, N + 1)
+    rho = np.sum(U - css / ind > 0, axis=1) - 1 # The condition holds on a prefix of the sorted row.
+    theta = css[np.arange(B), rho] / (rho + 1.0)
+    return np.maximum(V - theta[:, None], 0.0)
+
+class CbfBatchProjectionSolver:
+    """
+    Vectorised solver of B independent CBF projections
+
+        min_w ||w_b - a_rl_b||^2  s.t.  w_b on the simplex, w_b'cov_b w_b <= socp_d_b^2,  b = 1, .., B
+
+    run together with array operations over the batch.
+      1. Rows whose projection onto the simplex satisfies the cone are done.
+      2. Feasibility screen: accelerated projected gradient on the long-only minimum variance. An iterate inside the cone proves feasibility,
+         and the Frank-Wolfe gap gives a lower bound of the minimum variance that proves infeasibility.
+      3. Feasible rows: Dykstra's alternating projections between the simplex (sorting method) and the risk ellipsoid (batched
+         eigendecomposition and a monotone Newton iteration on the secular equation) converge to the projection onto the intersection.
+    Rows left undecided or unconverged (thin intersections) are solved one by one with the exact CbfProjectionSolver, and with the
+    CBF-SOCP if that reports numerical trouble.
+
+    solve() returns (status, a_cbf): status (B,) in ['optimal', 'infeasible'], a_cbf (B, N) with zero rows where not optimal.
+    """
+    def __init__(self, stock_num, tol=1e-10, cone_tol=1e-6, max_iter=500, screen_iter=300):
+        self.stock_num = stock_num
+        self.tol = tol # Tolerance of the Dykstra iterates on the weights.
+        self.cone_tol = cone_tol # Relative tolerance of the cone at a returned Dykstra point, w'cov w <= (1 + cone_tol) * socp_d^2.
+        self.max_iter = max_iter
+        self.screen_iter = screen_iter
+        self.exact_solver = CbfProjectionSolver(stock_num=stock_num, warm_start=False)
+        self.socp_problem = None # Built on the first row the exact solver cannot decide.
+        self.num_solves = 0
+        self.num_iters = 0 # Dykstra iterations of the batch
+        self.num_exact = 0 # Rows handed over to the exact solver
+
+    def solve(self, a_rl, cov, socp_d):
+        a_rl = np.array(a_rl, dtype=float) # (B, N)
+        B, N = a_rl.shape
+        cov = np.reshape(np.array(cov, dtype=float), (B, N, N))
+        socp_d = np.reshape(np.array(socp_d, dtype=float), -1) # (B,)
+        d2 = socp_d**2
+        self.num_solves = self.num_solves + B
+        status = np.array(['numerical'] * B, dtype=object)
+        w_final = np.zeros((B, N))
+        status[socp_d < 0] = 'infeasible'
+
+        w0 = proj_simplex_batch(a_rl)
+        risk2_0 = np.einsum('bi,bij,bj->b', w0, cov, w0)
+        inactive = (socp_d >= 0) & (risk2_0 <= d2 * (1 + 1e-9))
+        status[inactive] = 'optimal'
+        w_final[inactive] = w0[inactive]
+
+        idx = np.flatnonzero(status == 'numerical')
+        exact_idx = []
+        if len(idx) > 0:
+            lam_cov, V = np.linalg.eigh(cov[idx]) # (b, N), (b, N, N)
+            lam_cov = np.maximum(lam_cov, 0.0)
+            is_feasible, is_infeasible = self._screen(cov[idx], lam_cov[:, -1], d2[idx])
+            status[idx[is_infeasible]] = 'infeasible'
+            exact_idx.extend(idx[~(is_feasible | is_infeasible)])
+            sub = np.flatnonzero(is_feasible)
+            if len(sub) > 0:
+                w, is_converged = self._dykstra(a_rl[idx[sub]], lam_cov[sub], V[sub], d2[idx[sub]])
+                risk2 = np.einsum('bi,bij,bj->b', w, cov[idx[sub]], w)
+                ok = is_converged & (risk2 <= d2[idx[sub]] * (1 + self.cone_tol))
+                status[idx[sub[ok]]] = 'optimal'
+                w_final[idx[sub[ok]]] = w[ok]
+                exact_idx.extend(idx[sub[~ok]])
+        for b in exact_idx:
+            self.num_exact = self.num_exact + 1
+            st, a_cbf = self.exact_solver.solve(a_rl=a_rl[b], cov=cov[b], socp_d=socp_d[b])
+            if st == 'numerical':
+                # Fall back to the SOCP, with the symmetric eigen factor of cov[b] as the cone matrix.
+                lam_b, V_b = np.linalg.eigh(cov[b])
+                if self.socp_problem is None:
+                    self.socp_problem = CbfSocpProblem(stock_num=N)
+                self.socp_problem.set_data(a_rl=a_rl[b], cov_sqrt=np.matmul(V_b * np.sqrt(np.maximum(lam_b, 0.0)), V_b.T))
+                is_optimal, a_cbf = self.socp_problem.solve(socp_d=socp_d[b])
+                st = 'optimal' if is_optimal else 'infeasible'
+            status[b] = st
+            if st == 'optimal':
+                w_final[b] = a_rl[b] + a_cbf
+        a_cbf = np.where((status == 'optimal')[:, None], w_final - a_rl, 0.0)
+        return status, a_cbf
+
+    def _screen(self, cov, lam_max, d2):
+        # FISTA on min w'cov w over the simplex, step 1/L with L = 2*lam_max.
+        B, N = cov.shape[0], cov.shape[1]
+        w = np.ones((B, N)) / N
+        z = np.array(w)
+        t = 1.0
+        step = 1.0 / np.maximum(2.0 * lam_max, 1e-300)
+        is_feasible = np.zeros(B, dtype=bool)
+        is_infeasible = np.zeros(B, dtype=bool)
+        for _ in range(self.screen_iter):
+            g = 2.0 * np.einsum('bij,bj->bi', cov, w)
+            var = np.einsum('bi,bi->b', w, g) / 2.0
+            # For convex f on the simplex, min f >= f(w) + min_i g_i - g'w.
+            var_lb = var + np.min(g, axis=1) - 2.0 * var
+            is_feasible = is_feasible | (var <= d2)
+            is_infeasible = is_infeasible | ((var_lb > d2 * (1 + 1e-9)) & ~is_feasible)
+            if np.all(is_feasible | is_infeasible):
+                break
+            g_z = 2.0 * np.einsum('bij,bj->bi', cov, z)
+            w_new = proj_simplex_batch(z - step[:, None] * g_z)
+            t_new = (1.0 + np.sqrt(1.0 + 4.0 * t**2)) / 2.0
+            z = w_new + ((t - 1.0) / t_new) * (w_new - w)
+            w, t = w_new, t_new
+        return is_feasible, is_infeasible
+
+    def _dykstra(self, a_rl, lam_cov, V, d2):
+        B, N = a_rl.shape
+        x = np.array(a_rl)
+        y = proj_simplex_batch(x)
+        p = np.zeros((B, N))
+        q = np.zeros((B, N))
+        nu = np.zeros(B) # Multipliers of the ellipsoid projections, warm-started across iterations.
+        is_converged = np.zeros(B, dtype=bool)
+        act = np.arange(B) # Rows still iterating
+        for it in range(self.max_iter):
+            y_new = proj_simplex_batch(x[act] + p[act])
+            p[act] = x[act] + p[act] - y_new
+            x_new, nu[act] = self._proj_ellipsoid(y_new + q[act], lam_cov[act], V[act], d2[act], nu[act])
+            q[act] = y_new + q[act] - x_new
+            step = np.maximum(np.max(np.abs(y_new - y[act]), axis=1), np.max(np.abs(x_new - x[act]), axis=1))
+            gap = np.max(np.abs(x_new - y_new), axis=1)
+            x[act], y[act] = x_new, y_new
+            done = (step <= self.tol) & (gap <= self.tol)
+            is_converged[act[done]] = True
+            act = act[~done]
+            if len(act) == 0:
+                break
+        self.num_iters = self.num_iters + it + 1
+        return y, is_converged
+
+    def _proj_ellipsoid(self, z, lam_cov, V, d2, nu):
+        # Projection onto {w: w'cov w <= d2}: w = V diag(1 / (1 + nu*lam)) V'z with nu >= 0 solving s(nu)^2 = sum(lam c^2 / (1 + nu*lam)^2) = d2, c = V'z.
+        # Newton on phi(nu) = 1/s(nu) - 1/d (secular equation form of trust-region methods). phi is concave and increasing, so a step from
+        # a warm start nu on the right lands on the left of the root, and from there Newton converges monotonically. Returns (w, nu).
+        c = np.einsum('bji,bj->bi', V, z)
+        lc2 = lam_cov * c**2
+        d = np.sqrt(d2)
+        outside = np.sum(lc2, axis=1) > d2
+        nu = np.where(outside, nu, 0.0)
+        for _ in range(50):
+            den = 1.0 + nu[:, None] * lam_cov
+            s = np.sqrt(np.sum(lc2 / den**2, axis=1))
+            active = outside & (np.abs(s - d) > 1e-13 * d)
+            if not np.any(active):
+                break
+            dphi = np.sum(lc2 * lam_cov / den**3, axis=1) / np.maximum(s**3, 1e-300)
+            phi = 1.0 / np.maximum(s, 1e-300) - 1.0 / np.maximum(d, 1e-300)
+            nu = np.where(active, np.maximum(nu - phi / np.maximum(dphi, 1e-300), 0.0), nu)
+        return np.einsum('bij,bj->bi', V, c / (1.0 + nu[:, None] * lam_cov)), nu
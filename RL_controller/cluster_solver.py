@@ -0,0 +1,145 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         cluster_solver.py
+ Description:  Cluster decomposition of the CBF problem for very large portfolios: asset clusters, per-cluster solves
+               in worker processes, and the top-level allocation across clusters.
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+import atexit
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import squareform
+from .cbf_solver import CbfProjectionSolver, proj_simplex, min_risk_portfolio
+
+def gen_asset_clusters(returns, num_clusters, labels=None):
+    """
+    Partition of the assets into clusters, a list of index arrays.
+    returns: (days, num_of_stocks) daily returns, grouped by average-linkage clustering on the correlation distance sqrt(2 * (1 - corr)).
+    labels: (num_of_stocks, ) optional sector labels, used instead of the returns.
+    """
+    if labels is not None:
+        labels = np.array(labels)
+        return [np.flatnonzero(labels == label) for label in np.unique(labels)]
+    returns = np.array(returns, dtype=float)
+    N = np.shape(returns)[1]
+    num_clusters = min(max(num_clusters, 1), N)
+    if (N == 1) or (num_clusters == 1):
+        return [np.arange(N)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.nan_to_num(np.corrcoef(returns.T), nan=0.0) # Constant returns have no correlation.
+    np.fill_diagonal(corr, 1.0)
+    dist = np.sqrt(np.maximum(2 * (1 - corr), 0.0))
+    label_ay = fcluster(linkage(squareform(dist, checks=False), method='average'), t=num_clusters, criterion='maxclust')
+    return [np.flatnonzero(label_ay == label) for label in np.unique(label_ay)]
+
+def alloc_clusters(s_rl, rho, socp_d, max_iter=100):
+    """
+    Top-level problem of the cluster decomposition: the weights s of the clusters closest to s_rl with a total risk budget,
+
+        min_s ||s - s_rl||^2  s.t.  s on the simplex, rho's <= socp_d
+
+    rho: (C, ) risk of the portfolio of each cluster. By the triangle inequality, the risk of sum_c s_c * v_c is at most rho's,
+    so the global bound holds. s(lam) = proj_simplex(s_rl - lam * rho) and rho's(lam) is non-increasing, lam is found by bisection.
+    Returns s (C, ), or None if even the least risky cluster exceeds socp_d.
+    """
+    rho = np.array(rho, dtype=float)
+    s = proj_simplex(np.array(s_rl, dtype=float))
+    if np.dot(rho, s) <= socp_d:
+        return s
+    if np.min(rho) > socp_d:
+        return None
+    lam_lo, lam_hi = 0.0, 1.0
+    for _ in range(200):
+        s_hi = proj_simplex(s_rl - lam_hi * rho)
+        if np.dot(rho, s_hi) <= socp_d:
+            break
+        lam_lo, lam_hi = lam_hi, lam_hi * 2
+    else:
+        # All weight on the least risky cluster.
+        s_hi = np.zeros(len(rho))
+        s_hi[np.argmin(rho)] = 1.0
+        return s_hi
+    for _ in range(max_iter):
+        lam = 0.5 * (lam_lo + lam_hi)
+        s = proj_simplex(s_rl - lam * rho)
+        if np.dot(rho, s) <= socp_d:
+            lam_hi, s_hi = lam, s
+        else:
+            lam_lo = lam
+        if lam_hi - lam_lo <= 1e-12 * lam_hi:
+            break
+    return s_hi
+
+_cluster_solver_dict = {} # (env.ctrl_cluster_key, cluster) -> CbfProjectionSolver, one dict per worker process.
+
+def solve_cluster_job(key, v_rl, cov, socp_d):
+    """
+    Correction of one cluster: the portfolio v of the cluster closest to v_rl with v'cov v <= socp_d^2, warm-started from the previous day of the
+    cluster. If the cluster cannot meet the bound, its minimum-variance portfolio (the top-level problem then gives it less weight).
+    Returns (v, rho, num_of_iterations, is_projection), rho = sqrt(v'cov v).
+    """
+    n = len(v_rl)
+    solver = _cluster_solver_dict.get(key)
+    if (solver is None) or (solver.stock_num != n):
+        solver = CbfProjectionSolver(stock_num=n)
+        _cluster_solver_dict[key] = solver
+    status, x = solver.solve(a_rl=v_rl, cov=cov, socp_d=socp_d)
+    iters = solver.last_iters
+    if status == 'optimal':
+        v = v_rl + x
+    else:
+        w_start = solver.warm_w_mv if (solver.warm_w_mv is not None) and (len(solver.warm_w_mv) == n) else None
+        v, _, _, _, mv_iters = min_risk_portfolio(cov, w_start=w_start)
+        iters = iters + mv_iters
+    return v, np.sqrt(max(np.matmul(np.matmul(v, cov), v), 0.0)), iters, status == 'optimal'
+
+class ClusterExecutor:
+    """
+    Workers of the per-cluster solves. Cluster c of every env runs on the single-worker executor c % num_workers, so that the warm start of
+    a cluster follows its days in order. num_workers: 0 solves inline.
+    """
+    def __init__(self, num_workers=0):
+        self.num_workers = num_workers
+        self.executor_lst = [ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) for _ in range(num_workers)]
+
+    def submit(self, slot, fn, *args):
+        if self.num_workers == 0:
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+        return self.executor_lst[slot % self.num_workers].submit(fn, *args)
+
+    def shutdown(self):
+        for executor in self.executor_lst:
+            executor.shutdown(wait=True)
+        self.executor_lst = []
+        self.num_workers = 0
+        _cluster_solver_dict.clear() # The caches of the inline solves live in this process.
+
+_cluster_executor = None
+
+def get_cluster_executor(num_workers):
+    """
+    The ClusterExecutor shared by all envs of the process, (re)started if the number of workers changes.
+    """
+    global _cluster_executor
+    if (_cluster_executor is None) or (_cluster_executor.num_workers != num_workers):
+        if _cluster_executor is not None:
+            _cluster_executor.shutdown()
+        _cluster_executor = ClusterExecutor(num_workers=num_workers)
+    return _cluster_executor
+
+def shutdown_cluster_executor():
+    global _cluster_executor
+    if _cluster_executor is not None:
+        _cluster_executor.shutdown()
+        _cluster_executor = None
+
+atexit.register(shutdown_cluster_executor)
@@ -0,0 +1,142 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         controller_worker.py
+ Description:  Run the solves of the solver-based agent in worker processes (or threads) through a request/future API.
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .controllers import RL_withController, get_pred_dict, prepare_cbf, solve_cbf, audit_cbf, commit_cbf, combine_actions
+
+class CbfSolverCache:
+    """
+    Cached solvers of solve_cbf for one env, kept on the worker side in place of the env attributes of the same name.
+    """
+    def __init__(self, stock_num):
+        self.stock_num = stock_num
+        self.cbf_problem = None
+        self.cbf_factor_problem = None
+        self.cbf_proj_solver = None
+        self.cbf_approx_solver = None
+        self.cbf_audit_solver = None
+        self.cov_factor = None
+
+_solver_cache_dict = {} # (pool id, env key) -> CbfSolverCache, one dict per worker process (shared by the pools of the process with the thread backend).
+
+def solve_cbf_job(key, ctx):
+    """
+    Job of a worker: solve_cbf on ctx with the cached (warm-started) solvers of the env key, (pool id, index of the env in the pool).
+    Only ctx is sent, the env stays in the main process.
+    """
+    cache = _solver_cache_dict.get(key)
+    if (cache is None) or (cache.stock_num != ctx['N']):
+        cache = CbfSolverCache(stock_num=ctx['N'])
+        _solver_cache_dict[key] = cache
+    start_time = time.perf_counter()
+    res = solve_cbf(env=cache, ctx=ctx)
+    res['solve_time'] = time.perf_counter() - start_time
+    audit_cbf(env=cache, ctx=ctx, res=res)
+    return res
+
+class ControllerFuture:
+    """
+    Pending controller action of an env. result() waits for the solve, writes it back to the env (commit_cbf) and returns the final action, (N, ).
+    """
+    def __init__(self, pool, env, a_rl, ctx=None, future=None, a_final=None):
+        self.pool = pool
+        self.env = env
+        self.a_rl = a_rl
+        self.ctx = ctx
+        self.future = future
+        self.a_final = a_final # Already known for the inline controller.
+
+    def done(self):
+        return (self.future is None) or self.future.done()
+
+    def result(self):
+        if self.a_final is None:
+            res = self.future.result()
+            self.pool.release(env=self.env)
+            self.env.action_rl_memory.append(self.a_rl)
+            a_cbf, is_solvable_status = commit_cbf(env=self.env, ctx=self.ctx, res=res)
+            self.a_final = combine_actions(env=self.env, a_rl=self.a_rl, a_cbf=a_cbf, is_solvable_status=is_solvable_status)
+        return self.a_final
+
+    def cancel(self):
+        """
+        Drop the action without writing to the env, e.g. the rollout stops before the step it was submitted for.
+        """
+        if self.future is not None:
+            self.future.cancel()
+            self.pool.release(env=self.env)
+            self.future = None
+
+class ControllerPool:
+    """
+    Request/future API of the controller. submit(a_rl, env) reads the CBF inputs from the env and sends the solve to a worker, the caller
+    can do other work (e.g. store the previous transition, step another env) before ControllerFuture.result().
+    num_workers: 0 runs the controller inline at submit(), as RL_withController.
+    backend: 'process' (solves run in parallel with the torch work) or 'thread' (no start-up cost, limited by the GIL).
+    Each env is bound to one single-worker executor so that its solver warm start follows its days in order.
+    """
+    def __init__(self, num_workers=0, backend='process', controller=RL_withController):
+        self.num_workers = num_workers
+        self.backend = backend
+        self.controller = controller
+        self.executor_lst = []
+        for _ in range(num_workers):
+            if backend == 'process':
+                self.executor_lst.append(ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')))
+            elif backend == 'thread':
+                self.executor_lst.append(ThreadPoolExecutor(max_workers=1))
+            else:
+                raise ValueError("Unknown controller worker backend [{}], it should be in ['process', 'thread'].".format(backend))
+        self.pool_id = uuid.uuid4().hex # Keeps the solver caches of the envs of different pools apart on shared workers.
+        self.env_lst = [] # Envs seen by the pool, (pool_id, index) is the key of the env on the workers.
+        self.pending_lst = [] # True if the env has a submitted action not yet written back.
+
+    @property
+    def is_async(self):
+        return self.num_workers > 0
+
+    def get_key(self, env):
+        for key, cur_env in enumerate(self.env_lst):
+            if cur_env is env:
+                return key
+        self.env_lst.append(env)
+        self.pending_lst.append(False)
+        return len(self.env_lst) - 1
+
+    def release(self, env):
+        self.pending_lst[self.get_key(env)] = False
+
+    def submit(self, a_rl, env):
+        a_rl = np.array(a_rl)
+        if (not self.is_async) or (env.config.ctrl_mode == 'cluster'):
+            # The cluster mode runs its per-cluster solves on its own workers.
+            return ControllerFuture(pool=self, env=env, a_rl=a_rl, a_final=self.controller(a_rl=a_rl, env=env))
+        key = self.get_key(env)
+        # The inputs of the next day depend on the written-back result of the previous one.
+        assert not self.pending_lst[key], "The env already has a pending controller action."
+        ctx = prepare_cbf(env=env, a_rl=a_rl, pred_dict=get_pred_dict(env=env))
+        future = self.executor_lst[key % self.num_workers].submit(solve_cbf_job, (self.pool_id, key), ctx)
+        self.pending_lst[key] = True
+        return ControllerFuture(pool=self, env=env, a_rl=a_rl, ctx=ctx, future=future)
+
+    def shutdown(self):
+        for executor in self.executor_lst:
+            executor.shutdown(wait=True)
+        self.executor_lst = []
+        if self.backend == 'thread':
+            # The caches of the thread workers live in this process.
+            for key in [key for key in _solver_cache_dict.keys() if key[0] == self.pool_id]:
+                del _solver_cache_dict[key]
+        self.num_workers = 0
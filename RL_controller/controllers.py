@@ -13,7 +13,11 @@ import numpy as np
 import pandas as pd
 import time
 import cvxpy as cp
-from scipy.linalg import sqrtm
+from .price_pred import gen_price_pred_table
+from .cov_estimator import gen_cov_table
+from .solver_tuner import CbfSolverTuner, split_backend_name
+from .cluster_solver import gen_asset_clusters, alloc_clusters, solve_cluster_job, get_cluster_executor
+from .cbf_solver import CbfSocpProblem, CbfFactorSocpProblem, CbfConeQpProblem, CbfProjectionSolver, CbfBatchProjectionSolver, CovFactor, FactorRiskModel, MinRiskFrontier, min_risk_portfolio, blend_into_cone, cov_sqrt_factor
 import scipy.stats as spstats
 def RL_withoutController(a_rl, env=None):
     a_cbf = np.array([0]*env.stock_num)
@@ -23,15 +27,47 @@ def RL_withoutController(a_rl, env=None):
     a_final = a_rl + a_cbf
     return a_final
 
-def RL_withController(a_rl, env=None):
+def RL_withController(a_rl, env=None, time_budget=None):
+    """
+    time_budget: seconds of the CBF solve, overrides config.ctrl_time_budget (0: no limit). When it runs out, a fallback action is returned (solvable_flag 2).
+    With config.ctrl_mode 'cluster', the CBF problem is decomposed by cluster_cbf_opt (no time budget).
+    """
     a_rl = np.array(a_rl)
     env.action_rl_memory.append(a_rl)
-    if env.config.pricePredModel == 'MA':
-        pred_prices_change = get_pred_price_change(env=env)
-        pred_dict = {'shortterm': pred_prices_change}
+    pred_dict = get_pred_dict(env=env)
+    if env.config.ctrl_mode == 'cluster':
+        a_cbf, is_solvable_status = cluster_cbf_opt(env=env, a_rl=a_rl, pred_dict=pred_dict)
     else:
-        raise ValueError("Cannot find the price prediction model [{}]..".format(env.config.pricePredModel))
-    a_cbf, is_solvable_status = cbf_opt(env=env, a_rl=a_rl, pred_dict=pred_dict) 
+        a_cbf, is_solvable_status = cbf_opt(env=env, a_rl=a_rl, pred_dict=pred_dict, time_budget=time_budget)
+    return combine_actions(env=env, a_rl=a_rl, a_cbf=a_cbf, is_solvable_status=is_solvable_status)
+
+def RL_withController_batch(a_rl_batch, envs, batch_solver=None):
+    """
+    Controller of B envs in one call. a_rl_batch: (B, N), envs: B trading envs with the same number of assets.
+    The CBF inputs are read from each env, the B projections (with the adaptive risk relaxation) are solved together by CbfBatchProjectionSolver,
+    and the results are written back to each env. Returns the final actions, (B, N).
+    """
+    a_rl_batch = np.array(a_rl_batch)
+    ctx_lst = []
+    for env, a_rl in zip(envs, a_rl_batch):
+        env.action_rl_memory.append(a_rl)
+        ctx = prepare_cbf(env=env, a_rl=a_rl, pred_dict=get_pred_dict(env=env))
+        ctx['fidelity'], ctx['is_audit'] = 'exact', False # The batch solver is exact.
+        ctx_lst.append(ctx)
+    if batch_solver is None:
+        batch_solver = CbfBatchProjectionSolver(stock_num=envs[0].stock_num)
+    start_time = time.perf_counter()
+    res_lst = solve_cbf_batch(ctx_lst=ctx_lst, batch_solver=batch_solver)
+    solve_time = (time.perf_counter() - start_time) / len(envs) # Share of the batch per env
+    for res in res_lst:
+        res['solve_time'] = solve_time
+    a_final_lst = []
+    for env, a_rl, ctx, res in zip(envs, a_rl_batch, ctx_lst, res_lst):
+        a_cbf, is_solvable_status = commit_cbf(env=env, ctx=ctx, res=res)
+        a_final_lst.append(combine_actions(env=env, a_rl=a_rl, a_cbf=a_cbf, is_solvable_status=is_solvable_status))
+    return np.array(a_final_lst)
+
+def combine_actions(env, a_rl, a_cbf, is_solvable_status):
     cur_dcm_weight= 1.0 
     cur_rl_weight = 1.0
     if is_solvable_status:   
@@ -44,16 +80,54 @@ def RL_withController(a_rl, env=None):
         a_final = a_rl
     return a_final
 
+def get_pred_dict(env):
+    pred_prices_change = get_pred_price_change(env=env)
+    pred_dict = {'shortterm': pred_prices_change}
+    return pred_dict
+
 def get_pred_price_change(env):
-    ma_lst = env.ctl_state['MA-{}'.format(env.config.otherRef_indicator_ma_window)]
-    pred_prices = ma_lst
-    cur_close_price = np.array(env.curData['close'].values)
-    pred_prices_change = (pred_prices - cur_close_price) / cur_close_price 
-    return pred_prices_change
+    return get_price_pred_table(env=env)[env.curTradeDay]
 
-def cbf_opt(env, a_rl, pred_dict):
+def get_price_pred_table(env):
+    """
+    (days, num_of_stocks) predicted price changes of the split of the env by config.pricePredModel, precomputed on the first call.
+    """
+    if env.price_pred_table is None:
+        env.price_pred_table = gen_price_pred_table(model_name=env.config.pricePredModel, rawdata=env.rawdata, extra_data=env.extra_data, config=env.config)
+    return env.price_pred_table
+
+FIDELITY_CODE_DICT = {'exact': 0, 'approx': 1, 'cluster': 2} # Codes of the solver telemetry
+
+ARS_STEP_ADD_LST = [0.002, 0.002, 0.002, 0.002, 0.002, 0.005, 0.005, 0.005, 0.005, 0.005] # Risk relaxation of each ARS trial
+
+def cbf_opt(env, a_rl, pred_dict, time_budget=None):
     """
     The risk constraint is based on controller barrier function (CBF) method. Not just considering the satisfaction of the current risk constraint, but also considering the trends/gradients of the future risk. 
+    Split into prepare_cbf (read the env), solve_cbf (the optimisation with the adaptive risk relaxation), and commit_cbf (write back to the env).
+    """
+    ctx = prepare_cbf(env=env, a_rl=a_rl, pred_dict=pred_dict)
+    if time_budget is not None:
+        ctx['time_budget'] = time_budget
+    start_time = time.perf_counter()
+    res = solve_cbf(env=env, ctx=ctx)
+    res['solve_time'] = time.perf_counter() - start_time
+    audit_cbf(env=env, ctx=ctx, res=res)
+    return commit_cbf(env=env, ctx=ctx, res=res)
+
+def cluster_cbf_opt(env, a_rl, pred_dict):
+    """
+    Hierarchical alternative to cbf_opt for very large portfolios, the same inputs (prepare_cbf) and write-back (commit_cbf) with solve_cbf_cluster.
+    """
+    ctx = prepare_cbf(env=env, a_rl=a_rl, pred_dict=pred_dict)
+    start_time = time.perf_counter()
+    res = solve_cbf_cluster(env=env, ctx=ctx)
+    res['solve_time'] = time.perf_counter() - start_time
+    audit_cbf(env=env, ctx=ctx, res=res)
+    return commit_cbf(env=env, ctx=ctx, res=res)
+
+def prepare_cbf(env, a_rl, pred_dict):
+    """
+    Collect the inputs of the CBF problem of the current day from the env, without modifying it.
     """
     pred_prices_change = pred_dict['shortterm']
 
@@ -63,9 +137,7 @@ def cbf_opt(env, a_rl, pred_dict):
     # Past N days daily return rate of each stock, (num_of_stocks, lookback_days), [[t-N+1, t-N+2, .., t-1, t]]
     daily_return_ay = env.ctl_state['DAILYRETURNS-{}'.format(env.config.dailyRetun_lookback)]
     
-    cov_r_t0 = np.cov(daily_return_ay)
-    if np.isscalar(cov_r_t0):
-        cov_r_t0 = np.array([[cov_r_t0]], dtype=float)
+    cov_r_t0 = env.get_cur_cov() # Covariance of the window by config.cov_estimator, the same as the env.
     w_t0 = np.array([env.actions_memory[-1]])
     try:
         risk_stg_t0 = np.sqrt(np.matmul(np.matmul(w_t0, cov_r_t0), w_t0.T)[0][0])
@@ -85,165 +157,504 @@ def cbf_opt(env, a_rl, pred_dict):
     risk_market_t1 = env.config.risk_market  
     risk_safe_t1 = env.risk_adj_lst[-1] 
 
-    pred_prices_change_reshape = np.reshape(pred_prices_change, (-1, 1))
-    r_t1 = np.append(daily_return_ay[:, 1:], pred_prices_change_reshape, axis=1)
-
-    cov_r_t1 = np.cov(r_t1)
-    if np.isscalar(cov_r_t1):
-        cov_r_t1 = np.array([[cov_r_t1]], dtype=float)
-    cov_sqrt_t1 = sqrtm(cov_r_t1)
-    cov_sqrt_t1 = cov_sqrt_t1.real
-    G_ay = np.array([]).reshape(-1, N)
-
-    h_0 = np.array([])
-    
-    use_cvxopt_threshold = 0 # prefer cvxpy path by default to avoid cvxopt dependency
-    w_lb = 0
-    w_ub = 1
-
-    if env.config.topK <= use_cvxopt_threshold:
-        # Implemented by cvxopt
-        from cvxopt import matrix, solvers
-        solvers.options['show_progress'] = False
-        A_eq = np.array([]).reshape(-1, N)
-        linear_g1 = np.array([[1.0] * N]) # (1, N)
-        A_eq = np.append(A_eq, linear_g1, axis=0)
-        A_eq = matrix(A_eq)
-        b_eq = np.array([0.0])
-        b_eq = matrix(b_eq)
-
-        h_0 = np.append(h_0, a_rl, axis=0) # linear_h3, 0 <= (a_RL + a_cbf)
-        h_0 = np.append(h_0, 1-a_rl, axis=0) # linear_h4 (a_RL + a_cbf) <= 1
-
-        linear_g3 = np.diag([-1.0] * N)
-        G_ay = np.append(G_ay, linear_g3, axis=0) # 0 <= (a_RL + a_cbf)
-        linear_g4 = np.diag([1.0] * N) 
-        G_ay = np.append(G_ay, linear_g4, axis=0) # (a_RL + a_cbf) <= 1
-    
+    if is_factor_risk_model(env=env):
+        # Low-rank-plus-diagonal model of the day, (L, d). The dense covariance is only used to measure the risk of the solution.
+        risk_factor = get_factor_risk_model(env=env).factors(day=env.curTradeDay, pred_returns=pred_prices_change)
+        cov_r_t1 = FactorRiskModel.dense_cov(*risk_factor)
     else:
-        a_rl_re_sign = np.reshape(a_rl, (-1, 1))
-        sign_mul = np.ones((1, N))
-        w_lb_sign = w_lb
-        w_ub_sign = w_ub
-        
+        risk_factor = None
+        cov_r_t1 = get_cov_t1(env=env, daily_return_ay=daily_return_ay, pred_prices_change=pred_prices_change)
+
     last_h_risk = (-risk_market_t0 - risk_stg_t0 + risk_safe_t0)
     last_h_risk = np.max([last_h_risk, 0.0])
     socp_d = -risk_market_t1 + risk_safe_t1 + (gamma - 1) * last_h_risk
 
-    step_add_lst = [0.002, 0.002, 0.002, 0.002, 0.002, 0.005, 0.005, 0.005, 0.005, 0.005]
-    cnt = 1
     if env.config.is_enable_dynamic_risk_bound:
         cnt_th = env.config.ars_trial # Iterative risk relaxation
     else:
         cnt_th = 1 
 
-    if env.config.topK <= use_cvxopt_threshold:
-        # Implemented by cvxopt
-        socp_b = np.matmul(cov_sqrt_t1, a_rl)
-        h = np.append(h_0, [socp_d], axis=0) # socp_d
-        h = np.append(h, socp_b, axis=0) # socp_b
-        h = matrix(h)
-        socp_cx = np.array([[0.0] * N])
-        G_ay = np.append(G_ay, -socp_cx, axis=0)
-        G_ay = np.append(G_ay, -cov_sqrt_t1, axis=0) # socp_ax
-        G = matrix(G_ay) # G = matrix(np.transpose(np.transpose(G_ay)))
-
-        linear_eq_num = 2*N
-        dims = {'l': linear_eq_num, 'q': [N+1], 's': []}
-        QP_P = matrix(np.eye(N)) * 2 # (1/2) xP'x
-        QP_Q = matrix(np.zeros((N, 1))) # q'x
-        while cnt <= cnt_th:
-            try:
-                sol = solvers.coneqp(QP_P, QP_Q, G, h, dims, A_eq, b_eq)
-                if sol['status'] == 'optimal':
-                    solver_flag = True
-                    break
-                else:
-                    raise
-            except:
-                solver_flag = False
-                cnt += 1
-                risk_safe_t1 = risk_safe_t1 + step_add_lst[cnt-2]
-                socp_d = -risk_market_t1 + risk_safe_t1 + (gamma - 1) * (-risk_market_t0 - risk_stg_t0 + risk_safe_t0)
-                h = np.append(h_0, [socp_d], axis=0) # socp_d
-                h = np.append(h, socp_b, axis=0) # socp_b 
-                h = matrix(h)
+    is_cluster = (env.config.ctrl_mode == 'cluster')
+    # Bounds of the minimum achievable risk of the day, bounds below risk_lb are infeasible and bounds above risk_ub are feasible.
+    # They hold for the monolithic problem on the sample covariance only, not for the other estimators, the factor risk model or the cluster decomposition.
+    if env.config.cbf_precheck and (env.config.cov_estimator == 'sample') and (risk_factor is None) and (not is_cluster):
+        risk_lb, risk_ub = get_min_risk_frontier(env=env).bounds(day=env.curTradeDay, pred_returns=pred_prices_change)
+    else:
+        risk_lb, risk_ub = 0.0, np.inf
 
+    # Fidelity: the approximate projection is only used in the training env, valid/test and serving are always exact.
+    # A sampled share of the approximate (factor-model or cluster) days is also solved by the dense projection for the audit of the deviation.
+    if is_cluster:
+        fidelity = 'cluster'
+    elif (env.config.ctrl_fidelity == 'train_approx') and (env.mode == 'train') and (risk_factor is None):
+        fidelity = 'approx'
+    else:
+        fidelity = 'exact'
+    if (fidelity != 'exact') or (risk_factor is not None):
+        is_audit = bool(env.ctrl_audit_rng.random() < env.config.ctrl_audit_rate)
+    else:
+        is_audit = False
+
+    use_cvxopt_threshold = 0 # Portfolios with topK <= use_cvxopt_threshold are always solved by cvxopt
+    if is_cluster:
+        cbf_solver = 'projection' # Per cluster
+    elif risk_factor is not None:
+        cbf_solver = 'cvxpy' # CbfFactorSocpProblem
+    elif fidelity == 'approx':
+        cbf_solver = 'projection'
+    elif env.config.topK <= use_cvxopt_threshold:
+        cbf_solver = 'cvxopt'
+    else:
+        cbf_solver = get_cbf_solver(env=env)
+
+    ctx = {
+        'N': N, 'cbf_solver': cbf_solver, 'cvxpy_solver': env.cbf_cvxpy_solver if env.cbf_cvxpy_solver is not None else env.config.cbf_cvxpy_solver, 'a_rl': a_rl, 'daily_return_ay': daily_return_ay, 'pred_prices_change': pred_prices_change, 'cov_r_t1': cov_r_t1,
+        'risk_stg_t0': risk_stg_t0, 'risk_market_t0': risk_market_t0, 'risk_safe_t0': risk_safe_t0,
+        'risk_market_t1': risk_market_t1, 'risk_safe_t1': risk_safe_t1, 'gamma': gamma, 'last_h_risk': last_h_risk,
+        'socp_d': socp_d, 'cnt_th': cnt_th, 'ars_mode': env.config.ars_mode, 'risk_lb': risk_lb, 'risk_ub': risk_ub,
+        'time_budget': env.config.ctrl_time_budget, 'fidelity': fidelity, 'is_audit': is_audit,
+        'approx_tol': env.config.ctrl_approx_tol, 'approx_iter': env.config.ctrl_approx_iter, 'risk_factor': risk_factor, 'cov_estimator': env.config.cov_estimator,
+    }
+    return ctx
+
+def get_cov_t1_table(env):
+    """
+    (days, num_of_stocks, num_of_stocks) cov_r_t1 of the split by config.cov_estimator: the DAILYRETURNS window of each day shifted by the prediction
+    of the price prediction table, [[t-N+2, .., t, pred]]. Estimated at once on the first call.
+    """
+    if env.cov_t1_table is None:
+        windows = env.get_daily_return_windows()
+        pred_table = get_price_pred_table(env=env)
+        env.cov_t1_table = gen_cov_table(estimator_name=env.config.cov_estimator, windows=np.append(windows[:, :, 1:], pred_table[:, :, None], axis=2))
+    return env.cov_t1_table
+
+def get_cov_t1(env, daily_return_ay, pred_prices_change):
+    """
+    cov_r_t1 of the current day: from get_cov_t1_table if the prediction is the one of the price prediction table, otherwise estimated for the day.
+    """
+    if np.array_equal(pred_prices_change, get_price_pred_table(env=env)[env.curTradeDay]):
+        return get_cov_t1_table(env=env)[env.curTradeDay]
+    r_t1 = np.append(daily_return_ay[:, 1:], np.reshape(pred_prices_change, (-1, 1)), axis=1)
+    return gen_cov_table(estimator_name=env.config.cov_estimator, windows=r_t1[None])[0]
+
+def is_factor_risk_model(env):
+    # The factor risk model replaces the dense covariance for large universes, see config.ctrl_risk_model.
+    if env.config.ctrl_risk_model == 'auto':
+        return env.stock_num >= env.config.risk_factor_min_stocks
+    return env.config.ctrl_risk_model == 'factor'
+
+def get_factor_risk_model(env):
+    """
+    FactorRiskModel of the split of the env, estimated from the DAILYRETURNS windows of all trading days on the first call.
+    """
+    if env.factor_risk_model is None:
+        col = 'DAILYRETURNS-{}'.format(env.config.dailyRetun_lookback)
+        daily_return_lst = np.array(list(env.rawdata[col].values), dtype=float)
+        daily_return_lst = np.reshape(daily_return_lst, (env.totalTradeDay, env.stock_num, -1))
+        env.factor_risk_model = FactorRiskModel(daily_return_lst=daily_return_lst, num_factors=env.config.risk_factor_num)
+        print("Factor risk model of {} assets: {} factors, explained variance {:.2%} (mean of the days)".format(env.stock_num, env.factor_risk_model.num_factors, np.mean(env.factor_risk_model.explained)))
+    return env.factor_risk_model
+
+def get_cbf_solver(env):
+    """
+    Backend of the CBF problem: config.cbf_solver, or with 'auto' the backend selected by CbfSolverTuner on the first call
+    (env.cbf_cvxpy_solver is then the selected cvxpy solver, if any).
+    """
+    if env.config.cbf_solver != 'auto':
+        return env.config.cbf_solver
+    if env.cbf_solver_tuned is None:
+        tuner = CbfSolverTuner(cache_path=env.config.cbf_tune_cache, fallback_solver=env.config.cbf_cvxpy_solver)
+        backend = tuner.lookup(stock_num=env.stock_num)
+        if backend is None:
+            backend = tuner.select(stock_num=env.stock_num, instance_lst=gen_cbf_instances(env=env, num_instances=env.config.cbf_tune_instances))
+        env.cbf_solver_tuned, env.cbf_cvxpy_solver = split_backend_name(backend)
+        print("CBF solver of {} assets: {}".format(env.stock_num, backend))
+    return env.cbf_solver_tuned
+
+def gen_cbf_instances(env, num_instances, seed=0):
+    """
+    Sample CBF instances from the split of the env: cov_r_t1 of random days (with the price prediction of the day),
+    random Dirichlet actions and the risk bounds of the market observer.
+    """
+    rng = np.random.default_rng(seed)
+    daily_return_lst = env.get_daily_return_windows()
+    pred_table = get_price_pred_table(env=env)
+    cov_table = get_cov_t1_table(env=env)
+    risk_bound_lst = np.array([env.config.risk_up_bound, env.config.risk_hold_bound, env.config.risk_down_bound, env.config.risk_default]) - env.config.risk_market
+    day_lst = np.sort(rng.choice(env.totalTradeDay, size=min(num_instances, env.totalTradeDay), replace=False))
+    instance_lst = []
+    for day in day_lst:
+        instance = {'a_rl': rng.dirichlet(np.ones(env.stock_num) * 0.5), 'hist_returns': daily_return_lst[day], 'pred_returns': pred_table[day],
+                    'cov': cov_table[day], 'socp_d': rng.choice(risk_bound_lst)}
+        if env.config.cov_estimator != 'sample':
+            instance['cov_sqrt'] = cov_sqrt_factor(cov_table[day]) # The rolling factor of the window only holds for the sample covariance.
+        instance_lst.append(instance)
+    return instance_lst
+
+def get_min_risk_frontier(env):
+    """
+    MinRiskFrontier of the split of the env, precomputed from the DAILYRETURNS windows of all trading days on the first call.
+    """
+    if env.min_risk_frontier is None:
+        col = 'DAILYRETURNS-{}'.format(env.config.dailyRetun_lookback)
+        # rawdata is sorted by date and stock, every trading day has stock_num rows.
+        daily_return_lst = np.array(list(env.rawdata[col].values), dtype=float)
+        daily_return_lst = np.reshape(daily_return_lst, (env.totalTradeDay, env.stock_num, -1))
+        env.min_risk_frontier = MinRiskFrontier(daily_return_lst=daily_return_lst)
+    return env.min_risk_frontier
+
+def is_hopeless_bound(ctx, socp_d):
+    # The bound is below the certified minimum achievable risk of the day.
+    return socp_d < ctx['risk_lb'] * (1 - 1e-6)
+
+def relax_risk_bound(ctx, risk_safe_t1, cnt):
+    """
+    Risk bound of the ARS trial cnt (cnt >= 2). Returns (risk_safe_t1, socp_d).
+    """
+    risk_safe_t1 = risk_safe_t1 + ARS_STEP_ADD_LST[cnt-2]
+    socp_d = -ctx['risk_market_t1'] + risk_safe_t1 + (ctx['gamma'] - 1) * ctx['last_h_risk']
+    return risk_safe_t1, socp_d
+
+def min_feasible_risk_bound(ctx, risk_min):
+    """
+    ARS by the minimum achievable risk (ars_mode 'minrisk'): the smallest relaxed bound socp_d >= risk_min of the day, so that the
+    minimum-variance portfolio is feasible, within the total relaxation of the schedule.
+    Returns (cnt, risk_safe_t1, socp_d). If the bound exceeds the budget, cnt = cnt_th + 1 and the bound is the one of the exhausted schedule.
+    """
+    cnt_th = ctx['cnt_th']
+    socp_d = risk_min * (1 + 1e-6) # Margin for the round-off of the solver at the boundary.
+    risk_safe_t1 = socp_d + ctx['risk_market_t1'] - (ctx['gamma'] - 1) * ctx['last_h_risk']
+    if risk_safe_t1 <= ctx['risk_safe_t1'] + np.sum(ARS_STEP_ADD_LST[:cnt_th-1]):
+        return 2, risk_safe_t1, socp_d
+    risk_safe_t1 = ctx['risk_safe_t1'] + np.sum(ARS_STEP_ADD_LST[:cnt_th])
+    socp_d = -ctx['risk_market_t1'] + risk_safe_t1 + (ctx['gamma'] - 1) * ctx['last_h_risk']
+    return cnt_th + 1, risk_safe_t1, socp_d
+
+def solve_cbf(env, ctx):
+    """
+    Solve the CBF problem with the adaptive risk relaxation. The env only provides its cached solvers.
+    Returns {'solver_flag', 'a_cbf', 'risk_safe_t1', 'socp_d', 'cnt', 'solve_cnt', 'solve_iters'}.
+    """
+    N = ctx['N']
+    a_rl = ctx['a_rl']
+    cov_r_t1 = ctx['cov_r_t1']
+    risk_safe_t1 = ctx['risk_safe_t1']
+    socp_d = ctx['socp_d']
+    cnt_th = ctx['cnt_th']
+    cnt = 1
+    solve_cnt = 0
+    solve_iters = 0
+
+    # Complete solver
+    cbf_solver = ctx['cbf_solver']
+    if cbf_solver == 'projection':
+        # ++ Exact projection solver on cov_r_t1, no modelling layer and no matrix square root. It is kept per env and warm-started from the previous day.
+        proj_solver = get_proj_solver(env=env, ctx=ctx)
+    cbf_problem = None
+    # Time budget: a trial is not started if the previous one would not fit in the remaining time, the projection solver also stops at the deadline.
+    deadline = (time.perf_counter() + ctx['time_budget']) if ctx['time_budget'] > 0 else None
+    trial_time = 0.0
+    is_timeout = False
+    a_cbf_feasible = None
+    while cnt <= cnt_th:
+        trial_start_time = time.perf_counter()
+        if (deadline is not None) and (cnt > 1) and (trial_start_time + trial_time > deadline):
+            is_timeout = True
+            break
+        if is_hopeless_bound(ctx=ctx, socp_d=socp_d):
+            # Infeasible without solving.
+            proj_status, cp_x_value = 'infeasible', None
+            if cbf_solver == 'projection':
+                proj_solver.last_min_risk = None
+        elif cbf_solver == 'projection':
+            proj_status, cp_x_value = proj_solver.solve(a_rl=a_rl, cov=cov_r_t1, socp_d=socp_d, is_feasible=(socp_d >= ctx['risk_ub']), deadline=deadline)
+            solve_cnt = solve_cnt + 1
+            solve_iters = solve_iters + proj_solver.last_iters
+            if proj_status == 'timeout':
+                is_timeout = True
+                a_cbf_feasible = cp_x_value
+                break
+        else:
+            proj_status = 'numerical'
+        if proj_status == 'numerical':
+            # ++ Implemented by cvxpy (or cvxopt), the problem is built once per env and only its data are updated.
+            if (cbf_problem is None) and (ctx['risk_factor'] is not None):
+                cbf_problem = get_cbf_factor_problem(env=env, a_rl=a_rl, risk_factor=ctx['risk_factor'], cvxpy_solver=ctx['cvxpy_solver'])
+            elif cbf_problem is None:
+                if ctx['cov_estimator'] == 'sample':
+                    cov_sqrt_t1 = get_cov_factor(env=env, daily_return_ay=ctx['daily_return_ay'], pred_prices_change=ctx['pred_prices_change'])
+                else:
+                    cov_sqrt_t1 = cov_sqrt_factor(cov_r_t1)
+                cbf_problem = get_cbf_socp_problem(env=env, a_rl=a_rl, cov_sqrt_t1=cov_sqrt_t1,
+                                                   backend='cvxopt' if cbf_solver == 'cvxopt' else 'cvxpy', cvxpy_solver=ctx['cvxpy_solver'])
+            solver_flag, cp_x_value = cbf_problem.solve(socp_d=socp_d)
+            solve_cnt = solve_cnt + 1
+            solve_iters = solve_iters + cbf_problem.last_iters
+        else:
+            solver_flag = (proj_status == 'optimal')
         if solver_flag:
-            if sol['status'] == 'optimal':
-                a_cbf = np.reshape(np.array(sol['x']), -1)
-                env.solver_stat['solvable'] = env.solver_stat['solvable'] + 1
-                is_solvable_status = True
-                env.risk_adj_lst[-1] = risk_safe_t1
-                # Check the solution whether satisfy the risk constraint.
-                cur_alpha_risk = np.sqrt(np.matmul(np.matmul((a_rl+a_cbf), cov_r_t1), (a_rl+a_cbf).T))
-                assert (cur_alpha_risk - socp_d) <= 0.00001, 'cur risk: {}, socp_d {}'.format(cur_alpha_risk, socp_d)
-                assert np.abs(np.sum(np.abs((a_rl+a_cbf))) - 1) <= 0.00001, 'sum of actions: {} \n{} \n{}'.format(np.sum(np.abs((a_rl+a_cbf))), a_rl, a_cbf)
-                env.solvable_flag.append(0)
+            break
+        if (ctx['ars_mode'] == 'minrisk') and (cnt == 1) and (cnt_th > 1):
+            if (cbf_solver == 'projection') and (proj_solver.last_min_risk is not None):
+                risk_min = proj_solver.last_min_risk
             else:
-                a_cbf = np.zeros(N)
-                env.solver_stat['insolvable'] = env.solver_stat['insolvable'] + 1
-                is_solvable_status = False
-                cur_alpha_risk = np.sqrt(np.matmul(np.matmul((a_rl), cov_r_t1), (a_rl).T)) 
-                env.solvable_flag.append(1)           
+                risk_min = min_risk_portfolio(cov_r_t1)[2]
+            cnt, risk_safe_t1, socp_d = min_feasible_risk_bound(ctx=ctx, risk_min=risk_min)
+            continue
+        cnt += 1
+        risk_safe_t1, socp_d = relax_risk_bound(ctx=ctx, risk_safe_t1=risk_safe_t1, cnt=cnt)
+        trial_time = time.perf_counter() - trial_start_time
+
+    if is_timeout:
+        a_cbf, risk_safe_t1, socp_d, cnt = fallback_cbf(env=env, ctx=ctx, a_cbf=a_cbf_feasible, risk_safe_t1=risk_safe_t1, socp_d=socp_d, cnt=cnt)
+        return {'solver_flag': a_cbf is not None, 'is_fallback': a_cbf is not None, 'a_cbf': a_cbf, 'risk_safe_t1': risk_safe_t1, 'socp_d': socp_d, 'cnt': cnt,
+                'solve_cnt': solve_cnt, 'solve_iters': solve_iters}
+    return {'solver_flag': solver_flag, 'is_fallback': False, 'a_cbf': cp_x_value if solver_flag else None, 'risk_safe_t1': risk_safe_t1, 'socp_d': socp_d, 'cnt': cnt,
+            'solve_cnt': solve_cnt, 'solve_iters': solve_iters}
+
+def get_proj_solver(env, ctx):
+    """
+    The projection solver of the fidelity of ctx, kept per env: env.cbf_proj_solver (exact) or env.cbf_approx_solver (approximate).
+    """
+    N = ctx['N']
+    if ctx['fidelity'] == 'approx':
+        if (env.cbf_approx_solver is None) or (env.cbf_approx_solver.stock_num != N):
+            env.cbf_approx_solver = CbfProjectionSolver(stock_num=N, max_mu_iter=ctx['approx_iter'], approx=True, approx_tol=ctx['approx_tol'])
+        return env.cbf_approx_solver
+    if (env.cbf_proj_solver is None) or (env.cbf_proj_solver.stock_num != N):
+        env.cbf_proj_solver = CbfProjectionSolver(stock_num=N)
+    return env.cbf_proj_solver
+
+def audit_cbf(env, ctx, res):
+    """
+    Audit of the approximate controller, or cross-check of the factor risk model or the cluster decomposition, on the sampled days (ctx['is_audit']): solve the final bound
+    of res with the exact dense projection on cov_r_t1 by a separate cold solver, so that neither the timing nor the warm start of the controller
+    is affected. Adds res['audit_deviation'] (max |a_cbf - exact a_cbf|) and res['audit_gap'] (relative excess of ||a_cbf||^2 over the exact
+    projection), NaN if not audited or not comparable.
+    """
+    res['audit_deviation'], res['audit_gap'] = np.nan, np.nan
+    if (not ctx['is_audit']) or (not res['solver_flag']):
+        return res
+    N = ctx['N']
+    if (env.cbf_audit_solver is None) or (env.cbf_audit_solver.stock_num != N):
+        env.cbf_audit_solver = CbfProjectionSolver(stock_num=N, warm_start=False)
+    status, a_cbf_exact = env.cbf_audit_solver.solve(a_rl=ctx['a_rl'], cov=ctx['cov_r_t1'], socp_d=res['socp_d'])
+    if status == 'optimal':
+        dist_exact = np.sum(a_cbf_exact**2)
+        res['audit_deviation'] = float(np.max(np.abs(res['a_cbf'] - a_cbf_exact)))
+        res['audit_gap'] = float((np.sum(res['a_cbf']**2) - dist_exact) / max(dist_exact, 1e-12))
+    return res
+
+def fallback_cbf(env, ctx, a_cbf, risk_safe_t1, socp_d, cnt):
+    """
+    Action of a solve stopped by the time budget: the feasible point found by the solver, or a_rl moved toward the minimum-variance
+    portfolio (closed form, blend_into_cone) until the cone of the current bound is satisfied. If the minimum-variance portfolio is outside
+    that cone, the bound is relaxed as in ars_mode 'minrisk' within the budget of the schedule.
+    Returns (a_cbf, risk_safe_t1, socp_d, cnt), a_cbf is None if no fallback satisfies the relaxed bound.
+    """
+    if a_cbf is not None:
+        return a_cbf, risk_safe_t1, socp_d, cnt
+    a_rl = ctx['a_rl']
+    cov_r_t1 = ctx['cov_r_t1']
+    N = ctx['N']
+    # Cheapest minimum-variance candidates: the last one of the projection solver (previous day), or the equal weights.
+    anchor_lst = [np.ones(N) / N]
+    proj_solver = env.cbf_approx_solver if ctx['fidelity'] == 'approx' else env.cbf_proj_solver
+    if (proj_solver is not None) and (proj_solver.warm_w_mv is not None) and (len(proj_solver.warm_w_mv) == N):
+        anchor_lst.append(proj_solver.warm_w_mv)
+    risk_lst = [np.sqrt(max(np.matmul(np.matmul(w, cov_r_t1), w), 0.0)) for w in anchor_lst]
+    w_anchor, risk_anchor = anchor_lst[int(np.argmin(risk_lst))], np.min(risk_lst)
+    if risk_anchor > socp_d:
+        cnt, risk_safe_t1, socp_d = min_feasible_risk_bound(ctx=ctx, risk_min=risk_anchor)
+        if cnt > ctx['cnt_th']:
+            return None, risk_safe_t1, socp_d, cnt
+    theta = blend_into_cone(a_rl=a_rl, w_anchor=w_anchor, cov=cov_r_t1, socp_d=socp_d)
+    return theta * (w_anchor - a_rl), risk_safe_t1, socp_d, cnt
+
+def get_asset_clusters(env):
+    """
+    Clusters of the assets of the split of the env, computed on the first call: by the 'sector' column of the data if any, otherwise by the
+    correlation of the daily returns of the whole split. config.ctrl_cluster_num clusters, 0: round(sqrt(N)).
+    """
+    if env.asset_clusters is None:
+        data = env.rawdata.sort_values(['date', 'stock'], ascending=True)
+        if 'sector' in data.columns:
+            labels = data[data['date'] == data['date'].iloc[0]]['sector'].values
+            env.asset_clusters = gen_asset_clusters(returns=None, num_clusters=0, labels=labels)
         else:
-            a_cbf = np.zeros(N)
-            env.solver_stat['insolvable'] = env.solver_stat['insolvable'] + 1
-            is_solvable_status = False
-            cur_alpha_risk = np.sqrt(np.matmul(np.matmul((a_rl), cov_r_t1), (a_rl).T))
-            env.solvable_flag.append(1)
-            # print("Failed to solve the problem.")
+            col = 'DAILYRETURNS-{}'.format(env.config.dailyRetun_lookback)
+            daily_return_lst = np.reshape(np.array(list(data[col].values), dtype=float), (env.totalTradeDay, env.stock_num, -1))
+            num_clusters = env.config.ctrl_cluster_num if env.config.ctrl_cluster_num > 0 else int(round(np.sqrt(env.stock_num)))
+            env.asset_clusters = gen_asset_clusters(returns=daily_return_lst[:, :, -1], num_clusters=num_clusters)
+        print("Asset clusters of the controller: {} clusters, sizes {}".format(len(env.asset_clusters), [len(idx) for idx in env.asset_clusters]))
+    return env.asset_clusters
 
-    else:
-        # Complete solver
-        # ++ Implemented by cvxpy
-        cp_x = cp.Variable((N, 1))
-        a_rl_re = np.reshape(a_rl, (-1, 1))
-        cp_constraint = []
-        cp_constraint.append(cp.sum(sign_mul@cp_x) + cp.sum(a_rl_re_sign) == 1)
-        cp_constraint.append(a_rl_re + cp_x >= w_lb_sign) 
-        cp_constraint.append(a_rl_re + cp_x <= w_ub_sign) 
-        cp_constraint.append(cp.SOC(socp_d, cov_sqrt_t1 @ (a_rl_re + cp_x))) 
-        # cvxpy
-        while cnt <= cnt_th:
-            try:
-                obj_f2 = cp.sum_squares(cp_x)
-                cp_obj = cp.Minimize(obj_f2)
-                cp_prob = cp.Problem(cp_obj, cp_constraint)
-                cp_prob.solve(solver=cp.ECOS, verbose=False) 
-
-                if cp_prob.status == 'optimal':
-                    solver_flag = True
-                    break
-                else:
-                    raise
-            except:
-                solver_flag = False
-                cnt += 1
-                risk_safe_t1 = risk_safe_t1 + step_add_lst[cnt-2]
-                socp_d = -risk_market_t1 + risk_safe_t1 + (gamma - 1) * last_h_risk
-                cp_constraint[-1] = cp.SOC(socp_d, cov_sqrt_t1 @ (a_rl_re + cp_x))
-
-        if (cp_prob.status == 'optimal') and solver_flag:
-            is_solvable_status = True
-            a_cbf = np.reshape(np.array(cp_x.value), -1)
-            env.solver_stat['solvable'] = env.solver_stat['solvable'] + 1
-            # Check the solution whether satisfy the risk constraint.
-            env.risk_adj_lst[-1] = risk_safe_t1
-            cur_alpha_risk = np.sqrt(np.matmul(np.matmul((a_rl+a_cbf), cov_r_t1), (a_rl+a_cbf).T))
-            assert (cur_alpha_risk - socp_d) <= 0.00001, 'cur risk: {}, socp_d {}'.format(cur_alpha_risk, socp_d) 
-            assert np.abs(np.sum(np.abs(a_rl+a_cbf)) - 1) <= 0.00001, 'sum of actions: {} \n{} \n{}'.format(np.sum(np.abs((a_rl+a_cbf))), a_rl, a_cbf)
-            env.solvable_flag.append(0)
+def solve_cbf_cluster(env, ctx):
+    """
+    Cluster decomposition of the CBF problem with the adaptive risk relaxation. a_rl is split into the weight s_rl of each cluster and the
+    portfolio v_rl within it. Every trial corrects the portfolio of each cluster to the bound socp_d on its own block of cov_r_t1 (solve_cluster_job,
+    in parallel on the ClusterExecutor), then alloc_clusters reallocates the weight across clusters so that sum_c s_c * rho_c <= socp_d,
+    which bounds the risk of the combined portfolio. Returns the same dict as solve_cbf.
+    """
+    N = ctx['N']
+    a_rl = ctx['a_rl']
+    cov_r_t1 = ctx['cov_r_t1']
+    risk_safe_t1 = ctx['risk_safe_t1']
+    socp_d = ctx['socp_d']
+    cnt_th = ctx['cnt_th']
+    cluster_lst = get_asset_clusters(env=env)
+    executor = get_cluster_executor(num_workers=env.config.ctrl_cluster_workers)
+    s_rl = np.array([np.sum(a_rl[idx]) for idx in cluster_lst])
+    v_rl_lst = [a_rl[idx] / s_rl[c] if s_rl[c] > 1e-12 else np.ones(len(idx)) / len(idx) for c, idx in enumerate(cluster_lst)]
+    cov_lst = [cov_r_t1[np.ix_(idx, idx)] for idx in cluster_lst]
+    cnt = 1
+    solve_cnt = 0
+    solve_iters = 0
+    solver_flag = False
+    a_cbf = None
+    while cnt <= cnt_th:
+        future_lst = [executor.submit(c, solve_cluster_job, (env.ctrl_cluster_key, c), v_rl_lst[c], cov_lst[c], socp_d) for c in range(len(cluster_lst))]
+        out_lst = [future.result() for future in future_lst]
+        rho = np.array([out[1] for out in out_lst])
+        solve_cnt = solve_cnt + len(out_lst)
+        solve_iters = solve_iters + int(np.sum([out[2] for out in out_lst]))
+        s = alloc_clusters(s_rl=s_rl, rho=rho, socp_d=socp_d)
+        if s is not None:
+            w = np.zeros(N)
+            for c, idx in enumerate(cluster_lst):
+                w[idx] = s[c] * out_lst[c][0]
+            solver_flag, a_cbf = True, w - a_rl
+            break
+        if (ctx['ars_mode'] == 'minrisk') and (cnt == 1) and (cnt_th > 1):
+            cnt, risk_safe_t1, socp_d = min_feasible_risk_bound(ctx=ctx, risk_min=np.min(rho))
+            continue
+        cnt += 1
+        risk_safe_t1, socp_d = relax_risk_bound(ctx=ctx, risk_safe_t1=risk_safe_t1, cnt=cnt)
+    return {'solver_flag': solver_flag, 'is_fallback': False, 'a_cbf': a_cbf, 'risk_safe_t1': risk_safe_t1, 'socp_d': socp_d, 'cnt': cnt,
+            'solve_cnt': solve_cnt, 'solve_iters': solve_iters}
+
+def solve_cbf_batch(ctx_lst, batch_solver):
+    """
+    Batched solve_cbf: every ARS trial solves the problems of all still unsolved envs in one call of batch_solver.
+    Returns the list of results in the same format as solve_cbf.
+    """
+    B = len(ctx_lst)
+    a_rl = np.array([ctx['a_rl'] for ctx in ctx_lst]) # (B, N)
+    cov = np.array([ctx['cov_r_t1'] for ctx in ctx_lst]) # (B, N, N)
+    risk_safe_t1 = np.array([ctx['risk_safe_t1'] for ctx in ctx_lst], dtype=float)
+    socp_d = np.array([ctx['socp_d'] for ctx in ctx_lst], dtype=float)
+    cnt_th = np.array([ctx['cnt_th'] for ctx in ctx_lst])
+    cnt = np.ones(B, dtype=int)
+    solve_cnt = np.zeros(B, dtype=int)
+    solver_flag = np.zeros(B, dtype=bool)
+    a_cbf = np.zeros(a_rl.shape)
+    pending = np.arange(B)
+    while len(pending) > 0:
+        # Rows below the minimum achievable risk of their day are infeasible without solving.
+        is_hopeless = np.array([is_hopeless_bound(ctx=ctx_lst[b], socp_d=socp_d[b]) for b in pending], dtype=bool)
+        is_solved = np.zeros(len(pending), dtype=bool)
+        x = np.zeros((len(pending), a_rl.shape[1]))
+        to_solve = np.flatnonzero(~is_hopeless)
+        if len(to_solve) > 0:
+            status, x[to_solve] = batch_solver.solve(a_rl=a_rl[pending[to_solve]], cov=cov[pending[to_solve]], socp_d=socp_d[pending[to_solve]])
+            is_solved[to_solve] = (status == 'optimal')
+            solve_cnt[pending[to_solve]] = solve_cnt[pending[to_solve]] + 1
+        solver_flag[pending[is_solved]] = True
+        a_cbf[pending[is_solved]] = x[is_solved]
+        failed = pending[~is_solved]
+        for b in failed:
+            ctx = ctx_lst[b]
+            if (ctx['ars_mode'] == 'minrisk') and (cnt[b] == 1) and (cnt_th[b] > 1):
+                cnt[b], risk_safe_t1[b], socp_d[b] = min_feasible_risk_bound(ctx=ctx, risk_min=min_risk_portfolio(cov[b])[2])
+            else:
+                cnt[b] = cnt[b] + 1
+                risk_safe_t1[b], socp_d[b] = relax_risk_bound(ctx=ctx, risk_safe_t1=risk_safe_t1[b], cnt=cnt[b])
+        pending = failed[cnt[failed] <= cnt_th[failed]]
+    res_lst = []
+    for b in range(B):
+        res_lst.append({'solver_flag': solver_flag[b], 'is_fallback': False, 'a_cbf': a_cbf[b] if solver_flag[b] else None, 'risk_safe_t1': risk_safe_t1[b], 'socp_d': socp_d[b], 'cnt': cnt[b], 'solve_cnt': solve_cnt[b], 'solve_iters': 0,
+                        'audit_deviation': np.nan, 'audit_gap': np.nan})
+    return res_lst
+
+def commit_cbf(env, ctx, res):
+    """
+    Write the result of the CBF problem back to the env. Returns (a_cbf, is_solvable_status).
+    """
+    N = ctx['N']
+    a_rl = ctx['a_rl']
+    cov_r_t1 = ctx['cov_r_t1']
+    socp_d = res['socp_d']
+    if res['solver_flag']:
+        is_solvable_status = True
+        a_cbf = res['a_cbf']
+        if res['is_fallback']:
+            env.solver_stat['fallback'] = env.solver_stat['fallback'] + 1
         else:
-            a_cbf = np.zeros(N)
-            env.solver_stat['insolvable'] = env.solver_stat['insolvable'] + 1
-            is_solvable_status = False
-            env.solvable_flag.append(1)
-            cur_alpha_risk = np.sqrt(np.matmul(np.matmul((a_rl), cov_r_t1), (a_rl).T))
-            env.risk_adj_lst[-1] = risk_safe_t1
+            env.solver_stat['solvable'] = env.solver_stat['solvable'] + 1
+        # Check the solution whether satisfy the risk constraint.
+        env.risk_adj_lst[-1] = res['risk_safe_t1']
+        cur_alpha_risk = np.sqrt(np.matmul(np.matmul((a_rl+a_cbf), cov_r_t1), (a_rl+a_cbf).T))
+        assert (cur_alpha_risk - socp_d) <= 0.00001, 'cur risk: {}, socp_d {}'.format(cur_alpha_risk, socp_d) 
+        assert np.abs(np.sum(np.abs(a_rl+a_cbf)) - 1) <= 0.00001, 'sum of actions: {} \n{} \n{}'.format(np.sum(np.abs((a_rl+a_cbf))), a_rl, a_cbf)
+        env.solvable_flag.append(2 if res['is_fallback'] else 0)
+    else:
+        a_cbf = np.zeros(N)
+        env.solver_stat['insolvable'] = env.solver_stat['insolvable'] + 1
+        is_solvable_status = False
+        env.solvable_flag.append(1)
+        cur_alpha_risk = np.sqrt(np.matmul(np.matmul((a_rl), cov_r_t1), (a_rl).T))
+        env.risk_adj_lst[-1] = res['risk_safe_t1']
     env.risk_pred_lst.append(cur_alpha_risk)    
     env.is_last_ctrl_solvable = is_solvable_status
-    if cnt > 1:
+    if res['cnt'] > 1:
         env.stepcount = env.stepcount + 1
+    env.solver_stat['solve_cnt'] = env.solver_stat['solve_cnt'] + res['solve_cnt']
+    env.solver_stat['solve_iters'] = env.solver_stat['solve_iters'] + res['solve_iters']
+    env.solver_stat['socp_time'].append(res['solve_time'])
+    if is_solvable_status and (not res['is_fallback']):
+        env.solver_stat['socp_solvable'] = env.solver_stat['socp_solvable'] + 1
+    w_final = a_rl + a_cbf
+    env.solver_telemetry.record(
+        trade_day=env.curTradeDay, solve_time=res['solve_time'], ars_retries=res['cnt'] - 1, status=env.solvable_flag[-1],
+        solve_cnt=res['solve_cnt'], solve_iters=res['solve_iters'], risk_safe=res['risk_safe_t1'], risk_bound=socp_d,
+        risk_final=cur_alpha_risk, risk_residual=cur_alpha_risk - socp_d, sum_residual=np.abs(np.sum(w_final) - 1),
+        bound_residual=max(0.0, -np.min(w_final), np.max(w_final) - 1), fidelity=FIDELITY_CODE_DICT[ctx['fidelity']], risk_model=int(ctx['risk_factor'] is not None),
+        audit_deviation=res['audit_deviation'], audit_gap=res['audit_gap'],
+    )
+
+    return a_cbf, is_solvable_status
+
+def get_cbf_socp_problem(env, a_rl, cov_sqrt_t1, backend='cvxpy', cvxpy_solver='ECOS'):
+    """
+    The CBF-SOCP of the env (cvxpy: CbfSocpProblem solved by cvxpy_solver, cvxopt: CbfConeQpProblem), built once and loaded with the data of the current day.
+    """
+    N = env.stock_num
+    if backend == 'cvxopt':
+        is_rebuild = (env.cbf_problem is None) or (not isinstance(env.cbf_problem, CbfConeQpProblem))
+    else:
+        is_rebuild = (env.cbf_problem is None) or (not isinstance(env.cbf_problem, CbfSocpProblem)) or (env.cbf_problem.solver != cvxpy_solver)
+    if is_rebuild or (env.cbf_problem.stock_num != N):
+        env.cbf_problem = CbfConeQpProblem(stock_num=N) if backend == 'cvxopt' else CbfSocpProblem(stock_num=N, solver=cvxpy_solver)
+    env.cbf_problem.set_data(a_rl=a_rl, cov_sqrt=cov_sqrt_t1)
+    return env.cbf_problem
 
-    return a_cbf, is_solvable_status
\ No newline at end of file
+def get_cbf_factor_problem(env, a_rl, risk_factor, cvxpy_solver='ECOS'):
+    """
+    The CBF-SOCP over the factor risk model of the env (CbfFactorSocpProblem), built once and loaded with (L, d) of the current day.
+    """
+    N = env.stock_num
+    L, d = risk_factor
+    if (env.cbf_factor_problem is None) or (env.cbf_factor_problem.stock_num != N) or (env.cbf_factor_problem.num_factors != np.shape(L)[1]) or (env.cbf_factor_problem.solver != cvxpy_solver):
+        env.cbf_factor_problem = CbfFactorSocpProblem(stock_num=N, num_factors=np.shape(L)[1], solver=cvxpy_solver)
+    env.cbf_factor_problem.set_data(a_rl=a_rl, L=L, d=d)
+    return env.cbf_factor_problem
+
+def get_cov_factor(env, daily_return_ay, pred_prices_change):
+    """
+    Factor F of cov_r_t1 (F'F = cov_r_t1) for the cone matrix of the SOCP, updated from the rolling window of the env.
+    """
+    N, lookback = np.shape(daily_return_ay)
+    if (env.cov_factor is None) or (env.cov_factor.stock_num != N) or (env.cov_factor.lookback != lookback):
+        env.cov_factor = CovFactor(stock_num=N, lookback=lookback)
+    env.cov_factor.load(daily_return_ay[:, 1:])
+    return env.cov_factor.factor(pred_prices_change)
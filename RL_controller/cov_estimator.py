@@ -0,0 +1,95 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         cov_estimator.py
+ Description:  Covariance estimators of the return windows used for the risk of the env and the controller. Each estimator maps
+               the (days, num_of_stocks, lookback) windows of a split to the (days, num_of_stocks, num_of_stocks) covariances at once.
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+
+def get_centred(windows):
+    # (days, N, T) windows minus the mean of each asset over the window.
+    return windows - np.mean(windows, axis=-1, keepdims=True)
+
+def cov_sample(windows):
+    # Unbiased sample covariance, np.cov of each window. At most rank T-1.
+    Xc = get_centred(windows)
+    T = np.shape(windows)[-1]
+    return np.matmul(Xc, np.swapaxes(Xc, -1, -2)) / (T - 1)
+
+def cov_ledoit_wolf(windows):
+    # Ledoit-Wolf shrinkage of the sample covariance toward the scaled identity tr(S)/N * I, with the estimated optimal intensity.
+    Xc = get_centred(windows)
+    N, T = np.shape(windows)[-2:]
+    S_n = np.matmul(Xc, np.swapaxes(Xc, -1, -2)) / T # Biased sample covariance of the intensity formula
+    mu = np.trace(S_n, axis1=-2, axis2=-1) / N
+    eye = np.eye(N)
+    d2 = np.sum((S_n - mu[..., None, None] * eye)**2, axis=(-2, -1))
+    # sum_t ||x_t x_t' - S_n||^2 = sum_t ||x_t||^4 - T * ||S_n||^2
+    b2_bar = (np.sum(np.sum(Xc**2, axis=-2)**2, axis=-1) - T * np.sum(S_n**2, axis=(-2, -1))) / T**2
+    shrink = np.divide(np.minimum(b2_bar, d2), d2, out=np.ones_like(d2), where=d2 > 1e-300)
+    S = S_n * T / (T - 1)
+    target = (np.trace(S, axis1=-2, axis2=-1) / N)[..., None, None] * eye
+    return shrink[..., None, None] * target + (1 - shrink[..., None, None]) * S
+
+def cov_ewma(windows):
+    # Exponentially weighted covariance of the window, span = lookback (the latest day has the largest weight), bias-corrected.
+    T = np.shape(windows)[-1]
+    alpha = 2 / (T + 1)
+    weights = (1 - alpha) ** np.arange(T - 1, -1, -1)
+    weights = weights / np.sum(weights)
+    Xc = windows - np.matmul(windows, weights)[..., None]
+    return np.matmul(Xc * weights, np.swapaxes(Xc, -1, -2)) / (1 - np.sum(weights**2))
+
+def cov_const_corr(windows):
+    # Ledoit-Wolf shrinkage toward the constant-correlation matrix (same variances, average correlation), with the estimated optimal intensity.
+    Xc = get_centred(windows)
+    N, T = np.shape(windows)[-2:]
+    S_n = np.matmul(Xc, np.swapaxes(Xc, -1, -2)) / T
+    var = np.diagonal(S_n, axis1=-2, axis2=-1)
+    sd = np.sqrt(var)
+    sd_outer = sd[..., :, None] * sd[..., None, :]
+    corr = np.divide(S_n, sd_outer, out=np.zeros_like(S_n), where=sd_outer > 1e-300)
+    off = 1 - np.eye(N)
+    r_bar = np.sum(corr * off, axis=(-2, -1)) / max(N * (N - 1), 1)
+    F_n = r_bar[..., None, None] * sd_outer * off + np.eye(N) * S_n
+    # pi: asymptotic variance of the entries of S_n, rho: covariance of the target and S_n, gamma: misspecification of the target.
+    Y2 = Xc**2
+    pi_mat = np.matmul(Y2, np.swapaxes(Y2, -1, -2)) / T - S_n**2
+    theta = np.matmul(Xc**3, np.swapaxes(Xc, -1, -2)) / T - var[..., :, None] * S_n # theta_{ii,ij}
+    ratio = np.divide(sd[..., None, :], sd[..., :, None], out=np.zeros_like(S_n), where=sd[..., :, None] > 1e-300) # sqrt(s_jj / s_ii)
+    rho = np.trace(pi_mat, axis1=-2, axis2=-1) + r_bar * np.sum(ratio * theta * off, axis=(-2, -1))
+    gamma = np.sum((F_n - S_n)**2, axis=(-2, -1))
+    kappa = np.divide(np.sum(pi_mat, axis=(-2, -1)) - rho, gamma, out=np.zeros_like(gamma), where=gamma > 1e-300)
+    shrink = np.clip(kappa / T, 0.0, 1.0)
+    S = S_n * T / (T - 1)
+    sd_outer = sd_outer * T / (T - 1)
+    target = r_bar[..., None, None] * sd_outer * off + np.eye(N) * S
+    return shrink[..., None, None] * target + (1 - shrink[..., None, None]) * S
+
+# Register the covariance estimators here, an estimator maps (..., num_of_stocks, lookback) windows to (..., num_of_stocks, num_of_stocks) covariances.
+COV_ESTIMATOR_DICT = {
+    'sample': cov_sample,
+    'ledoit_wolf': cov_ledoit_wolf,
+    'ewma': cov_ewma,
+    'const_corr': cov_const_corr,
+}
+
+def cov_estimator_select(estimator_name):
+    try:
+        cov_fn = COV_ESTIMATOR_DICT[estimator_name]
+    except KeyError:
+        raise ValueError("Cannot find the covariance estimator [{}], it should be in {}.".format(estimator_name, list(COV_ESTIMATOR_DICT.keys())))
+    return cov_fn
+
+def gen_cov_table(estimator_name, windows):
+    """
+    (days, num_of_stocks, num_of_stocks) covariances of the (days, num_of_stocks, lookback) return windows by the estimator estimator_name.
+    """
+    cov_fn = cov_estimator_select(estimator_name=estimator_name)
+    return np.array(cov_fn(np.array(windows, dtype=float)), dtype=float)
@@ -9,6 +9,7 @@
 ---------------------------------
 '''
 import numpy as np
+import copy
 import pandas as pd
 import torch as th
 import torch.nn as nn
@@ -38,6 +39,12 @@ class MarketObserver_Algorithmic:
         return cur_hidden_vector_ay, lambda_val_ay, sigma_val_ay
     def update_hidden_vec_reward(self, mode, rate_of_price_change, mkt_direction):
         pass
+    def fork(self):
+        return self
+    def state_dict(self):
+        return None # No trained weights.
+    def load_state_dict(self, state_dict):
+        pass
 
 class MarketObserver:
     def __init__(self, config, action_dim):
@@ -58,7 +65,7 @@ class MarketObserver:
         else:
             self.optimizer = optim.Adam(self.mkt_obs_model.parameters(), lr=self.config.po_lr, weight_decay=self.config.po_weight_decay)
 
-        decay_steps = self.config.num_epochs // 3
+        decay_steps = (self.config.num_epochs * self.config.train_num_envs) // 3 # Every training env trains the observer at the end of its episodes.
 
         self.exp_lr_scheduler = optim.lr_scheduler.StepLR(self.optimizer, step_size=decay_steps, gamma=0.1)
 
@@ -71,6 +78,7 @@ class MarketObserver:
 
         self.mkt_direction_loss_sigma = th.nn.CrossEntropyLoss()
         self.mkt_direction_loss_lambda = th.nn.CrossEntropyLoss()
+        self.shared_model = None # Model trained by the optimizer once forked for several training envs, mkt_obs_model is then the copy of this env.
 
     def train(self, **label_kwargs):
   
@@ -92,7 +100,16 @@ class MarketObserver:
 
         self.optimizer.zero_grad()
         loss_val.backward()
-        th.cuda.synchronize()
+        if self.shared_model is not None:
+            # The gradients of the episode of this env update the shared model, the copy of the env takes its weights at reset().
+            for shared_param, param in zip(self.shared_model.parameters(), self.mkt_obs_model.parameters()):
+                shared_param.grad = param.grad
+                param.grad = None
+            with th.no_grad():
+                for shared_buf, buf in zip(self.shared_model.buffers(), self.mkt_obs_model.buffers()):
+                    shared_buf.copy_(buf) # e.g. the running statistics of the batch norms
+        if th.cuda.is_available():
+            th.cuda.synchronize()
         self.optimizer.step()
         self.exp_lr_scheduler.step()
 
@@ -108,6 +125,38 @@ class MarketObserver:
         self.lambda_log_p_lst = []
         self.sigma_log_p_lst = []
         self.mkt_direction_lst = []
+        if self.shared_model is not None:
+            # Start of an episode (or after training): no graph of this env goes through its copy, take the latest shared weights.
+            self.mkt_obs_model.load_state_dict(self.shared_model.state_dict())
+
+    def fork(self):
+        """
+        Observer of another training env: shares the model, the optimizer and the lr scheduler, but keeps its own episode buffers.
+        The episodes of the envs run through their own copies of the model, so that the optimizer step at the end of the episode of one env
+        does not modify the weights in the pending graph of another one. Every env steps the optimizer of the shared model with its gradients.
+        """
+        if self.shared_model is None:
+            self.shared_model = self.mkt_obs_model
+            self.mkt_obs_model = copy.deepcopy(self.shared_model)
+        mkt_observer = copy.copy(self)
+        mkt_observer.mkt_obs_model = copy.deepcopy(self.shared_model)
+        mkt_observer.reset()
+        return mkt_observer
+
+    def get_eval_model(self):
+        # The valid and test episodes use the latest trained weights.
+        return self.mkt_obs_model if self.shared_model is None else self.shared_model
+
+    def state_dict(self):
+        """
+        CPU copy of the weights of the observer model, e.g. for the evaluation in another process.
+        """
+        return {k: v.detach().cpu().clone() for k, v in self.get_eval_model().state_dict().items()}
+
+    def load_state_dict(self, state_dict):
+        self.mkt_obs_model.load_state_dict(state_dict)
+        if self.shared_model is not None:
+            self.shared_model.load_state_dict(state_dict)
 
     def predict(self, finemkt_feat, finestock_feat, **kwargs):
         # fine market data: (batch, features, window_size) 
@@ -128,10 +177,11 @@ class MarketObserver:
             self.sigma_log_p_lst.append(sigma_log_p) # sigma_log_p: (batch,), device loc: cuda
 
         elif kwargs['mode'] in ['valid', 'test']:
-            self.mkt_obs_model.eval()
+            eval_model = self.get_eval_model()
+            eval_model.eval()
             with th.no_grad():
                 input_kwargs['deterministic'] = True
-                cur_hidden_vector, lambda_val, sigma_val, lambda_log_p, sigma_log_p = self.mkt_obs_model(x=finestock_feat, **input_kwargs)
+                cur_hidden_vector, lambda_val, sigma_val, lambda_log_p, sigma_log_p = eval_model(x=finestock_feat, **input_kwargs)
             
         else:
             raise ValueError("Unknown mode: {}".format(kwargs['mode']))
@@ -309,14 +359,140 @@ def stf_1(config, **kwargs):
     model = STF_1(config, **kwargs)
     return model
 class STF_1(nn.Module):
+    """
+    Spatio-temporal transformer observer. Each (stock, time) point of the fine window is a token, and the market index is appended as an extra row of tokens.
+    Attention is applied along the time axis (within each stock) and along the stock axis (within each time step) by kernelised linear attention, so the cost is linear in both the number of assets and the window length.
+    """
     def __init__(self, config, **kwargs):
         super(STF_1, self).__init__()
         self.name = 'stf_1'
         self.config = config
+        self.output_action_dim = kwargs['action_dim'] # for hidden vector to RL agent
+
+        self.in_features = len(self.config.use_features)
+        self.num_of_stocks = self.config.topK
+        self.window_len = self.config.fine_window_size
+        d_model = 64
+        num_heads = 4
+        num_layers = 2
+
+        self.embed_s = nn.Linear(self.in_features, d_model) # stock tokens
+        self.embed_m = nn.Linear(self.in_features, d_model) # market tokens
+        self.pos_time = nn.Parameter(th.zeros(1, 1, self.window_len, d_model)) # (1, 1, window_size, d_model)
+        self.pos_asset = nn.Parameter(th.zeros(1, self.num_of_stocks + 1, 1, d_model)) # (1, num_of_stocks+1, 1, d_model), the last row is the market
+        nn.init.normal_(self.pos_time, std=0.02)
+        nn.init.normal_(self.pos_asset, std=0.02)
+
+        self.blocks = nn.ModuleList([STBlock(d_model=d_model, num_heads=num_heads) for _ in range(num_layers)])
+        self.norm_out = nn.LayerNorm(d_model)
+
+        self.fc_stock = nn.Linear(d_model, 1, bias=True) # per-stock score
+        self.fc_cash = nn.Linear(d_model, 1, bias=True) # cash score from the market embedding, used when action_dim = num_of_stocks + 1
+        self.sm = nn.Softmax(dim=1)
+
+        self.fc_lambda = nn.Linear(d_model, 3, bias=True)
+        self.gen_lambda = GenScore()
+        self.fc_sigma = nn.Linear(d_model, 3, bias=True)
+        self.gen_sigma = GenScore()
+
+    def forward(self, x, **kwargs):
+        # fine stock data (x): (batch, features, num_of_stocks, window_size)
+        # fine market data: (batch, features, window_size)
+        # kwargs: market, deterministic, device
+        s0 = x.permute(0, 2, 3, 1) # -> (batch, num_of_stocks, window_size, features)
+        m0 = kwargs['market'].permute(0, 2, 1).unsqueeze(1) # -> (batch, 1, window_size, features)
+        tokens = th.cat((self.embed_s(s0), self.embed_m(m0)), dim=1) # -> (batch, num_of_stocks+1, window_size, d_model)
+        tokens = tokens + self.pos_time + self.pos_asset
+        for blk in self.blocks:
+            tokens = blk(tokens)
+        tokens = self.norm_out(tokens)
+
+        asset_embed = th.mean(tokens, dim=2) # Pool over time -> (batch, num_of_stocks+1, d_model)
+        stock_embed = asset_embed[:, :-1, :] # (batch, num_of_stocks, d_model)
+        mkt_embed = asset_embed[:, -1, :] # (batch, d_model)
+        scores = self.fc_stock(stock_embed).squeeze(-1) # (batch, num_of_stocks)
+        if self.output_action_dim == self.num_of_stocks:
+            pass
+        elif self.output_action_dim == self.num_of_stocks + 1:
+            # The first dim is cash.
+            scores = th.cat((self.fc_cash(mkt_embed), scores), dim=1) # (batch, num_of_stocks+1)
+        else:
+            raise ValueError("Unmatch action_dim: {}, stock_num: {}".format(self.output_action_dim, self.num_of_stocks))
+        hidden_vec = self.sm(scores) # hidden vectors
+
+        embed = th.mean(asset_embed, dim=1) # Pool over assets and market -> (batch, d_model)
+        lambda_vec = self.fc_lambda(embed) # -> (batch, 3)
+        lambda_kwargs = {'name': 'lambda', 'deterministic': kwargs['deterministic'], 'device': kwargs['device'], 'score_min': self.config.lambda_min, 'score_max': self.config.lambda_max}
+        lambda_val, lambda_log_p = self.gen_lambda(lambda_vec, **lambda_kwargs) # -> (batch, )
+        sigma_vec = self.fc_sigma(embed) # -> (batch, 3)
+        sigma_kwargs = {'name': 'sigma', 'deterministic': kwargs['deterministic'], 'device': kwargs['device'], 'score_min': self.config.sigma_min, 'score_max': self.config.sigma_max}
+        sigma_val, sigma_log_p = self.gen_sigma(sigma_vec, **sigma_kwargs) # -> (batch, )
+
+        return hidden_vec, lambda_val, sigma_val, lambda_log_p, sigma_log_p
+
+class STBlock(nn.Module):
+    """
+    One spatio-temporal layer: temporal linear attention, spatial linear attention and a feed-forward network, each with a pre-norm residual connection.
+    """
+    def __init__(self, d_model, num_heads, ff_mult=2, dropout=0.1):
+        super(STBlock, self).__init__()
+        self.name = 'st_block'
+        self.norm_t = nn.LayerNorm(d_model)
+        self.attn_t = LinearAttention(d_model=d_model, num_heads=num_heads)
+        self.norm_s = nn.LayerNorm(d_model)
+        self.attn_s = LinearAttention(d_model=d_model, num_heads=num_heads)
+        self.norm_ff = nn.LayerNorm(d_model)
+        self.ff = nn.Sequential(
+            nn.Linear(d_model, ff_mult * d_model),
+            nn.GELU(),
+            nn.Dropout(dropout),
+            nn.Linear(ff_mult * d_model, d_model),
+        )
+        self.dropout = nn.Dropout(dropout)
+
     def forward(self, x):
-        pass
+        # x: (batch, num_of_assets, window_size, d_model)
+        batch, num_of_assets, window_size, d_model = x.shape
+        # Temporal attention within each asset
+        h = self.norm_t(x).reshape(batch * num_of_assets, window_size, d_model)
+        x = x + self.dropout(self.attn_t(h).reshape(batch, num_of_assets, window_size, d_model))
+        # Spatial attention across assets within each time step
+        h = self.norm_s(x).permute(0, 2, 1, 3).reshape(batch * window_size, num_of_assets, d_model)
+        h = self.attn_s(h).reshape(batch, window_size, num_of_assets, d_model).permute(0, 2, 1, 3)
+        x = x + self.dropout(h)
+        x = x + self.dropout(self.ff(self.norm_ff(x)))
         return x
 
+class LinearAttention(nn.Module):
+    """
+    Multi-head kernelised attention with the feature map elu(x)+1 (Katharopoulos et al., 2020).
+    softmax(QK')V is replaced by phi(Q)(phi(K)'V) / (phi(Q) sum_j phi(K_j)), which costs O(L*d^2) instead of O(L^2*d) for a sequence of length L.
+    """
+    def __init__(self, d_model, num_heads, eps=1e-6):
+        super(LinearAttention, self).__init__()
+        self.name = 'linear_attention'
+        if d_model % num_heads != 0:
+            raise ValueError("d_model [{}] should be divisible by num_heads [{}]".format(d_model, num_heads))
+        self.num_heads = num_heads
+        self.head_dim = d_model // num_heads
+        self.eps = eps
+        self.qkv = nn.Linear(d_model, 3 * d_model, bias=True)
+        self.proj = nn.Linear(d_model, d_model, bias=True)
+
+    def forward(self, x):
+        # x: (batch, seq_len, d_model)
+        batch, seq_len, d_model = x.shape
+        qkv = self.qkv(x).reshape(batch, seq_len, 3, self.num_heads, self.head_dim)
+        q, k, v = qkv.unbind(dim=2) # (batch, seq_len, heads, head_dim)
+        q = nn.functional.elu(q) + 1.0
+        k = nn.functional.elu(k) + 1.0
+        kv = th.einsum('blhd,blhe->bhde', k, v) # (batch, heads, head_dim, head_dim)
+        k_sum = th.sum(k, dim=1) # (batch, heads, head_dim)
+        z = 1.0 / (th.einsum('blhd,bhd->blh', q, k_sum) + self.eps) # (batch, seq_len, heads)
+        out = th.einsum('blhd,bhde,blh->blhe', q, kv, z) # (batch, seq_len, heads, head_dim)
+        out = out.reshape(batch, seq_len, d_model)
+        return self.proj(out)
+
 class GenScore(nn.Module):
     def __init__(self, **kwargs):
         super(GenScore, self).__init__()
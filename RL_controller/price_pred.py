@@ -0,0 +1,101 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         price_pred.py
+ Description:  Price prediction models of the solver-based agent. Each model predicts the price change of the next day
+               for all trading days of a split at once, the controller reads the table by day.
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+
+def get_split_panel(data, col, date_lst, stock_lst):
+    """
+    (days, num_of_stocks) values of col, one row per date of date_lst and one column per stock of stock_lst.
+    """
+    panel = data[data['date'].isin(date_lst)].pivot_table(index='date', columns='stock', values=col, aggfunc='last')
+    return np.array(panel.reindex(index=date_lst, columns=stock_lst).values, dtype=float)
+
+def gen_price_pred_input(rawdata, extra_data, config):
+    """
+    Inputs of the price prediction models of a split.
+    - close: (days, num_of_stocks), daily close price.
+    - daily_returns: (days, num_of_stocks, lookback_days), the DAILYRETURNS window of each day, [[t-N+1, .., t-1, t]].
+    - fine_ma, fine_close: (days, num_of_stocks), moving average and close price of the fine-frequency stock data, at the market close of each day.
+    """
+    date_lst = np.sort(rawdata['date'].unique())
+    stock_lst = np.sort(rawdata['stock'].unique())
+    data = rawdata.sort_values(['date', 'stock'], ascending=True)
+    daily_returns = np.array(list(data['DAILYRETURNS-{}'.format(config.dailyRetun_lookback)].values), dtype=float)
+    pred_input = {
+        'close': get_split_panel(data=data, col='close', date_lst=date_lst, stock_lst=stock_lst),
+        'daily_returns': np.reshape(daily_returns, (len(date_lst), len(stock_lst), -1)),
+    }
+    if (extra_data is not None) and ('fine_stock' in extra_data.keys()):
+        fine_data = extra_data['fine_stock']
+        pred_input['fine_ma'] = get_split_panel(data=fine_data, col='stock_{}_ma'.format(config.finefreq), date_lst=date_lst, stock_lst=stock_lst)
+        pred_input['fine_close'] = get_split_panel(data=fine_data, col='stock_{}_close'.format(config.finefreq), date_lst=date_lst, stock_lst=stock_lst)
+    return pred_input
+
+def pred_ma(pred_input, config):
+    # The price reverts to the moving average of the fine-frequency data.
+    if 'fine_ma' not in pred_input.keys():
+        raise ValueError("The MA price prediction model requires the fine-frequency stock data.")
+    return (pred_input['fine_ma'] - pred_input['close']) / pred_input['close']
+
+def pred_ewma(pred_input, config):
+    # Exponentially weighted mean of the daily returns of the window, span = lookback_days.
+    daily_returns = pred_input['daily_returns']
+    lookback = np.shape(daily_returns)[-1]
+    alpha = 2 / (lookback + 1)
+    weights = (1 - alpha) ** np.arange(lookback - 1, -1, -1) # The latest day has the largest weight.
+    return np.matmul(daily_returns, weights) / np.sum(weights)
+
+def pred_linear_trend(pred_input, config):
+    # Least-squares line through the (relative) prices of the window, extrapolated by one day.
+    daily_returns = pred_input['daily_returns']
+    lookback = np.shape(daily_returns)[-1]
+    prices = np.cumprod(1 + daily_returns, axis=-1) # (days, num_of_stocks, lookback_days)
+    x = np.arange(lookback) - (lookback - 1) / 2
+    slope = np.matmul(prices, x) / max(np.sum(x ** 2), 1e-12)
+    pred_prices = np.mean(prices, axis=-1) + slope * (lookback + 1) / 2
+    return pred_prices / prices[:, :, -1] - 1
+
+def pred_ar1(pred_input, config):
+    # AR(1) of the daily returns fitted on the window of each day and stock.
+    daily_returns = pred_input['daily_returns']
+    x = daily_returns[:, :, :-1]
+    y = daily_returns[:, :, 1:]
+    x_c = x - np.mean(x, axis=-1, keepdims=True)
+    y_c = y - np.mean(y, axis=-1, keepdims=True)
+    var_x = np.sum(x_c ** 2, axis=-1)
+    phi = np.divide(np.sum(x_c * y_c, axis=-1), var_x, out=np.zeros_like(var_x), where=var_x > 1e-16)
+    phi = np.clip(phi, -1.0, 1.0)
+    const = np.mean(y, axis=-1) - phi * np.mean(x, axis=-1)
+    return const + phi * daily_returns[:, :, -1]
+
+# Register the price prediction models here, a model maps the inputs of a split to the (days, num_of_stocks) predicted price changes.
+PRICE_PRED_MODEL_DICT = {
+    'MA': pred_ma,
+    'EWMA': pred_ewma,
+    'TREND': pred_linear_trend,
+    'AR1': pred_ar1,
+}
+
+def price_pred_select(model_name):
+    try:
+        pred_fn = PRICE_PRED_MODEL_DICT[model_name]
+    except KeyError:
+        raise ValueError("Cannot find the price prediction model [{}], it should be in {}.".format(model_name, list(PRICE_PRED_MODEL_DICT.keys())))
+    return pred_fn
+
+def gen_price_pred_table(model_name, rawdata, extra_data, config):
+    """
+    (days, num_of_stocks) predicted price changes of the next day of a split by the price prediction model model_name.
+    """
+    pred_fn = price_pred_select(model_name=model_name)
+    pred_input = gen_price_pred_input(rawdata=rawdata, extra_data=extra_data, config=config)
+    return np.array(pred_fn(pred_input=pred_input, config=config), dtype=float)
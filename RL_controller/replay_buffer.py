@@ -0,0 +1,295 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         replay_buffer.py
+ Description:  Replay buffers of the RL agent of MASA, plugged into the algorithm through replay_buffer_class.
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+import torch as th
+from gym import spaces
+from typing import Any, Dict, List, Optional, Union
+from stable_baselines3.common.buffers import BaseBuffer, ReplayBuffer
+from stable_baselines3.common.type_aliases import ReplayBufferSamples
+from stable_baselines3.common.vec_env import VecNormalize
+
+class CompactReplayBuffer(ReplayBuffer):
+    """
+    Replay buffer storing every observation once: the next observation of transition i is the observation i + 1 of the same env
+    (as the memory efficient variant of ReplayBuffer), the slot i + 1 is only overwritten by the reset observation after a done, whose target
+    does not use the next observation. The observation is split into
+        the static block, (buffer_size, n_envs, obs_dim - dynamic_dim): the market features of the day (covariances and technical indicators),
+            stored in float16 if static_fp16,
+        the dynamic block, (buffer_size, n_envs, dynamic_dim): the end of the state (the portfolio value and the hidden vector of the market observer).
+    The sampled indices are sorted, so that a batch reads the storage in order, and the blocks are joined (and float16 converted) by torch.
+    buffer_size: size the buffer to the transitions of the whole training (num_epochs * totalTradeDay of all envs), not the 1e6 default.
+    """
+    def __init__(
+        self,
+        buffer_size: int,
+        observation_space: spaces.Space,
+        action_space: spaces.Space,
+        device: Union[th.device, str] = "auto",
+        n_envs: int = 1,
+        optimize_memory_usage: bool = True,
+        handle_timeout_termination: bool = False,
+        dynamic_dim: int = 1,
+        static_fp16: bool = False,
+    ):
+        # The arrays of ReplayBuffer are not allocated, optimize_memory_usage is always on.
+        BaseBuffer.__init__(self, buffer_size, observation_space, action_space, device, n_envs=n_envs)
+        if not isinstance(observation_space, spaces.Box) or (len(self.obs_shape) != 1):
+            raise ValueError("CompactReplayBuffer only supports flat Box observations, got [{}].".format(observation_space))
+        if handle_timeout_termination:
+            raise ValueError("CompactReplayBuffer does not support handle_timeout_termination, the next observation of a truncated episode is not kept.")
+        obs_dim = self.obs_shape[0]
+        if not (0 <= dynamic_dim <= obs_dim):
+            raise ValueError("The dynamic block [{}] should be within the observation [{}].".format(dynamic_dim, obs_dim))
+        self.buffer_size = max(buffer_size // n_envs, 1)
+        self.optimize_memory_usage = True
+        self.handle_timeout_termination = False
+        self.static_dim = obs_dim - dynamic_dim
+        self.static_dtype = np.float16 if static_fp16 else observation_space.dtype
+        self.observations = None
+        self.next_observations = None
+        self.obs_static = np.zeros((self.buffer_size, self.n_envs, self.static_dim), dtype=self.static_dtype)
+        self.obs_dynamic = np.zeros((self.buffer_size, self.n_envs, dynamic_dim), dtype=observation_space.dtype)
+        self.actions = np.zeros((self.buffer_size, self.n_envs, self.action_dim), dtype=action_space.dtype)
+        self.rewards = np.zeros((self.buffer_size, self.n_envs), dtype=np.float32)
+        self.dones = np.zeros((self.buffer_size, self.n_envs), dtype=np.float32)
+        self.timeouts = np.zeros((self.buffer_size, self.n_envs), dtype=np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.obs_static.nbytes + self.obs_dynamic.nbytes + self.actions.nbytes + self.rewards.nbytes + self.dones.nbytes + self.timeouts.nbytes
+
+    def set_obs(self, idx: int, obs: np.ndarray) -> None:
+        obs = np.reshape(np.array(obs), (self.n_envs, ) + self.obs_shape)
+        self.obs_static[idx] = obs[:, :self.static_dim]
+        self.obs_dynamic[idx] = obs[:, self.static_dim:]
+
+    def get_obs(self, batch_inds: np.ndarray, env_indices: np.ndarray) -> np.ndarray:
+        # (batch, obs_dim) in the dtype of the observation space
+        return np.concatenate([self.obs_static[batch_inds, env_indices, :].astype(self.observation_space.dtype), self.obs_dynamic[batch_inds, env_indices, :]], axis=-1)
+
+    def get_obs_tensor(self, batch_inds: np.ndarray, env_indices: np.ndarray) -> th.Tensor:
+        # (batch, obs_dim) on self.device, numpy is much slower than torch at the float16 conversion.
+        obs_static = th.from_numpy(self.obs_static[batch_inds, env_indices, :])
+        obs_dynamic = th.from_numpy(self.obs_dynamic[batch_inds, env_indices, :])
+        obs = th.empty((len(batch_inds), ) + self.obs_shape, dtype=obs_dynamic.dtype)
+        obs[:, :self.static_dim] = obs_static
+        obs[:, self.static_dim:] = obs_dynamic
+        return obs.to(self.device)
+
+    def add(
+        self,
+        obs: np.ndarray,
+        next_obs: np.ndarray,
+        action: np.ndarray,
+        reward: np.ndarray,
+        done: np.ndarray,
+        infos: List[Dict[str, Any]],
+    ) -> None:
+        self.set_obs(self.pos, obs)
+        self.set_obs((self.pos + 1) % self.buffer_size, next_obs)
+        self.actions[self.pos] = np.reshape(np.array(action), (self.n_envs, self.action_dim))
+        self.rewards[self.pos] = np.array(reward)
+        self.dones[self.pos] = np.array(done)
+
+        self.pos += 1
+        if self.pos == self.buffer_size:
+            self.full = True
+            self.pos = 0
+
+    def sample(self, batch_size: int, env: Optional[VecNormalize] = None) -> ReplayBufferSamples:
+        # The transition at self.pos is invalid, its observation slot holds the next observation of the previous one.
+        if self.full:
+            batch_inds = (np.random.randint(1, self.buffer_size, size=batch_size) + self.pos) % self.buffer_size
+        else:
+            batch_inds = np.random.randint(0, self.pos, size=batch_size)
+        return self._get_samples(np.sort(batch_inds), env=env)
+
+    def _get_samples(self, batch_inds: np.ndarray, env: Optional[VecNormalize] = None) -> ReplayBufferSamples:
+        env_indices = np.random.randint(0, high=self.n_envs, size=(len(batch_inds),))
+        next_inds = (batch_inds + 1) % self.buffer_size
+        if env is None:
+            return ReplayBufferSamples(
+                self.get_obs_tensor(batch_inds, env_indices),
+                self.to_torch(self.actions[batch_inds, env_indices, :]),
+                self.get_obs_tensor(next_inds, env_indices),
+                self.to_torch(self.dones[batch_inds, env_indices].reshape(-1, 1)),
+                self.to_torch(self.rewards[batch_inds, env_indices].reshape(-1, 1)),
+            )
+        data = (
+            self._normalize_obs(self.get_obs(batch_inds, env_indices), env),
+            self.actions[batch_inds, env_indices, :],
+            self._normalize_obs(self.get_obs(next_inds, env_indices), env),
+            self.dones[batch_inds, env_indices].reshape(-1, 1),
+            self._normalize_reward(self.rewards[batch_inds, env_indices].reshape(-1, 1), env),
+        )
+        return ReplayBufferSamples(*tuple(map(self.to_torch, data)))
+
+class DayIndexedReplayBuffer(CompactReplayBuffer):
+    """
+    Replay buffer storing the day of each observation instead of its market features: a row keeps (day index, dynamic block, action,
+    reward, done), and the observations are rebuilt at sampling by gathering the static block from the (days, num_of_features) tables
+    of the envs. The day of the observation and of the next one is read from the step info (obs_trade_day, trade_day).
+    day_feat_table_lst: the table of each env (StockPortfolioEnv.get_day_feat_table), envs running the same days can share one table.
+    The next observation is the next row, as in CompactReplayBuffer.
+    """
+    def __init__(
+        self,
+        buffer_size: int,
+        observation_space: spaces.Space,
+        action_space: spaces.Space,
+        device: Union[th.device, str] = "auto",
+        n_envs: int = 1,
+        optimize_memory_usage: bool = True,
+        handle_timeout_termination: bool = False,
+        dynamic_dim: int = 1,
+        day_feat_table_lst: Optional[List[np.ndarray]] = None,
+    ):
+        super().__init__(buffer_size, observation_space, action_space, device=device, n_envs=n_envs, optimize_memory_usage=optimize_memory_usage,
+                         handle_timeout_termination=handle_timeout_termination, dynamic_dim=dynamic_dim, static_fp16=False)
+        if (day_feat_table_lst is None) or (len(day_feat_table_lst) != self.n_envs):
+            raise ValueError("DayIndexedReplayBuffer needs the day feature table of each of the [{}] envs.".format(self.n_envs))
+        # One (all days, num_of_features) table, env k reads its day d at the row day_offset[k] + d.
+        table_lst = []
+        self.day_offset = np.zeros(self.n_envs, dtype=np.int64)
+        num_days = 0
+        for idx, table in enumerate(day_feat_table_lst):
+            for prev_idx in range(idx):
+                if day_feat_table_lst[prev_idx] is table:
+                    self.day_offset[idx] = self.day_offset[prev_idx]
+                    break
+            else:
+                if np.shape(table)[1] != self.static_dim:
+                    raise ValueError("The day feature table has [{}] features, the observation has [{}].".format(np.shape(table)[1], self.static_dim))
+                table_lst.append(np.array(table, dtype=observation_space.dtype))
+                self.day_offset[idx] = num_days
+                num_days = num_days + len(table)
+        self.day_feat_table = np.concatenate(table_lst, axis=0)
+        self.obs_static = None
+        self.obs_day = np.zeros((self.buffer_size, self.n_envs), dtype=np.int32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.day_feat_table.nbytes + self.obs_day.nbytes + self.obs_dynamic.nbytes + self.actions.nbytes + self.rewards.nbytes + self.dones.nbytes + self.timeouts.nbytes
+
+    def set_obs(self, idx: int, obs: np.ndarray, day_lst: List[int]) -> None:
+        obs = np.reshape(np.array(obs), (self.n_envs, ) + self.obs_shape)
+        self.obs_day[idx] = self.day_offset + np.array(day_lst)
+        self.obs_dynamic[idx] = obs[:, self.static_dim:]
+
+    def get_obs(self, batch_inds: np.ndarray, env_indices: np.ndarray) -> np.ndarray:
+        return np.concatenate([self.day_feat_table[self.obs_day[batch_inds, env_indices], :], self.obs_dynamic[batch_inds, env_indices, :]], axis=-1)
+
+    def get_obs_tensor(self, batch_inds: np.ndarray, env_indices: np.ndarray) -> th.Tensor:
+        return th.from_numpy(self.get_obs(batch_inds, env_indices)).to(self.device)
+
+    def add(
+        self,
+        obs: np.ndarray,
+        next_obs: np.ndarray,
+        action: np.ndarray,
+        reward: np.ndarray,
+        done: np.ndarray,
+        infos: List[Dict[str, Any]],
+    ) -> None:
+        self.set_obs(self.pos, obs, [info['obs_trade_day'] for info in infos])
+        self.set_obs((self.pos + 1) % self.buffer_size, next_obs, [info['trade_day'] for info in infos])
+        self.actions[self.pos] = np.reshape(np.array(action), (self.n_envs, self.action_dim))
+        self.rewards[self.pos] = np.array(reward)
+        self.dones[self.pos] = np.array(done)
+
+        self.pos += 1
+        if self.pos == self.buffer_size:
+            self.full = True
+            self.pos = 0
+
+class DeviceReplayBuffer(ReplayBuffer):
+    """
+    Replay buffer held in preallocated torch tensors on the training device. add() copies the transition to the device once, sample() draws
+    the indices with th.randint on the device and gathers the batch there, so the gradient steps make no host round trip.
+    The next observation is the next row, as in CompactReplayBuffer. The buffer should be sized to the transitions of the training.
+    """
+    def __init__(
+        self,
+        buffer_size: int,
+        observation_space: spaces.Space,
+        action_space: spaces.Space,
+        device: Union[th.device, str] = "auto",
+        n_envs: int = 1,
+        optimize_memory_usage: bool = True,
+        handle_timeout_termination: bool = False,
+    ):
+        # The arrays of ReplayBuffer are not allocated, optimize_memory_usage is always on.
+        BaseBuffer.__init__(self, buffer_size, observation_space, action_space, device, n_envs=n_envs)
+        if not isinstance(observation_space, spaces.Box) or (len(self.obs_shape) != 1):
+            raise ValueError("DeviceReplayBuffer only supports flat Box observations, got [{}].".format(observation_space))
+        if handle_timeout_termination:
+            raise ValueError("DeviceReplayBuffer does not support handle_timeout_termination, the next observation of a truncated episode is not kept.")
+        self.buffer_size = max(buffer_size // n_envs, 1)
+        self.optimize_memory_usage = True
+        self.handle_timeout_termination = False
+        self.observations = th.zeros((self.buffer_size, self.n_envs) + self.obs_shape, dtype=th.float32, device=self.device)
+        self.next_observations = None
+        self.actions = th.zeros((self.buffer_size, self.n_envs, self.action_dim), dtype=th.float32, device=self.device)
+        self.rewards = th.zeros((self.buffer_size, self.n_envs), dtype=th.float32, device=self.device)
+        self.dones = th.zeros((self.buffer_size, self.n_envs), dtype=th.float32, device=self.device)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.element_size() * t.nelement() for t in [self.observations, self.actions, self.rewards, self.dones])
+
+    def add(
+        self,
+        obs: np.ndarray,
+        next_obs: np.ndarray,
+        action: np.ndarray,
+        reward: np.ndarray,
+        done: np.ndarray,
+        infos: List[Dict[str, Any]],
+    ) -> None:
+        # One host to device copy per transition: [obs, next_obs, action, reward, done] of the n_envs envs.
+        row = np.concatenate([
+            np.reshape(obs, (self.n_envs, -1)), np.reshape(next_obs, (self.n_envs, -1)), np.reshape(action, (self.n_envs, -1)),
+            np.reshape(reward, (self.n_envs, 1)), np.reshape(done, (self.n_envs, 1)),
+        ], axis=1).astype(np.float32)
+        row = th.from_numpy(row).to(self.device)
+        obs_dim = self.obs_shape[0]
+        self.observations[self.pos] = row[:, :obs_dim]
+        self.observations[(self.pos + 1) % self.buffer_size] = row[:, obs_dim:2*obs_dim]
+        self.actions[self.pos] = row[:, 2*obs_dim:2*obs_dim+self.action_dim]
+        self.rewards[self.pos] = row[:, -2]
+        self.dones[self.pos] = row[:, -1]
+
+        self.pos += 1
+        if self.pos == self.buffer_size:
+            self.full = True
+            self.pos = 0
+
+    def sample(self, batch_size: int, env: Optional[VecNormalize] = None) -> ReplayBufferSamples:
+        if env is not None:
+            raise ValueError("DeviceReplayBuffer does not support VecNormalize.")
+        # The transition at self.pos is invalid, its observation slot holds the next observation of the previous one.
+        if self.full:
+            batch_inds = (th.randint(1, self.buffer_size, (batch_size, ), device=self.device) + self.pos) % self.buffer_size
+        else:
+            batch_inds = th.randint(0, self.pos, (batch_size, ), device=self.device)
+        return self._get_samples(batch_inds)
+
+    def _get_samples(self, batch_inds: th.Tensor, env: Optional[VecNormalize] = None) -> ReplayBufferSamples:
+        batch_inds = th.as_tensor(batch_inds, device=self.device)
+        env_indices = th.randint(0, self.n_envs, (len(batch_inds), ), device=self.device)
+        return ReplayBufferSamples(
+            self.observations[batch_inds, env_indices],
+            self.actions[batch_inds, env_indices],
+            self.observations[(batch_inds + 1) % self.buffer_size, env_indices],
+            self.dones[batch_inds, env_indices].unsqueeze(1),
+            self.rewards[batch_inds, env_indices].unsqueeze(1),
+        )
@@ -0,0 +1,169 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         solver_tuner.py
+ Description:  Select the fastest backend of the CBF problem on sample instances, cached on disk per (number of assets, machine).
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+import os
+import json
+import time
+import platform
+import cvxpy as cp
+from .cbf_solver import CbfSocpProblem, CbfConeQpProblem, CbfProjectionSolver, CovFactor
+
+CVXPY_SOC_SOLVER_LST = ['CLARABEL', 'ECOS', 'SCS', 'CVXOPT'] # cvxpy solvers supporting second-order cones (OSQP does not).
+
+def split_backend_name(name):
+    """
+    'projection' -> ('projection', None), 'cvxopt' -> ('cvxopt', None), 'cvxpy:ECOS' -> ('cvxpy', 'ECOS').
+    """
+    if name.startswith('cvxpy:'):
+        return 'cvxpy', name.split(':', 1)[1]
+    return name, None
+
+class CbfSolverTuner:
+    """
+    Benchmark the available backends of the CBF problem on instances {'a_rl', 'hist_returns', 'pred_returns', 'cov', 'socp_d'} (and 'cov_sqrt', optional)
+    and select the fastest one whose status and solution match the exact projection within tol.
+    The instances are solved in order, as the days of an episode, after one untimed instance (compilation of the cvxpy problems).
+    The choice is cached in the json file cache_path, by the number of assets and the machine (host, CPU and solver versions).
+    """
+    def __init__(self, cache_path, tol=1e-3, fallback_solver='ECOS'):
+        self.cache_path = cache_path
+        self.tol = tol
+        self.fallback_solver = fallback_solver # cvxpy solver of the numerical fallback of the projection, as in the controller.
+
+    @staticmethod
+    def machine_key():
+        try:
+            import cvxopt
+            cvxopt_version = cvxopt.__version__
+        except ImportError:
+            cvxopt_version = None
+        return '{}|{}|{}|cpu{}|numpy-{}|cvxpy-{}|cvxopt-{}'.format(platform.node(), platform.machine(), platform.processor(), os.cpu_count(), np.__version__, cp.__version__, cvxopt_version)
+
+    def get_cache_key(self, stock_num):
+        return 'N{}|{}'.format(stock_num, self.machine_key())
+
+    def load_cache(self):
+        if (self.cache_path is None) or (not os.path.exists(self.cache_path)):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self, cache):
+        if self.cache_path is None:
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir != '':
+            os.makedirs(cache_dir, exist_ok=True)
+        with open(self.cache_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+
+    def get_backend_lst(self):
+        backend_lst = ['projection']
+        try:
+            import cvxopt
+            backend_lst.append('cvxopt')
+        except ImportError:
+            pass
+        installed_lst = cp.installed_solvers()
+        backend_lst = backend_lst + ['cvxpy:{}'.format(solver) for solver in CVXPY_SOC_SOLVER_LST if solver in installed_lst]
+        return backend_lst
+
+    def lookup(self, stock_num):
+        """
+        The cached backend name of stock_num assets on this machine, None if not tuned yet.
+        """
+        rec = self.load_cache().get(self.get_cache_key(stock_num=stock_num))
+        return None if rec is None else rec['backend']
+
+    def select(self, stock_num, instance_lst):
+        """
+        The backend name of the fastest accurate backend, e.g. 'projection', 'cvxopt', 'cvxpy:ECOS'. Benchmarks only if not cached.
+        """
+        backend = self.lookup(stock_num=stock_num)
+        if backend is not None:
+            return backend
+        cache_key = self.get_cache_key(stock_num=stock_num)
+        report = self.benchmark(stock_num=stock_num, instance_lst=instance_lst)
+        accurate_lst = [name for name, rec in report.items() if rec['is_accurate']]
+        backend = min(accurate_lst, key=lambda name: report[name]['time']) if len(accurate_lst) > 0 else 'projection'
+        cache = self.load_cache() # Reload, another process may have added its own N.
+        cache[cache_key] = {'backend': backend, 'num_instances': len(instance_lst), 'tol': self.tol, 'report': report,
+                            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.save_cache(cache)
+        return backend
+
+    def benchmark(self, stock_num, instance_lst):
+        """
+        {backend: {'time' (s per instance), 'is_accurate', 'max_diff', 'status_mismatch'}} of all available backends.
+        """
+        ref_solver = CbfProjectionSolver(stock_num=stock_num, tol=1e-12, warm_start=False)
+        ref_lst = [ref_solver.solve(a_rl=ins['a_rl'], cov=ins['cov'], socp_d=ins['socp_d']) for ins in instance_lst]
+        report = {}
+        for name in self.get_backend_lst():
+            try:
+                elapsed, res_lst = self.run_backend(name=name, stock_num=stock_num, instance_lst=instance_lst)
+            except Exception as error:
+                print("CBF solver tuning, backend [{}] failed: {}".format(name, error))
+                continue
+            max_diff = 0.0
+            status_mismatch = 0
+            for (ref_status, ref_x), (is_optimal, x) in zip(ref_lst[1:], res_lst[1:]):
+                if (ref_status == 'optimal') != is_optimal:
+                    status_mismatch = status_mismatch + 1
+                elif is_optimal:
+                    max_diff = max(max_diff, float(np.max(np.abs(ref_x - x))))
+            report[name] = {'time': elapsed / max(len(instance_lst) - 1, 1), 'is_accurate': bool((status_mismatch == 0) and (max_diff <= self.tol)),
+                            'max_diff': max_diff, 'status_mismatch': status_mismatch}
+        return report
+
+    def run_backend(self, name, stock_num, instance_lst):
+        """
+        Solve the instances in order with the backend. Returns (elapsed time excluding the first instance, [(is_optimal, a_cbf), ...]).
+        """
+        cbf_solver, cvxpy_solver = split_backend_name(name)
+        if cbf_solver == 'projection':
+            solver = CbfProjectionSolver(stock_num=stock_num)
+            problem = None # Numerical fallback, built on first use as in the controller.
+        elif cbf_solver == 'cvxopt':
+            problem = CbfConeQpProblem(stock_num=stock_num)
+        else:
+            problem = CbfSocpProblem(stock_num=stock_num, solver=cvxpy_solver)
+        cov_factor = None
+        res_lst = []
+        elapsed = 0.0
+        for idx, ins in enumerate(instance_lst):
+            start_time = time.perf_counter()
+            status = None
+            if cbf_solver == 'projection':
+                status, x = solver.solve(a_rl=ins['a_rl'], cov=ins['cov'], socp_d=ins['socp_d'])
+                res = (status == 'optimal', x)
+                if (status == 'numerical') and (problem is None):
+                    problem = CbfSocpProblem(stock_num=stock_num, solver=self.fallback_solver)
+            if (cbf_solver != 'projection') or (status == 'numerical'):
+                # The SOCP backends also pay for the factor of the covariance, as in the controller (given for the non-sample estimators).
+                if 'cov_sqrt' in ins:
+                    cov_sqrt = ins['cov_sqrt']
+                else:
+                    N, lookback = np.shape(ins['hist_returns'])
+                    if cov_factor is None:
+                        cov_factor = CovFactor(stock_num=N, lookback=lookback)
+                    cov_factor.load(ins['hist_returns'][:, 1:])
+                    cov_sqrt = cov_factor.factor(ins['pred_returns'])
+                problem.set_data(a_rl=ins['a_rl'], cov_sqrt=cov_sqrt)
+                res = problem.solve(socp_d=ins['socp_d'])
+            if idx > 0:
+                elapsed = elapsed + time.perf_counter() - start_time
+            res_lst.append(res)
+        return elapsed, res_lst
@@ -22,13 +22,16 @@ import pandas as pd
 import time
 import datetime
 from RL_controller.TD3_controller import TD3PolicyOriginal
+from RL_controller.price_pred import PRICE_PRED_MODEL_DICT
+from RL_controller.cov_estimator import COV_ESTIMATOR_DICT
+from RL_controller.replay_buffer import CompactReplayBuffer, DayIndexedReplayBuffer, DeviceReplayBuffer
 
 class Config():
     def __init__(self, seed_num=2022, current_date=None):
 
         self.notes = 'AAMAS MASA Implementation'
 
-        self.benchmark_algo = os.getenv('BENCHMARK_ALGO', 'MASA-dc') # Algorithm: 'MASA-dc', 'MASA-mlp', 'MASA-lstm', 'TD3-Profit', 'TD3-PR', 'TD3-SR', 'CRP', (Please implement firstly before running 'EG', 'OLMAR', 'PAMR', 'CORN', 'RMR', 'EIIE', 'PPN', 'RAT')
+        self.benchmark_algo = os.getenv('BENCHMARK_ALGO', 'MASA-dc') # Algorithm: 'MASA-dc', 'MASA-mlp', 'MASA-lstm', 'MASA-stf', 'TD3-Profit', 'TD3-PR', 'TD3-SR', 'CRP', (Please implement firstly before running 'EG', 'OLMAR', 'PAMR', 'CORN', 'RMR', 'EIIE', 'PPN', 'RAT')
         self.market_name = os.getenv('MARKET_NAME', 'DJIA') # Financial Index: 'DJIA', 'SP500', 'CSI300', can be 'EURUSD' for FX
         self.topK = int(os.getenv('TOPK', '10')) # Number of assets in a portfolio (10, 20, 30)
         self.num_epochs = int(os.getenv('EPOCHS', '50')) # episode.
@@ -50,7 +53,7 @@ class Config():
         elif 'MASA' in self.benchmark_algo:
             self.rl_model_name = 'TD3' # RL-based agent is implemented by TD3 in the paper, and can be replaced by other RL approaches.
             self.mode = 'RLcontroller' # For the proposed MASA framework
-            self.mktobs_algo = '{}_1'.format(self.benchmark_algo.split('-')[1]) # 'dc_1', 'ma_1', 'mlp_1'
+            self.mktobs_algo = '{}_1'.format(self.benchmark_algo.split('-')[1]) # 'dc_1', 'ma_1', 'mlp_1', 'lstm_1', 'stf_1'
             self.trained_best_model_type = 'js_loss'
         else:
             # Baseline models
@@ -78,7 +81,8 @@ class Config():
         self.period_mode = int(os.getenv('PERIOD_MODE', '1')) 
         self.tmp_name = 'Cls3_{}_{}_K{}_M{}_{}_{}'.format(self.mode, self.mktobs_algo, self.topK, self.period_mode, self.market_name, self.trained_best_model_type)
         self.dataDir = os.getenv('DATA_DIR', './data')
-        self.pricePredModel = 'MA'
+        self.pricePredModel = os.getenv('PRICE_PRED_MODEL', 'MA') # Price prediction model of the controller: 'MA', 'EWMA', 'TREND', 'AR1' (RL_controller/price_pred.py)
+        self.cov_estimator = os.getenv('COV_ESTIMATOR', 'sample') # Covariance estimator of the risk of the env and the controller: 'sample', 'ledoit_wolf', 'ewma', 'const_corr' (RL_controller/cov_estimator.py)
         self.cov_lookback = 5 
         self.norm_method = 'sum'
 
@@ -90,12 +94,36 @@ class Config():
 
         self.risk_market = 0.001 # \Sigma_beta
         self.cbf_gamma = 0.7
+        self.cbf_solver = os.getenv('CBF_SOLVER', 'projection') # Solver of the CBF risk constraint: 'projection' (exact projection, falls back to cvxpy on numerical trouble), 'cvxpy', 'cvxopt', 'auto' (fastest accurate one on sample instances)
+        self.cbf_cvxpy_solver = os.getenv('CBF_CVXPY_SOLVER', 'ECOS') # Solver of the cvxpy backend (and of the fallback of the projection): 'ECOS', 'CLARABEL', 'SCS', 'CVXOPT'
+        self.cbf_tune_cache = os.getenv('CBF_TUNE_CACHE', './res/cbf_solver_tuning.json') # Backend selected by CBF_SOLVER=auto, per number of assets and machine.
+        self.cbf_tune_instances = 200 # Number of sample instances of the solver tuning.
+        self.cbf_precheck = bool(int(os.getenv('CBF_PRECHECK', '1'))) # Precompute the per-day bounds of the minimum achievable risk of each split to skip hopeless controller solves.
+        self.ctrl_mode = os.getenv('CTRL_MODE', 'monolithic') # 'monolithic' (one CBF problem over all assets), 'cluster' (per-cluster problems and a top-level allocation, for very large portfolios)
+        self.ctrl_cluster_num = int(os.getenv('CTRL_CLUSTER_NUM', '0')) # Number of asset clusters of the cluster mode, 0: round(sqrt(topK)). Ignored if the data has a 'sector' column.
+        self.ctrl_cluster_workers = int(os.getenv('CTRL_CLUSTER_WORKERS', '0')) # Worker processes of the per-cluster solves, 0: inline.
+        self.ctrl_risk_model = os.getenv('CTRL_RISK_MODEL', 'auto') # 'dense' (sample covariance), 'factor' (FactorRiskModel, low rank plus diagonal), 'auto' (factor if topK >= risk_factor_min_stocks)
+        self.risk_factor_num = int(os.getenv('RISK_FACTOR_NUM', '0')) # Principal components of the factor risk model per day, 0: all components of the window (exact).
+        self.risk_factor_min_stocks = 100 # Smallest universe of the factor risk model in 'auto'.
+        self.ctrl_fidelity = os.getenv('CTRL_FIDELITY', 'exact') # 'exact', 'train_approx' (approximate projection in the training env, exact in valid/test)
+        self.ctrl_approx_tol = 1e-3 # Stopping tolerance of the approximate projection, w'cov w >= (1 - tol) * socp_d^2 when the cone is active.
+        self.ctrl_approx_iter = 5 # Regula falsi steps of the approximate projection.
+        self.ctrl_audit_rate = float(os.getenv('CTRL_AUDIT_RATE', '0.05')) # Share of the days of the approximate controller also solved exactly and logged.
+        self.ctrl_time_budget = float(os.getenv('CTRL_TIME_BUDGET', '0')) # Seconds of the CBF solve of a day, 0: no limit. On time-out the controller returns a fallback action (solvable_flag 2).
+        self.ctrl_workers = int(os.getenv('CTRL_WORKERS', '0')) # Worker processes (or threads) solving the controller alongside the training loop and the evaluation, 0: inline.
+        self.ctrl_worker_backend = os.getenv('CTRL_WORKER_BACKEND', 'process') # 'process', 'thread'
+        self.eval_async = bool(int(os.getenv('EVAL_ASYNC', '0'))) # Evaluate the valid and test sets in a background process while the training goes on.
+        self.train_num_envs = int(os.getenv('TRAIN_NUM_ENVS', '1')) # Training envs collecting the rollouts of the RL agent together.
+        self.train_env_shard = os.getenv('TRAIN_ENV_SHARD', 'seed') # 'seed' (every env runs the whole training period with its own seed), 'time' (env k runs the k-th contiguous segment of the training period)
         # TD3 config
         self.reward_scaling = 1 
         self.learning_rate = 0.0001 
         self.batch_size = 50
         self.gradient_steps = 1 
+        self.replay_buffer = os.getenv('REPLAY_BUFFER', 'default') # 'default' (ReplayBuffer of 1e6 transitions), 'compact' (CompactReplayBuffer sized to num_epochs * totalTradeDay), 'day' (DayIndexedReplayBuffer, same size, market features by day), 'device' (DeviceReplayBuffer, same size, torch tensors on the training device)
+        self.replay_static_fp16 = bool(int(os.getenv('REPLAY_STATIC_FP16', '0'))) # Store the market features of the observations in float16 in the compact replay buffer.
         self.ars_trial = 10
+        self.ars_mode = os.getenv('ARS_MODE', 'schedule') # Adaptive risk relaxation: 'schedule' (raise the bound by fixed steps at each trial), 'minrisk' (jump to the smallest bound admitting the minimum-variance portfolio)
 
         if current_date is None:
             self.cur_datetime = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
@@ -168,6 +196,51 @@ class Config():
             self.enable_market_observer = False
             self.is_enable_dynamic_risk_bound = False
 
+        if self.pricePredModel not in PRICE_PRED_MODEL_DICT.keys():
+            raise ValueError("Cannot find the price prediction model [{}], it should be in {}.".format(self.pricePredModel, list(PRICE_PRED_MODEL_DICT.keys())))
+
+        if self.cov_estimator not in COV_ESTIMATOR_DICT.keys():
+            raise ValueError("Cannot find the covariance estimator [{}], it should be in {}.".format(self.cov_estimator, list(COV_ESTIMATOR_DICT.keys())))
+
+        if self.ars_mode not in ['schedule', 'minrisk']:
+            raise ValueError("Unknown ARS mode [{}], it should be in ['schedule', 'minrisk'].".format(self.ars_mode))
+
+        if self.cbf_solver not in ['projection', 'cvxpy', 'cvxopt', 'auto']:
+            raise ValueError("Unknown CBF solver [{}], it should be in ['projection', 'cvxpy', 'cvxopt', 'auto'].".format(self.cbf_solver))
+
+        if self.ctrl_mode not in ['monolithic', 'cluster']:
+            raise ValueError("Unknown controller mode [{}], it should be in ['monolithic', 'cluster'].".format(self.ctrl_mode))
+
+        if (self.ctrl_cluster_num < 0) or (self.ctrl_cluster_workers < 0):
+            raise ValueError("The number of controller clusters [{}] and cluster workers [{}] should not be negative.".format(self.ctrl_cluster_num, self.ctrl_cluster_workers))
+
+        if self.ctrl_risk_model not in ['dense', 'factor', 'auto']:
+            raise ValueError("Unknown controller risk model [{}], it should be in ['dense', 'factor', 'auto'].".format(self.ctrl_risk_model))
+
+        if self.risk_factor_num < 0:
+            raise ValueError("The number of risk factors [{}] should not be negative.".format(self.risk_factor_num))
+
+        if self.ctrl_fidelity not in ['exact', 'train_approx']:
+            raise ValueError("Unknown controller fidelity [{}], it should be in ['exact', 'train_approx'].".format(self.ctrl_fidelity))
+
+        if self.ctrl_time_budget < 0:
+            raise ValueError("The time budget of the controller [{}] should not be negative.".format(self.ctrl_time_budget))
+
+        if self.ctrl_workers < 0:
+            raise ValueError("The number of controller workers [{}] should not be negative.".format(self.ctrl_workers))
+
+        if self.ctrl_worker_backend not in ['process', 'thread']:
+            raise ValueError("Unknown controller worker backend [{}], it should be in ['process', 'thread'].".format(self.ctrl_worker_backend))
+
+        if self.replay_buffer not in ['default', 'compact', 'day', 'device']:
+            raise ValueError("Unknown replay buffer [{}], it should be in ['default', 'compact', 'day', 'device'].".format(self.replay_buffer))
+
+        if self.train_num_envs < 1:
+            raise ValueError("The number of training envs [{}] should be at least 1.".format(self.train_num_envs))
+
+        if self.train_env_shard not in ['seed', 'time']:
+            raise ValueError("Unknown sharding of the training envs [{}], it should be in ['seed', 'time'].".format(self.train_env_shard))
+
         if self.risk_default <= self.risk_market:
             raise ValueError("The boundary of safe risk[{}] should not be less than/ equal to the market risk[{}].".format(self.risk_default, self.risk_market))
 
@@ -231,6 +304,17 @@ class Config():
             'optimize_memory_usage': False, 'tensorboard_log': None, 'policy_kwargs': None, 
             'verbose': 1, 'seed': self.seed_num, 'device': 'auto', '_init_setup_model': True,
         }
+        if self.replay_buffer == 'compact':
+            # The buffer_size is set from the training envs in entrance.py, the end of the state is the portfolio value (and the hidden vector of the market observer).
+            base_para['replay_buffer_class'] = CompactReplayBuffer
+            base_para['replay_buffer_kwargs'] = {'dynamic_dim': 1 + (self.topK if self.enable_market_observer else 0), 'static_fp16': self.replay_static_fp16}
+        elif self.replay_buffer == 'day':
+            # The day feature tables of the training envs are added in entrance.py.
+            base_para['replay_buffer_class'] = DayIndexedReplayBuffer
+            base_para['replay_buffer_kwargs'] = {'dynamic_dim': 1 + (self.topK if self.enable_market_observer else 0)}
+        elif self.replay_buffer == 'device':
+            base_para['replay_buffer_class'] = DeviceReplayBuffer
+            base_para['replay_buffer_kwargs'] = {}
         algo_para = {
             'TD3': {'policy_delay': 2, 'target_policy_noise': 0.2, 'target_noise_clip': 0.5,},
             'SAC': {'ent_coef': 'auto', 'target_update_interval': 1, 'target_entropy': 'auto', 'use_sde': False, 'sde_sample_freq': -1, 'use_sde_at_warmup': False,},
@@ -260,9 +344,9 @@ class Config():
         log_str = log_str + para_str
         para_str = 'trade_pattern: {} \n'.format(self.trade_pattern)
         log_str = log_str + para_str
-        para_str = 'period_mode: {}, num_epochs: {}, cov_lookback: {}, norm_method: {}, benchmark_algo: {}, trained_best_model_type: {}, pricePredModel: {}, \n'.format(self.period_mode, self.num_epochs, self.cov_lookback, self.norm_method, self.benchmark_algo, self.trained_best_model_type, self.pricePredModel)
+        para_str = 'period_mode: {}, num_epochs: {}, cov_lookback: {}, norm_method: {}, benchmark_algo: {}, trained_best_model_type: {}, pricePredModel: {}, cov_estimator: {}, \n'.format(self.period_mode, self.num_epochs, self.cov_lookback, self.norm_method, self.benchmark_algo, self.trained_best_model_type, self.pricePredModel, self.cov_estimator)
         log_str = log_str + para_str
-        para_str = 'is_enable_dynamic_risk_bound: {}, risk_market: {}, risk_default: {}, cbf_gamma: {}, ars_trial: {} \n'.format(self.is_enable_dynamic_risk_bound, self.risk_market, self.risk_default, self.cbf_gamma, self.ars_trial)
+        para_str = 'is_enable_dynamic_risk_bound: {}, risk_market: {}, risk_default: {}, cbf_gamma: {}, ars_trial: {}, ars_mode: {}, cbf_solver: {} ({}), cbf_precheck: {}, ctrl_mode: {}, ctrl_risk_model: {} (k={}), ctrl_fidelity: {}, ctrl_time_budget: {}, ctrl_workers: {} ({}), train_num_envs: {} ({}), eval_async: {}, replay_buffer: {} (fp16: {}) \n'.format(self.is_enable_dynamic_risk_bound, self.risk_market, self.risk_default, self.cbf_gamma, self.ars_trial, self.ars_mode, self.cbf_solver, self.cbf_cvxpy_solver, self.cbf_precheck, self.ctrl_mode, self.ctrl_risk_model, self.risk_factor_num, self.ctrl_fidelity, self.ctrl_time_budget, self.ctrl_workers, self.ctrl_worker_backend, self.train_num_envs, self.train_env_shard, self.eval_async, self.replay_buffer, self.replay_static_fp16)
         log_str = log_str + para_str
         para_str = 'cur_datetime: {}, res_dir: {}, tradeDays_per_year: {}, tradeDays_per_month: {}, seed_num: {}, \n'.format(self.cur_datetime, self.res_dir, self.tradeDays_per_year, self.tradeDays_per_month, self.seed_num)
         log_str = log_str + para_str
@@ -34,8 +34,27 @@ from utils.tradeEnv import StockPortfolioEnv, StockPortfolioEnv_cash
 from utils.model_pool import model_select, benchmark_algo_select
 from utils.callback_func import PoCallback
 from RL_controller.market_obs import MarketObserver, MarketObserver_Algorithmic
+from stable_baselines3.common.vec_env import DummyVecEnv
+from stable_baselines3.common.monitor import Monitor
 import timeit
 
+def get_model_para(config, total_timesteps, env_train_lst):
+    """
+    Parameters of the RL model, config.model_para with the compact (day-indexed, device) replay buffer sized to the transitions of the training
+    (+ one row per env for the next observation of the last transition). The day-indexed buffer gets the day feature tables of the training envs,
+    envs of the same data share one table.
+    """
+    model_para_dict = dict(config.model_para)
+    if ('replay_buffer_class' in model_para_dict) and (config.replay_buffer in ['compact', 'day', 'device']):
+        model_para_dict['buffer_size'] = int(total_timesteps + 2 * len(env_train_lst))
+    if ('replay_buffer_class' in model_para_dict) and (config.replay_buffer == 'day'):
+        table_dict = {}
+        for env in env_train_lst:
+            if id(env.rawdata) not in table_dict:
+                table_dict[id(env.rawdata)] = env.get_day_feat_table()
+        model_para_dict['replay_buffer_kwargs'] = {**model_para_dict['replay_buffer_kwargs'], 'day_feat_table_lst': [table_dict[id(env.rawdata)] for env in env_train_lst]}
+    return model_para_dict
+
 def RLonly(config):
     # For running the single-agent RL-based framework (TD3-Profit, TD3-PR, TD3-SR)
     # Get dataset
@@ -78,9 +97,9 @@ def RLonly(config):
 
     # Load RL model
     ModelCls = model_select(model_name=config.rl_model_name, mode=config.mode)
-    model_para_dict = config.model_para
-    po_model = ModelCls(env=env_train, **model_para_dict) # Create instance 
     total_timesteps = int(config.num_epochs * env_train.totalTradeDay)
+    model_para_dict = get_model_para(config=config, total_timesteps=total_timesteps, env_train_lst=[env_train])
+    po_model = ModelCls(env=env_train, **model_para_dict) # Create instance 
     print('Training Start', flush=True)
     log_interval = 10
     callback1 =PoCallback(config=config, train_env=env_train, valid_env=env_valid, test_env=env_test)
@@ -101,6 +120,34 @@ def RLonly(config):
     print("Training Done...", flush=True)
 
 
+def gen_train_envs(config, data_dict, stock_num, tech_indicator_lst, mkt_observer=None):
+    """
+    config.train_num_envs training envs of the MASA framework, the first one is the main env.
+    'seed': every env runs the whole training period, env k with the seed seed_num + k.
+    'time': env k runs the k-th contiguous segment of the trading days of the training period.
+    The envs train one market observer model (MarketObserver.fork), each one with its own episode buffers, and env k > 0 writes its results with the tag 'env{k}'.
+    """
+    num_envs = config.train_num_envs
+    if (num_envs > 1) and (config.train_env_shard == 'time'):
+        date_lst = np.sort(data_dict['train']['date'].unique())
+        if len(date_lst) < 2 * num_envs:
+            raise ValueError("The training period [{} days] is too short for [{}] time-sharded envs.".format(len(date_lst), num_envs))
+        rawdata_lst = [data_dict['train'][data_dict['train']['date'].isin(date_shard)].copy() for date_shard in np.array_split(date_lst, num_envs)]
+    else:
+        rawdata_lst = [data_dict['train']] * num_envs
+    env_train_lst = []
+    for idx, rawdata in enumerate(rawdata_lst):
+        trainInvest_env_para = copy.deepcopy(config.invest_env_para)
+        trainInvest_env_para['seed_num'] = trainInvest_env_para['seed_num'] + idx
+        env_mkt_observer = mkt_observer if (idx == 0) or (mkt_observer is None) else mkt_observer.fork()
+        env_train = StockPortfolioEnv(
+            config=config, rawdata=rawdata, mode='train', stock_num=stock_num, action_dim=stock_num, 
+            tech_indicator_lst=tech_indicator_lst, extra_data=data_dict['extra_train'], 
+            mkt_observer=env_mkt_observer, env_tag=None if idx == 0 else 'env{}'.format(idx), **trainInvest_env_para
+        )
+        env_train_lst.append(env_train)
+    return env_train_lst
+
 def RLcontroller(config):
     # For running the MASA framework
     # Get dataset
@@ -149,17 +196,17 @@ def RLcontroller(config):
 
     ModelCls = model_select(model_name=config.rl_model_name, mode=config.mode)
     # Initialize environment
-    trainInvest_env_para = config.invest_env_para 
-    env_train = StockPortfolioEnv(
-        config=config, rawdata=data_dict['train'], mode='train', stock_num=stock_num, action_dim=stock_num, 
-        tech_indicator_lst=tech_indicator_lst, extra_data=data_dict['extra_train'], 
-        mkt_observer=mkt_observer, **trainInvest_env_para
-    )
+    env_train_lst = gen_train_envs(config=config, data_dict=data_dict, stock_num=stock_num, tech_indicator_lst=tech_indicator_lst, mkt_observer=mkt_observer)
+    env_train = env_train_lst[0] # The main training env, its episodes trigger the evaluation.
+    if len(env_train_lst) > 1:
+        rollout_env = DummyVecEnv([(lambda env=env: Monitor(env)) for env in env_train_lst])
+    else:
+        rollout_env = env_train
 
     # Load RL model
-    model_para_dict = config.model_para
-    po_model = ModelCls(env=env_train, **model_para_dict) 
-    total_timesteps = int(config.num_epochs * env_train.totalTradeDay)
+    total_timesteps = int(config.num_epochs * np.sum([env.totalTradeDay for env in env_train_lst]))
+    model_para_dict = get_model_para(config=config, total_timesteps=total_timesteps, env_train_lst=env_train_lst)
+    po_model = ModelCls(env=rollout_env, **model_para_dict) 
     print('Training Start', flush=True)
     log_interval = 10
     callback1 = PoCallback(config=config, train_env=env_train, valid_env=env_valid, test_env=env_test)
@@ -0,0 +1,29 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         conftest.py
+ Description:  Shared fixtures of the tests, run from the root of the repository with python -m pytest tests.
+ Author:       MASA
+---------------------------------
+'''
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def make_config(tmp_path, monkeypatch):
+    """
+    Config(**env_vars) of the repository, with its result directories under tmp_path.
+    """
+    monkeypatch.chdir(tmp_path)
+    def _make_config(**env_vars):
+        for key, val in env_vars.items():
+            monkeypatch.setenv(key, str(val))
+        from config import Config
+        return Config(seed_num=1, current_date='pytest')
+    return _make_config
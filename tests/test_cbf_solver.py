@@ -0,0 +1,111 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         test_cbf_solver.py
+ Description:  The CBF projection solvers against the CBF-SOCP solved by cvxpy (ECOS) on random instances.
+ Author:       MASA
+---------------------------------
+'''
+
+import cvxpy as cp
+import numpy as np
+import pytest
+from RL_controller.cbf_solver import CbfProjectionSolver, CbfBatchProjectionSolver
+
+WEIGHT_TOL = 1e-4
+
+def gen_instance(rng, N, T=20):
+    """
+    (a_rl, cov, min_risk, free_risk): the RL action, the covariance of a random return window, the long-only minimum risk and the
+    risk of the projection of a_rl onto the simplex (the cone is inactive above it).
+    """
+    returns = rng.standard_normal((N, T)) * rng.uniform(0.005, 0.03, (N, 1))
+    cov = np.cov(returns) + 1e-6 * np.eye(N)
+    a_rl = rng.uniform(-0.5, 1.0, N)
+    min_risk = np.sqrt(solve_reference(a_rl=np.zeros(N), cov=cov, socp_d=None)[2])
+    w_free = solve_reference(a_rl=a_rl, cov=cov, socp_d=np.inf)[1]
+    free_risk = np.sqrt(w_free @ cov @ w_free)
+    return a_rl, cov, min_risk, free_risk
+
+def solve_reference(a_rl, cov, socp_d):
+    """
+    (status, w, objective) of min ||w - a_rl||^2 s.t. w on the simplex, ||L'w|| <= socp_d by ECOS. socp_d None minimises the risk w'cov w instead.
+    """
+    N = len(a_rl)
+    w = cp.Variable(N)
+    constraints = [cp.sum(w) == 1, w >= 0]
+    if socp_d is None:
+        objective = cp.quad_form(w, cov)
+    else:
+        objective = cp.sum_squares(w - a_rl)
+        if np.isfinite(socp_d):
+            constraints.append(cp.SOC(cp.Constant(socp_d), np.linalg.cholesky(cov).T @ w))
+    prob = cp.Problem(cp.Minimize(objective), constraints)
+    prob.solve(solver=cp.ECOS, abstol=1e-9, reltol=1e-9, feastol=1e-9, max_iters=500)
+    status = 'infeasible' if prob.status in [cp.INFEASIBLE, cp.INFEASIBLE_INACCURATE] else prob.status
+    return status, w.value, prob.value
+
+def gen_cases(seed, num_cases, N):
+    """
+    Random instances with the cone active (socp_d between the minimum risk and the free risk), inactive, and infeasible.
+    """
+    rng = np.random.default_rng(seed)
+    case_lst = []
+    for idx in range(num_cases):
+        a_rl, cov, min_risk, free_risk = gen_instance(rng=rng, N=N)
+        kind = idx % 3
+        if kind == 0:
+            socp_d = min_risk + rng.uniform(0.05, 0.95) * (free_risk - min_risk)
+        elif kind == 1:
+            socp_d = free_risk * 1.5
+        else:
+            socp_d = min_risk * 0.8
+        case_lst.append((a_rl, cov, socp_d))
+    return case_lst
+
+@pytest.mark.parametrize('N', [1, 2, 5, 12])
+def test_projection_solver_matches_ecos(N):
+    solver = CbfProjectionSolver(stock_num=N)
+    for a_rl, cov, socp_d in gen_cases(seed=N, num_cases=15, N=N):
+        ref_status, ref_w, _ = solve_reference(a_rl=a_rl, cov=cov, socp_d=socp_d)
+        status, a_cbf = solver.solve(a_rl, cov, socp_d)
+        if ref_status == 'infeasible':
+            assert status == 'infeasible'
+            continue
+        assert status == 'optimal'
+        w = a_rl + a_cbf
+        np.testing.assert_allclose(w, ref_w, atol=WEIGHT_TOL)
+        assert abs(np.sum(w) - 1) < 1e-8 and np.min(w) > -1e-10
+        assert w @ cov @ w <= socp_d**2 * (1 + 1e-6)
+
+def test_projection_solver_warm_start_path():
+    # Consecutive solves of nearby problems with the warm start give the same answers as cold solves.
+    N = 8
+    rng = np.random.default_rng(7)
+    a_rl, cov, min_risk, free_risk = gen_instance(rng=rng, N=N)
+    warm_solver = CbfProjectionSolver(stock_num=N)
+    for step in range(10):
+        a_rl_t = a_rl + 0.02 * rng.standard_normal(N)
+        socp_d = min_risk + (0.3 + 0.02 * step) * (free_risk - min_risk)
+        status, a_cbf = warm_solver.solve(a_rl_t, cov, socp_d)
+        ref_status, ref_w, _ = solve_reference(a_rl=a_rl_t, cov=cov, socp_d=socp_d)
+        assert (status, ref_status) == ('optimal', 'optimal')
+        np.testing.assert_allclose(a_rl_t + a_cbf, ref_w, atol=WEIGHT_TOL)
+
+@pytest.mark.parametrize('N', [3, 10])
+def test_batch_solver_matches_ecos(N):
+    case_lst = gen_cases(seed=100 + N, num_cases=24, N=N)
+    a_rl = np.array([case[0] for case in case_lst])
+    cov = np.array([case[1] for case in case_lst])
+    socp_d = np.array([case[2] for case in case_lst])
+    status, a_cbf = CbfBatchProjectionSolver(stock_num=N).solve(a_rl, cov, socp_d)
+    assert np.shape(status) == (len(case_lst), ) and np.shape(a_cbf) == (len(case_lst), N)
+    for idx, (a_rl_b, cov_b, socp_d_b) in enumerate(case_lst):
+        ref_status, ref_w, _ = solve_reference(a_rl=a_rl_b, cov=cov_b, socp_d=socp_d_b)
+        if ref_status == 'infeasible':
+            assert status[idx] == 'infeasible'
+            continue
+        assert status[idx] == 'optimal'
+        np.testing.assert_allclose(a_rl_b + a_cbf[idx], ref_w, atol=WEIGHT_TOL)
@@ -0,0 +1,41 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         test_cov_estimator.py
+ Description:  The covariance estimators of cov_estimator.py on random return windows.
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+import pytest
+from RL_controller.cov_estimator import COV_ESTIMATOR_DICT, gen_cov_table
+
+def gen_windows(seed, days=6, N=5, T=20):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((days, N, T)) * rng.uniform(0.005, 0.03, (1, N, 1))
+
+def test_sample_matches_np_cov():
+    windows = gen_windows(seed=0)
+    cov = COV_ESTIMATOR_DICT['sample'](windows)
+    ref_cov = np.array([np.cov(window) for window in windows])
+    np.testing.assert_allclose(cov, ref_cov, rtol=1e-12, atol=1e-18)
+
+def test_sample_single_window():
+    # A (N, T) window without the leading days axis.
+    window = gen_windows(seed=1)[0]
+    np.testing.assert_allclose(COV_ESTIMATOR_DICT['sample'](window), np.cov(window), rtol=1e-12, atol=1e-18)
+
+@pytest.mark.parametrize('estimator_name', list(COV_ESTIMATOR_DICT.keys()))
+def test_estimators_are_covariances(estimator_name):
+    windows = gen_windows(seed=2)
+    cov = gen_cov_table(estimator_name=estimator_name, windows=windows)
+    assert cov.shape == (6, 5, 5)
+    np.testing.assert_allclose(cov, np.swapaxes(cov, -1, -2), atol=1e-18)
+    assert np.min(np.linalg.eigvalsh(cov)) > -1e-15
+
+def test_unknown_estimator():
+    with pytest.raises(ValueError):
+        gen_cov_table(estimator_name='unknown', windows=gen_windows(seed=3))
@@ -0,0 +1,60 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         test_market_obs.py
+ Description:  Market observers of several training envs (MarketObserver.fork).
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+import torch as th
+from RL_controller.market_obs import MarketObserver
+
+def run_days(mkt_observer, config, rng, num_days, is_start=False):
+    # One trading day: the reward of the previous hidden vector, then the prediction of the day, as StockPortfolioEnv.run_mkt_observer.
+    num_features = len(config.use_features)
+    for iday in range(num_days):
+        if not (is_start and (iday == 0)):
+            mkt_observer.update_hidden_vec_reward(mode='train', rate_of_price_change=1 + 0.01 * rng.standard_normal((1, config.topK)), mkt_direction=np.array([rng.integers(3)]))
+        finemkt_feat = rng.standard_normal((1, num_features, config.fine_window_size))
+        finestock_feat = rng.standard_normal((1, num_features, config.topK, config.fine_window_size))
+        mkt_observer.predict(finemkt_feat=finemkt_feat, finestock_feat=finestock_feat, mode='train')
+
+def test_forked_observers_across_episode_boundary(make_config):
+    config = make_config(BENCHMARK_ALGO='MASA-mlp', TRAIN_NUM_ENVS=2)
+    th.manual_seed(0)
+    rng = np.random.default_rng(0)
+    main_observer = MarketObserver(config=config, action_dim=config.topK)
+    init_state = main_observer.state_dict()
+    fork_observer = main_observer.fork()
+    assert fork_observer.mkt_obs_model is not main_observer.mkt_obs_model
+    # Two envs in lockstep, the episode of env 1 is one day longer and starts before env 0 steps the optimizer.
+    run_days(main_observer, config, rng, 5, is_start=True)
+    run_days(fork_observer, config, rng, 5, is_start=True)
+    main_observer.train(mode='train')
+    trained_state = main_observer.state_dict()
+    assert any(not th.equal(init_state[k], trained_state[k]) for k in init_state)
+    # The next episode of env 0 runs on the updated weights, the pending episode of env 1 still trains on the weights it was run with.
+    run_days(main_observer, config, rng, 3, is_start=True)
+    run_days(fork_observer, config, rng, 1)
+    fork_observer.train(mode='train')
+    run_days(main_observer, config, rng, 2)
+    main_observer.train(mode='train')
+    # Both envs train one shared model and pick up its weights at their reset.
+    for k, v in main_observer.state_dict().items():
+        assert th.equal(v, main_observer.mkt_obs_model.state_dict()[k].cpu())
+        assert th.equal(v, fork_observer.state_dict()[k])
+    fork_observer.reset()
+    for k, v in main_observer.state_dict().items():
+        assert th.equal(v, fork_observer.mkt_obs_model.state_dict()[k].cpu())
+
+def test_single_observer_trains_in_place(make_config):
+    config = make_config(BENCHMARK_ALGO='MASA-mlp')
+    th.manual_seed(0)
+    mkt_observer = MarketObserver(config=config, action_dim=config.topK)
+    run_days(mkt_observer, config, np.random.default_rng(0), 4, is_start=True)
+    mkt_observer.train(mode='train')
+    assert mkt_observer.shared_model is None
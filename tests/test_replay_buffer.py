@@ -0,0 +1,162 @@
+#！/usr/bin/python
+# -*- coding: utf-8 -*-#
+
+'''
+---------------------------------
+ Name:         test_replay_buffer.py
+ Description:  The replay buffers of replay_buffer.py against the ReplayBuffer of stable-baselines3 on synthetic episodes of several envs.
+ Author:       MASA
+---------------------------------
+'''
+
+import numpy as np
+import pytest
+import torch as th
+from gym import spaces
+from stable_baselines3.common.buffers import ReplayBuffer
+from RL_controller.replay_buffer import CompactReplayBuffer, DayIndexedReplayBuffer, DeviceReplayBuffer
+
+STATIC_DIM, DYNAMIC_DIM, ACTION_DIM = 6, 3, 4
+OBS_SPACE = spaces.Box(low=-np.inf, high=np.inf, shape=(STATIC_DIM + DYNAMIC_DIM, ), dtype=np.float32)
+ACTION_SPACE = spaces.Box(low=-1, high=1, shape=(ACTION_DIM, ), dtype=np.float32)
+
+class SyntheticEnvs:
+    """
+    n_envs envs in lockstep, env k runs episodes of ep_len_lst[k] days. The observation is (market features of the day, dynamic block).
+    As StockPortfolioEnv, the terminal step stays on the last day, the step info holds the days of the observation and of the next one.
+    """
+    def __init__(self, ep_len_lst, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.ep_len_lst = ep_len_lst
+        self.day_feat_table_lst = [self.rng.standard_normal((ep_len, STATIC_DIM)).astype(np.float32) for ep_len in ep_len_lst]
+        self.day_lst = [0] * len(ep_len_lst)
+        self.obs = np.array([self.get_obs(k) for k in range(len(ep_len_lst))])
+
+    def get_obs(self, k):
+        return np.concatenate([self.day_feat_table_lst[k][self.day_lst[k]], self.rng.standard_normal(DYNAMIC_DIM).astype(np.float32)])
+
+    def step(self):
+        """
+        (obs, next_obs, action, reward, done, infos) of one transition of all envs, next_obs is the terminal observation after a done.
+        """
+        n_envs = len(self.ep_len_lst)
+        obs = self.obs
+        action = self.rng.uniform(-1, 1, (n_envs, ACTION_DIM)).astype(np.float32)
+        reward = self.rng.standard_normal(n_envs).astype(np.float32)
+        done = np.zeros(n_envs, dtype=bool)
+        next_obs, infos, last_obs = [], [], []
+        for k in range(n_envs):
+            obs_day = self.day_lst[k]
+            done[k] = obs_day == self.ep_len_lst[k] - 1
+            if not done[k]:
+                self.day_lst[k] = obs_day + 1
+            next_obs.append(self.get_obs(k))
+            infos.append({'obs_trade_day': obs_day, 'trade_day': self.day_lst[k]})
+            if done[k]:
+                self.day_lst[k] = 0 # Reset by the VecEnv
+                last_obs.append(self.get_obs(k))
+            else:
+                last_obs.append(next_obs[-1])
+        self.obs = np.array(last_obs)
+        return obs, np.array(next_obs), action, reward, done, infos
+
+def make_buffer(name, buffer_size, synthetic_envs):
+    n_envs = len(synthetic_envs.ep_len_lst)
+    if name == 'compact':
+        return CompactReplayBuffer(buffer_size, OBS_SPACE, ACTION_SPACE, device='cpu', n_envs=n_envs, dynamic_dim=DYNAMIC_DIM)
+    if name == 'day':
+        return DayIndexedReplayBuffer(buffer_size, OBS_SPACE, ACTION_SPACE, device='cpu', n_envs=n_envs, dynamic_dim=DYNAMIC_DIM,
+                                      day_feat_table_lst=synthetic_envs.day_feat_table_lst)
+    if name == 'device':
+        return DeviceReplayBuffer(buffer_size, OBS_SPACE, ACTION_SPACE, device='cpu', n_envs=n_envs)
+    raise ValueError(name)
+
+def fill(buffer_lst, synthetic_envs, num_steps):
+    """
+    Add num_steps transitions to every buffer, returns the transitions by the bytes of their action.
+    """
+    transition_dict = {}
+    for _ in range(num_steps):
+        obs, next_obs, action, reward, done, infos = synthetic_envs.step()
+        for buffer in buffer_lst:
+            buffer.add(obs, next_obs, action, reward, done, infos)
+        for k in range(len(action)):
+            transition_dict[action[k].tobytes()] = (obs[k], next_obs[k], reward[k], done[k])
+    return transition_dict
+
+def to_numpy(samples):
+    return [th.as_tensor(x).cpu().numpy() for x in samples]
+
+@pytest.mark.parametrize('name', ['compact', 'day'])
+def test_get_samples_match_replay_buffer(name):
+    synthetic_envs = SyntheticEnvs(ep_len_lst=[5, 7])
+    num_steps = 40
+    ref_buffer = ReplayBuffer(2 * num_steps, OBS_SPACE, ACTION_SPACE, device='cpu', n_envs=2, handle_timeout_termination=False)
+    buffer = make_buffer(name, 2 * num_steps + 4, synthetic_envs)
+    fill([ref_buffer, buffer], synthetic_envs, num_steps)
+    batch_inds = np.arange(num_steps)
+    np.random.seed(0)
+    ref_obs, ref_actions, ref_next_obs, ref_dones, ref_rewards = to_numpy(ref_buffer._get_samples(batch_inds))
+    np.random.seed(0)
+    obs, actions, next_obs, dones, rewards = to_numpy(buffer._get_samples(batch_inds))
+    np.testing.assert_array_equal(obs, ref_obs)
+    np.testing.assert_array_equal(actions, ref_actions)
+    np.testing.assert_array_equal(rewards, ref_rewards)
+    np.testing.assert_array_equal(dones, ref_dones)
+    # After a done the next slot holds the reset observation, the target of a done transition does not use the next observation.
+    not_done = ref_dones[:, 0] == 0
+    assert np.any(~not_done)
+    np.testing.assert_array_equal(next_obs[not_done], ref_next_obs[not_done])
+
+def test_device_buffer_matches_replay_buffer():
+    synthetic_envs = SyntheticEnvs(ep_len_lst=[6])
+    num_steps = 30
+    ref_buffer = ReplayBuffer(num_steps, OBS_SPACE, ACTION_SPACE, device='cpu', n_envs=1, handle_timeout_termination=False)
+    buffer = make_buffer('device', num_steps + 2, synthetic_envs)
+    fill([ref_buffer, buffer], synthetic_envs, num_steps)
+    batch_inds = np.arange(num_steps)
+    ref_obs, ref_actions, ref_next_obs, ref_dones, ref_rewards = to_numpy(ref_buffer._get_samples(batch_inds))
+    obs, actions, next_obs, dones, rewards = to_numpy(buffer._get_samples(batch_inds))
+    np.testing.assert_array_equal(obs, ref_obs)
+    np.testing.assert_array_equal(actions, ref_actions)
+    np.testing.assert_array_equal(rewards, ref_rewards)
+    np.testing.assert_array_equal(dones, ref_dones)
+    not_done = ref_dones[:, 0] == 0
+    np.testing.assert_array_equal(next_obs[not_done], ref_next_obs[not_done])
+
+@pytest.mark.parametrize('name', ['compact', 'day', 'device'])
+@pytest.mark.parametrize('num_steps', [25, 90])
+def test_sample_returns_stored_transitions(name, num_steps):
+    # buffer_size 2 * 40: 90 steps wrap around, the oldest transitions are overwritten and the one at pos is invalid.
+    synthetic_envs = SyntheticEnvs(ep_len_lst=[5, 7], seed=1)
+    buffer = make_buffer(name, 2 * 40, synthetic_envs)
+    ref_buffer = ReplayBuffer(2 * 40, OBS_SPACE, ACTION_SPACE, device='cpu', n_envs=2, optimize_memory_usage=True, handle_timeout_termination=False)
+    transition_dict = fill([buffer, ref_buffer], synthetic_envs, num_steps)
+    assert (buffer.pos, buffer.full) == (ref_buffer.pos, ref_buffer.full)
+    np.random.seed(2)
+    th.manual_seed(2)
+    obs, actions, next_obs, dones, rewards = to_numpy(buffer.sample(512))
+    ref_actions = to_numpy(ref_buffer.sample(4096))[1]
+    ref_action_set = {action.tobytes() for action in ref_actions}
+    for idx in range(len(actions)):
+        assert actions[idx].tobytes() in ref_action_set # Only the transitions ReplayBuffer can sample.
+        ref_obs, ref_next_obs, ref_reward, ref_done = transition_dict[actions[idx].tobytes()]
+        np.testing.assert_array_equal(obs[idx], ref_obs)
+        assert rewards[idx, 0] == ref_reward
+        assert dones[idx, 0] == ref_done
+        if not ref_done:
+            np.testing.assert_array_equal(next_obs[idx], ref_next_obs)
+
+def test_compact_buffer_static_fp16():
+    synthetic_envs = SyntheticEnvs(ep_len_lst=[5, 7])
+    ref_buffer = ReplayBuffer(40, OBS_SPACE, ACTION_SPACE, device='cpu', n_envs=2, handle_timeout_termination=False)
+    buffer = CompactReplayBuffer(44, OBS_SPACE, ACTION_SPACE, device='cpu', n_envs=2, dynamic_dim=DYNAMIC_DIM, static_fp16=True)
+    fill([ref_buffer, buffer], synthetic_envs, 20)
+    np.random.seed(0)
+    ref_obs = to_numpy(ref_buffer._get_samples(np.arange(20)))[0]
+    np.random.seed(0)
+    obs = to_numpy(buffer._get_samples(np.arange(20)))[0]
+    # float16 market features, the dynamic block is exact.
+    np.testing.assert_allclose(obs[:, :STATIC_DIM], ref_obs[:, :STATIC_DIM], rtol=1e-3, atol=1e-3)
+    np.testing.assert_array_equal(obs[:, STATIC_DIM:], ref_obs[:, STATIC_DIM:])
+    assert obs.dtype == np.float32
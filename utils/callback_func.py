@@ -10,6 +10,11 @@ import numpy as np
 import os
 import pandas as pd
 import time
+import io
+import copy
+import atexit
+import multiprocessing
+import torch as th
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
@@ -18,6 +23,88 @@ from .model_pool import model_select
 import sys
 sys.path.append('..')
 from RL_controller.controllers import RL_withoutController, RL_withController
+from RL_controller.controller_worker import ControllerPool
+
+def run_eval_episodes(trained_model, env_lst, ctrl_pool):
+    """
+    Run one episode of each env with trained_model (a model or a policy, by its predict()). With controller workers, at every step the actions of all unfinished
+    envs are submitted to the controller before the first one is awaited, so that the workers solve them together. With the inline controller, the episodes
+    run one after another as before. Each env draws its slippage from its own RNG, so the results do not depend on the order.
+    """
+    if not ctrl_pool.is_async:
+        for env in env_lst:
+            run_eval_episodes_lockstep(trained_model=trained_model, env_lst=[env], ctrl_pool=ctrl_pool)
+        return
+    run_eval_episodes_lockstep(trained_model=trained_model, env_lst=env_lst, ctrl_pool=ctrl_pool)
+
+def run_eval_episodes_lockstep(trained_model, env_lst, ctrl_pool):
+    obs_lst = [env.reset() for env in env_lst]
+    active_lst = list(range(len(env_lst)))
+    while len(active_lst) > 0:
+        future_lst = []
+        for idx in active_lst:
+            a_rlonly, _ = trained_model.predict(obs_lst[idx])
+            a_rlonly = np.reshape(a_rlonly, (-1))
+            a_rl = a_rlonly
+            if np.sum(np.abs(a_rl)) == 0:
+                a_rl = np.array([1/len(a_rl)]*len(a_rl))
+            else:
+                a_rl = a_rl / np.sum(np.abs(a_rl))
+            future_lst.append(ctrl_pool.submit(a_rl=a_rl, env=env_lst[idx]))
+        finished_lst = []
+        for idx, future in zip(active_lst, future_lst):
+            a_final = future.result()
+            a_final = a_final / np.sum(np.abs(a_final))
+            a_final = np.array([a_final])
+            obs_lst[idx], rewards, terminal_flag, _ = env_lst[idx].step(a_final)
+            if terminal_flag:
+                finished_lst.append(idx)
+        active_lst = [idx for idx in active_lst if idx not in finished_lst]
+
+def save_valid_bestmodel(config, valid_env, trained_model):
+    """
+    Save trained_model as the best model if the episode just evaluated by valid_env is the best one in valid_bestmodel.csv.
+    """
+    cur_ep = valid_env.epoch # valid_env.epoch is the epoch number before reset().
+    env_type = 'valid'
+    fpath = os.path.join(config.res_dir, '{}_bestmodel.csv'.format(env_type))
+    model_records = pd.DataFrame(pd.read_csv(fpath, header=0))
+    if cur_ep == int(model_records['{}_ep'.format(config.trained_best_model_type)][0]):
+        mpath = os.path.join(config.res_model_dir, '{}_{}'.format(env_type, config.trained_best_model_type))
+        trained_model.save(mpath)
+
+def eval_worker(config, model_path, valid_env, test_env, request_queue):
+    """
+    Background evaluation process of PoCallback, it owns the valid and test envs. model_path is a saved model of the training, loaded once as
+    the template of the evaluated models. Each request of request_queue is (parameters of the model saved by th.save, weights of the market
+    observer), the frozen model is evaluated on both envs and saved as the best model by save_valid_bestmodel. None stops the process.
+    """
+    # Seeded before anything is evaluated, so that the run does not depend on the RNG state of the spawn.
+    np.random.seed(config.seed_num)
+    th.manual_seed(config.seed_num)
+    eval_env_lst = [env for env in [valid_env, test_env] if env is not None]
+    for env in eval_env_lst:
+        env.seed(seed=env.seed_num) # The slippage of each env is drawn from its own generator.
+    ModelCls = model_select(model_name=config.rl_model_name, mode=config.mode)
+    trained_model = ModelCls.load(model_path)
+    os.remove(model_path)
+    risk_controller = RL_withController if config.mode == 'RLcontroller' else RL_withoutController
+    ctrl_pool = ControllerPool(num_workers=config.ctrl_workers if config.mode == 'RLcontroller' else 0, backend=config.ctrl_worker_backend, controller=risk_controller)
+    try:
+        while True:
+            request = request_queue.get()
+            if request is None:
+                break
+            model_params, mkt_obs_state = request
+            trained_model.set_parameters(th.load(io.BytesIO(model_params), map_location=trained_model.device), exact_match=True)
+            if mkt_obs_state is not None:
+                # The valid and test envs share the observer.
+                eval_env_lst[0].mkt_observer.load_state_dict(mkt_obs_state)
+            run_eval_episodes(trained_model=trained_model, env_lst=eval_env_lst, ctrl_pool=ctrl_pool)
+            if valid_env is not None:
+                save_valid_bestmodel(config=config, valid_env=valid_env, trained_model=trained_model)
+    finally:
+        ctrl_pool.shutdown()
 
 class PoCallback(BaseCallback):
 
@@ -33,11 +120,20 @@ class PoCallback(BaseCallback):
             self.risk_controller = RL_withController
         else:
             raise ValueError("Unexpected mode [{}]..".format(self.config.mode))
+        # The valid and test episodes are run in lockstep, their controller solves are in flight together.
+        self.ctrl_pool = ControllerPool(num_workers=self.config.ctrl_workers if self.config.mode == 'RLcontroller' else 0, backend=self.config.ctrl_worker_backend, controller=self.risk_controller)
+        # config.eval_async: the valid and test envs are moved to the background process eval_worker at the first evaluation.
+        self.eval_process = None
+        self.eval_queue = None
+        self.eval_policy = None # Preallocated copy of the policy, the synchronous evaluation loads the weights of the current policy into it.
+
     def _on_training_start(self) -> None:
         """
         This method is called before the first rollout starts.
         """
-        pass
+        if not self.config.eval_async:
+            self.eval_policy = copy.deepcopy(self.model.policy)
+            self.eval_policy.set_training_mode(False)
 
     def _on_rollout_start(self) -> None:
         """
@@ -60,56 +156,16 @@ class PoCallback(BaseCallback):
         if self.train_env.model_save_flag:
             exclusive_start_cputime = time.process_time()
             exclusive_start_systime = time.perf_counter()
-            curmpath = os.path.join(self.config.res_model_dir, 'current_model')
-            self.model.save(curmpath)
-            # Evaluate model in validation set and test set
-            ModelCls = model_select(model_name=self.config.rl_model_name,  mode=self.config.mode)
-            trained_model = ModelCls.load(curmpath)
-            if self.valid_env is not None:
-                obs_valid = self.valid_env.reset()
-                while True:
-                    a_rlonly, _ = trained_model.predict(obs_valid)
-                    a_rlonly = np.reshape(a_rlonly, (-1))
-                    a_rl = a_rlonly
-                    if np.sum(np.abs(a_rl)) == 0:
-                        a_rl = np.array([1/len(a_rl)]*len(a_rl))
-                    else:
-                        a_rl = a_rl / np.sum(np.abs(a_rl))
-                    a_final = self.risk_controller(a_rl=a_rl, env=self.valid_env)
-                    a_final = a_final / np.sum(np.abs(a_final))
-                    a_final = np.array([a_final])
-                    obs_valid, rewards, terminal_flag, _ = self.valid_env.step(a_final) 
-                    if terminal_flag:
-                        break    
-            
-                cur_ep = self.valid_env.epoch # self.valid_env.epoch is the epoch number before reset().
-                env_type = 'valid'
-                fpath = os.path.join(self.config.res_dir, '{}_bestmodel.csv'.format(env_type))
-                model_records = pd.DataFrame(pd.read_csv(fpath, header=0))
-                if cur_ep == int(model_records['{}_ep'.format(self.config.trained_best_model_type)][0]):
-                    mpath = os.path.join(self.config.res_model_dir, '{}_{}'.format(env_type, self.config.trained_best_model_type))
-                    trained_model.save(mpath)
-                
-            if self.test_env is not None:
-                obs_test = self.test_env.reset()
-                while True:
-                    a_rlonly, _ = trained_model.predict(obs_test)
-                    a_rlonly = np.reshape(a_rlonly, (-1))
-                    a_rl = a_rlonly
-                    if np.sum(np.abs(a_rl)) == 0:
-                        a_rl = np.array([1/len(a_rl)]*len(a_rl))
-                    else:
-                        a_rl = a_rl / np.sum(np.abs(a_rl))
-                    a_final  = self.risk_controller(a_rl=a_rl, env=self.test_env)
-                    a_final = a_final / np.sum(np.abs(a_final))
-                    a_final = np.array([a_final])
-                    obs_test, rewards, terminal_flag, _ = self.test_env.step(a_final) 
-                    if terminal_flag:
-                        break
-
-            del trained_model
-            # delete the current model file
-            os.remove(os.path.join(self.config.res_model_dir, 'current_model.zip'))
+            if self.config.eval_async:
+                self.submit_eval()
+            else:
+                # Evaluate model in validation set and test set
+                eval_policy = self.snapshot_policy()
+                eval_env_lst = [env for env in [self.valid_env, self.test_env] if env is not None]
+                self.run_eval_episodes(trained_model=eval_policy, env_lst=eval_env_lst)
+                if self.valid_env is not None:
+                    # The training is paused during the evaluation, the model is saved to disk only if it is the new best one.
+                    save_valid_bestmodel(config=self.config, valid_env=self.valid_env, trained_model=self.model)
             exclusive_end_cputime = time.process_time()
             exclusive_end_systime = time.perf_counter()
             self.train_env.exclusive_cputime = exclusive_end_cputime - exclusive_start_cputime
@@ -117,6 +173,55 @@ class PoCallback(BaseCallback):
         self.train_env.model_save_flag = False
         return True
 
+    def run_eval_episodes(self, trained_model, env_lst):
+        run_eval_episodes(trained_model=trained_model, env_lst=env_lst, ctrl_pool=self.ctrl_pool)
+
+    def snapshot_policy(self):
+        """
+        In-memory snapshot of the current policy: its weights are copied into the preallocated evaluation policy, no model is saved or loaded.
+        """
+        if self.eval_policy is None:
+            self.eval_policy = copy.deepcopy(self.model.policy)
+        self.eval_policy.load_state_dict(self.model.policy.state_dict())
+        self.eval_policy.set_training_mode(False)
+        return self.eval_policy
+
+    def submit_eval(self):
+        """
+        Hand a frozen copy of the current model (the parameters of the policy and its optimizers, and the weights of the market observer) to the
+        background evaluation process, started with the valid and test envs at the first call. Training goes on while it is evaluated.
+        """
+        if self.eval_process is None:
+            model_path = os.path.join(self.config.res_model_dir, 'eval_template')
+            self.model.save(model_path)
+            ctx = multiprocessing.get_context('spawn')
+            self.eval_queue = ctx.Queue()
+            self.eval_process = ctx.Process(target=eval_worker, args=(self.config, '{}.zip'.format(model_path), self.valid_env, self.test_env, self.eval_queue))
+            self.eval_process.start()
+            # If learn() stops early, the queued models are still evaluated before the exit.
+            atexit.register(self.join_eval)
+        buf = io.BytesIO()
+        th.save(self.model.get_parameters(), buf) # Frozen at submission, the training updates the parameters in place.
+        model_params = buf.getvalue()
+        eval_env = self.valid_env if self.valid_env is not None else self.test_env
+        mkt_obs_state = eval_env.mkt_observer.state_dict() if (eval_env is not None) and (eval_env.mkt_observer is not None) else None
+        self.eval_queue.put((model_params, mkt_obs_state))
+
+    def join_eval(self):
+        """
+        Wait for the background evaluation of all submitted models.
+        """
+        if self.eval_process is None:
+            return
+        atexit.unregister(self.join_eval)
+        self.eval_queue.put(None)
+        self.eval_process.join()
+        exitcode = self.eval_process.exitcode
+        self.eval_process = None
+        self.eval_queue = None
+        if exitcode != 0:
+            raise RuntimeError("The background evaluation process exited with code [{}].".format(exitcode))
+
     def _on_rollout_end(self) -> None:
         """
         This event is triggered before updating the policy.
@@ -127,4 +232,5 @@ class PoCallback(BaseCallback):
         """
         This event is triggered before exiting the `learn()` method.
         """
-        pass
+        self.ctrl_pool.shutdown()
+        self.join_eval()
@@ -12,22 +12,64 @@ import os
 import pandas as pd
 import time
 import copy
+import uuid
 from gym.utils import seeding
 import gym
 from gym import spaces
 from stable_baselines3.common.vec_env import DummyVecEnv
 from scipy.stats import entropy
 import scipy.stats as spstats
+from RL_controller.cov_estimator import gen_cov_table
+
+class SolverTelemetry:
+    """
+    Per-day records of the controller solves of an env, kept in a preallocated array and reset every episode.
+    status: 0 (solvable), 1 (insolvable), 2 (fallback of the time budget), the same codes as solvable_flag.
+    fidelity: 0 (exact), 1 (approximate projection), 2 (cluster decomposition). risk_model: 0 (dense covariance), 1 (factor risk model).
+    audit_deviation, audit_gap: max |a_cbf - exact a_cbf| and the relative excess of ||a_cbf||^2 over the dense projection on the audited days
+    of the approximate, factor-model or cluster controller, NaN on the other days.
+    """
+    field_lst = ['trade_day', 'solve_time', 'ars_retries', 'status', 'solve_cnt', 'solve_iters', 'risk_safe', 'risk_bound',
+                 'risk_final', 'risk_residual', 'sum_residual', 'bound_residual', 'fidelity', 'risk_model', 'audit_deviation', 'audit_gap']
+    def __init__(self, capacity):
+        self.data = np.zeros((max(capacity, 1), len(self.field_lst)))
+        self.size = 0
+
+    def reset(self):
+        self.size = 0
+
+    def record(self, **kwargs):
+        if self.size == len(self.data):
+            self.data = np.append(self.data, np.zeros(self.data.shape), axis=0)
+        self.data[self.size] = [kwargs[k] for k in self.field_lst]
+        self.size = self.size + 1
+
+    def column(self, fname):
+        return self.data[:self.size, self.field_lst.index(fname)]
+
+    def latency_percentiles(self, q_lst=(50, 95, 99)):
+        # Percentiles of the daily solve time in milliseconds.
+        if self.size == 0:
+            return [0.0] * len(q_lst)
+        return list(np.percentile(self.column('solve_time') * 1000, q_lst))
+
+    def to_df(self):
+        df = pd.DataFrame(self.data[:self.size], columns=self.field_lst)
+        for fname in ['trade_day', 'ars_retries', 'status', 'solve_cnt', 'solve_iters', 'fidelity', 'risk_model']:
+            df[fname] = df[fname].astype(int)
+        return df
 
 class StockPortfolioEnv(gym.Env):
 
     def __init__(self, config, rawdata, mode, stock_num, action_dim, tech_indicator_lst, max_shares,
                  initial_asset=1000000, reward_scaling=1, norm_method='sum', transaction_cost=0.001, slippage=0.001, 
-                 seed_num=2022, extra_data=None, mkt_observer=None):
+                 seed_num=2022, extra_data=None, mkt_observer=None, env_tag=None):
         
         self.config = config
         self.rawdata = rawdata
         self.mode = mode # train, valid, test
+        self.env_tag = env_tag # Tag of one of several envs of the same mode, e.g. 'env1', None for the main env.
+        self.res_name = self.mode if self.env_tag is None else '{}_{}'.format(self.mode, self.env_tag) # Prefix of the result files of the env.
         self.stock_num = stock_num # Number of stocks
         self.action_dim = action_dim # Number of assets
         self.tech_indicator_lst = tech_indicator_lst
@@ -46,7 +88,7 @@ class StockPortfolioEnv(gym.Env):
         self.norm_method = norm_method
         self.transaction_cost = transaction_cost # 0.001
         self.slippage = slippage # 0.001 for one-side, 0.002 for two-side
-        self.cur_slippage_drift = np.random.random(self.stock_num) * (self.slippage * 2) - self.slippage
+        self.cur_slippage_drift = self.np_random.random(self.stock_num) * (self.slippage * 2) - self.slippage
         if extra_data is not None:
             self.extra_data = extra_data
         else:
@@ -122,7 +164,7 @@ class StockPortfolioEnv(gym.Env):
         self.risk_raw_lst = [0] # For performance analysis. Record the risk without using risk controllrt during the validation/test period.
         self.risk_cbf_lst = [0]
         self.return_raw_lst = [self.initial_asset] 
-        self.solver_stat = {'solvable': 0, 'insolvable': 0, 'stochastic_solvable': 0, 'stochastic_time': [], 'socp_solvable': 0, 'socp_time': []} 
+        self.solver_stat = {'solvable': 0, 'insolvable': 0, 'stochastic_solvable': 0, 'stochastic_time': [], 'socp_solvable': 0, 'socp_time': [], 'solve_cnt': 0, 'solve_iters': 0, 'fallback': 0} 
 
         self.ctrl_weight_lst = [1.0]
         self.solvable_flag = []
@@ -133,6 +175,23 @@ class StockPortfolioEnv(gym.Env):
         self.cnt1 = 0
         self.cnt2 = 0
         self.stepcount = 0
+        self.cbf_problem = None # Compiled CBF-SOCP of the controller, built on the first call and reused across days and epochs.
+        self.cbf_proj_solver = None # Projection solver of the controller, used when config.cbf_solver == 'projection'.
+        self.cbf_factor_problem = None # Compiled CBF-SOCP over the factor risk model (CbfFactorSocpProblem), built on the first call.
+        self.cov_factor = None # Rolling covariance factor of the controller, the cone matrix of the SOCP solvers.
+        self.solver_telemetry = SolverTelemetry(capacity=self.totalTradeDay) # Per-day controller solves of the current episode
+        self.factor_risk_model = None # Per-day low-rank-plus-diagonal covariance of the split, built on the first controller call if the factor risk model is used.
+        self.asset_clusters = None # Index arrays of the asset clusters of the split, built on the first controller call if config.ctrl_mode == 'cluster'.
+        self.ctrl_cluster_key = uuid.uuid4().hex # Key of the warm starts of the clusters of this env on the cluster workers, unique unlike id(env).
+        self.cov_table = None # (days, num_of_stocks, num_of_stocks) covariances of the DAILYRETURNS windows of the split by config.cov_estimator, built on the first call of get_cur_cov.
+        self.cov_t1_table = None # (days, num_of_stocks, num_of_stocks) cov_r_t1 of the controller (window shifted by the price prediction) by config.cov_estimator, built on the first controller call.
+        self.min_risk_frontier = None # Per-day bounds of the minimum achievable risk of the split, built on the first controller call if config.cbf_precheck.
+        self.cbf_solver_tuned = None # Backend of the controller selected by the solver tuner, if config.cbf_solver == 'auto'.
+        self.cbf_cvxpy_solver = None # cvxpy solver selected by the solver tuner, config.cbf_cvxpy_solver if None.
+        self.cbf_approx_solver = None # Approximate projection solver of the controller, used in training if config.ctrl_fidelity == 'train_approx'.
+        self.cbf_audit_solver = None # Exact projection solver auditing the approximate controller on sampled days.
+        self.ctrl_audit_rng = np.random.default_rng(self.seed_num) # Sampling of the audited days, independent of the market simulation.
+        self.price_pred_table = None # (days, num_of_stocks) predicted price changes of the split by config.pricePredModel, built on the first controller call.
 
         risk_free = self.config.mkt_rf[self.config.market_name] / 100
         self.start_cputime = time.process_time()
@@ -154,7 +213,7 @@ class StockPortfolioEnv(gym.Env):
             'risk_downsideAtVol', 'risk_downsideAtVol_daily_max', 'risk_downsideAtVol_daily_min', 'risk_downsideAtVol_daily_avg',
             'risk_downsideAtValue_daily_max', 'risk_downsideAtValue_daily_min', 'risk_downsideAtValue_daily_avg',
             'cvar_max', 'cvar_min', 'cvar_avg', 'cvar_raw_max', 'cvar_raw_min', 'cvar_raw_avg',
-            'solver_solvable', 'solver_insolvable', 'cputime', 'systime', 
+            'solver_solvable', 'solver_insolvable', 'solver_fallback', 'solver_solve_cnt', 'solver_iters', 'solve_time_p50', 'solve_time_p95', 'solve_time_p99', 'cputime', 'systime', 
         ]
         self.profile_hist_ep = {k: [] for k in self.profile_hist_field_lst}
 
@@ -180,7 +239,7 @@ class StockPortfolioEnv(gym.Env):
             invest_profile = self.get_results()
             self.save_profile(invest_profile=invest_profile)
 
-            return self.state, self.reward, self.terminal, {}
+            return self.state, self.reward, self.terminal, {'obs_trade_day': self.curTradeDay, 'trade_day': self.curTradeDay}
         else:
             actions = np.reshape(actions, (-1)) # [1, num_of_stocks] or [num_of_stocks, ]
             weights = self.weights_normalization(actions=actions) # Unnormalized weights -> normalized weights 
@@ -235,7 +294,7 @@ class StockPortfolioEnv(gym.Env):
             cur_date = self.curData['date'].unique()[0]
             self.date_memory.append(cur_date)
 
-            self.cur_slippage_drift = np.random.random(self.stock_num) * (self.slippage * 2) - self.slippage
+            self.cur_slippage_drift = self.np_random.random(self.stock_num) * (self.slippage * 2) - self.slippage
             curDay_ClosePrice_withSlippage = np.array(self.curData['close'].values) * (1 + self.cur_slippage_drift)
             lastDay_ClosePrice_withSlippage = np.array(self.lastDayData['close'].values) * (1 + self.last_slippage_drift)
             rate_of_price_change = curDay_ClosePrice_withSlippage / lastDay_ClosePrice_withSlippage
@@ -262,9 +321,7 @@ class StockPortfolioEnv(gym.Env):
             self.ctrl_weight_lst.append(1.0)       
 
             daily_return_ay = np.array(list(self.curData['DAILYRETURNS-{}'.format(self.config.dailyRetun_lookback)].values))
-            cur_cov = np.cov(daily_return_ay) 
-            if np.isscalar(cur_cov):
-                cur_cov = np.array([[cur_cov]], dtype=float)
+            cur_cov = self.get_cur_cov() # Covariance of the DAILYRETURNS window of the day, by config.cov_estimator
             self.risk_cbf_lst.append(np.sqrt(np.matmul(np.matmul(weights, cur_cov), weights.T))) # Daily risk
             w_rl = self.action_rl_memory[-1] # weights - self.action_cbf_memeory[-1]
             w_rl = w_rl / np.sum(np.abs(w_rl))
@@ -287,9 +344,12 @@ class StockPortfolioEnv(gym.Env):
             expected_r_prev = np.mean(expected_r_series[:, -1:], axis=1)
             expected_r_prev = np.where((expected_r_prev>=1)&(weights<0), 1, expected_r_prev)
             expected_r = np.sum(np.reshape(expected_r_prev, (1, -1)) @ np.reshape(weights, (-1, 1)))
-            expected_cov = np.cov(expected_r_series)
-            if np.isscalar(expected_cov):
-                expected_cov = np.array([[expected_cov]], dtype=float)
+            if np.shape(expected_r_series)[1] == np.shape(daily_return_ay)[1]:
+                expected_cov = cur_cov # The same window
+            else:
+                expected_cov = np.cov(expected_r_series)
+                if np.isscalar(expected_cov):
+                    expected_cov = np.array([[expected_cov]], dtype=float)
             expected_std = np.sum(np.sqrt(np.reshape(weights, (1, -1)) @ expected_cov @ np.reshape(weights, (-1, 1))))
             cvar_lz = spstats.norm.ppf(1-0.05) # positive 1.65 for 95%(=1-alpha) confidence level.
             cvar_Z = np.exp(-0.5*np.power(cvar_lz, 2)) / 0.05 / np.sqrt(2*np.pi)
@@ -332,9 +392,7 @@ class StockPortfolioEnv(gym.Env):
 
             elif (self.config.mode == 'RLonly') and (self.config.trained_best_model_type == 'pr_loss'):
                 # overall return maximisation + risk minimisation
-                cov_r_t0 = np.cov(self.ctl_state['DAILYRETURNS-{}'.format(self.config.dailyRetun_lookback)])
-                if np.isscalar(cov_r_t0):
-                    cov_r_t0 = np.array([[cov_r_t0]], dtype=float)
+                cov_r_t0 = self.get_cur_cov()
                 risk_part = np.sqrt(np.matmul(np.matmul(np.array([weights]), cov_r_t0), np.array([weights]).T)[0][0])
                 scaled_risk_part = (-1) * risk_part * 50
                 scaled_profit_part = profit_part * self.config.lambda_1
@@ -342,9 +400,7 @@ class StockPortfolioEnv(gym.Env):
 
             elif (self.config.mode == 'RLonly') and (self.config.trained_best_model_type == 'sr_loss'):
                 # Sharpe ratio maximisation
-                cov_r_t0 = np.cov(self.ctl_state['DAILYRETURNS-{}'.format(self.config.dailyRetun_lookback)])
-                if np.isscalar(cov_r_t0):
-                    cov_r_t0 = np.array([[cov_r_t0]], dtype=float)
+                cov_r_t0 = self.get_cur_cov()
                 risk_part = np.sqrt(np.matmul(np.matmul(np.array([weights]), cov_r_t0), np.array([weights]).T)[0][0])
                 profit_part = poDayReturn_withcost
                 scaled_profit_part = profit_part
@@ -362,7 +418,39 @@ class StockPortfolioEnv(gym.Env):
             self.reward = cur_reward
             self.reward_lst.append(self.reward)
             self.model_save_flag = False
-            return self.state, self.reward, self.terminal, {}
+            return self.state, self.reward, self.terminal, {'obs_trade_day': self.curTradeDay - 1, 'trade_day': self.curTradeDay}
+
+    def get_daily_return_windows(self):
+        """
+        (days, num_of_stocks, lookback) DAILYRETURNS windows of all trading days of the split.
+        """
+        col = 'DAILYRETURNS-{}'.format(self.config.dailyRetun_lookback)
+        # rawdata is sorted by date and stock, every trading day has stock_num rows.
+        daily_return_lst = np.array(list(self.rawdata[col].values), dtype=float)
+        return np.reshape(daily_return_lst, (self.totalTradeDay, self.stock_num, -1))
+
+    def get_day_feat_table(self):
+        """
+        (days, num_of_features) market features of the state on each trading day of the split, i.e. the state of the day without the
+        portfolio value and the hidden vector of the market observer. The step info gives the days of the observations.
+        """
+        # rawdata is sorted by date and stock, every trading day has stock_num rows.
+        feat = np.array(self.rawdata[self.tech_indicator_lst_wocov].values, dtype=float)
+        feat = np.transpose(np.reshape(feat, (self.totalTradeDay, self.stock_num, -1)), (0, 2, 1)) # (days, features, num_of_stocks)
+        if self.config.enable_cov_features:
+            cov_lst = self.rawdata['cov'].values
+            covs = np.array([np.array(cov_lst[day * self.stock_num]) for day in range(self.totalTradeDay)], dtype=float) # (days, num_of_stocks, num_of_stocks)
+            feat = np.append(covs, feat, axis=1)
+        return np.reshape(feat, (self.totalTradeDay, -1))
+
+    def get_cur_cov(self):
+        """
+        (num_of_stocks, num_of_stocks) covariance of the DAILYRETURNS window of the current day by config.cov_estimator, shared with the controller.
+        The covariances of all days of the split are estimated at once on the first call.
+        """
+        if self.cov_table is None:
+            self.cov_table = gen_cov_table(estimator_name=self.config.cov_estimator, windows=self.get_daily_return_windows())
+        return self.cov_table[self.curTradeDay]
 
     def reset(self):
         self.epoch = self.epoch + 1
@@ -405,7 +493,7 @@ class StockPortfolioEnv(gym.Env):
         self.risk_raw_lst = [0]
         self.risk_cbf_lst = [0]
         self.return_raw_lst = [self.initial_asset]
-        self.solver_stat = {'solvable': 0, 'insolvable': 0, 'stochastic_solvable': 0, 'stochastic_time': [], 'socp_solvable': 0, 'socp_time': []} 
+        self.solver_stat = {'solvable': 0, 'insolvable': 0, 'stochastic_solvable': 0, 'stochastic_time': [], 'socp_solvable': 0, 'socp_time': [], 'solve_cnt': 0, 'solve_iters': 0, 'fallback': 0} 
 
         self.ctrl_weight_lst = [1.0]
         self.solvable_flag = []
@@ -416,6 +504,7 @@ class StockPortfolioEnv(gym.Env):
         self.cnt1 = 0
         self.cnt2 = 0
         self.stepcount = 0
+        self.solver_telemetry.reset()
 
         self.start_cputime = time.process_time()
         self.start_systime = time.perf_counter()
@@ -610,6 +699,7 @@ class StockPortfolioEnv(gym.Env):
             self.risk_pred_lst = np.zeros(len(self.asset_lst))
   
         cbf_abssum_contribution = np.sum(np.abs(self.action_cbf_memeory[:-1]))
+        solve_time_p50, solve_time_p95, solve_time_p99 = self.solver_telemetry.latency_percentiles() # ms
 
         info_dict = {
             'ep': self.epoch, 'trading_days': self.totalTradeDay, 'annualReturn_pct': annualReturn_pct, 'volatility': volatility, 'sharpeRatio': sharpeRatio, 'sharpeRatio_wocbf': sharpeRatio_woCBF,
@@ -627,7 +717,9 @@ class StockPortfolioEnv(gym.Env):
             'risk_downsideAtVol': risk_downsideAtVol, 'risk_downsideAtVol_daily_max': risk_downsideAtVol_daily_max, 'risk_downsideAtVol_daily_min': risk_downsideAtVol_daily_min, 'risk_downsideAtVol_daily_avg': risk_downsideAtVol_daily_avg,
             'risk_downsideAtValue_daily_max': risk_downsideAtValue_daily_max, 'risk_downsideAtValue_daily_min': risk_downsideAtValue_daily_min, 'risk_downsideAtValue_daily_avg': risk_downsideAtValue_daily_avg,
             'cvar_max': cvar_max, 'cvar_min': cvar_min, 'cvar_avg': cvar_avg, 'cvar_raw_max': cvar_raw_max, 'cvar_raw_min': cvar_raw_min, 'cvar_raw_avg': cvar_raw_avg,
-            'solver_solvable': self.solver_stat['solvable'], 'solver_insolvable': self.solver_stat['insolvable'], 'cputime': cputime_use, 'systime': systime_use,
+            'solver_solvable': self.solver_stat['solvable'], 'solver_insolvable': self.solver_stat['insolvable'], 'solver_fallback': self.solver_stat['fallback'], 
+            'solver_solve_cnt': self.solver_stat['solve_cnt'], 'solver_iters': self.solver_stat['solve_iters'], 
+            'solve_time_p50': solve_time_p50, 'solve_time_p95': solve_time_p95, 'solve_time_p99': solve_time_p99, 'cputime': cputime_use, 'systime': systime_use,
             'asset_lst': copy.deepcopy(self.asset_lst), 'daily_return_lst': copy.deepcopy(self.profit_lst), 'reward_lst': copy.deepcopy(self.reward_lst), 
             'stg_vol_lst': copy.deepcopy(stg_vol_lst), 'risk_lst': copy.deepcopy(self.risk_cbf_lst), 'risk_wocbf_lst': copy.deepcopy(self.risk_raw_lst),
             'capital_wocbf_lst': copy.deepcopy(self.return_raw_lst), 'daily_sr_lst': copy.deepcopy(dailySR), 'daily_sr_wocbf_lst': copy.deepcopy(dailySR_wocbf),
@@ -650,7 +742,7 @@ class StockPortfolioEnv(gym.Env):
             else:
                 raise ValueError('Cannot find the field [{}] in invest profile..'.format(fname))
         phist_df = pd.DataFrame(self.profile_hist_ep, columns=self.profile_hist_field_lst)
-        phist_df.to_csv(os.path.join(self.config.res_dir, '{}_profile.csv'.format(self.mode)), index=False)
+        phist_df.to_csv(os.path.join(self.config.res_dir, '{}_profile.csv'.format(self.res_name)), index=False)
 
         cputime_avg = np.mean(phist_df['cputime'])
         systime_avg = np.mean(phist_df['systime'])
@@ -680,13 +772,20 @@ class StockPortfolioEnv(gym.Env):
         if True:
             print("-"*30)
             # log_str = "Mode: {}, Ep: {}, Current epoch capital: {}, historical best captial ({} ep): {}, cputime cur: {} s, avg: {} s, system time cur: {} s/ep, avg: {} s/ep..".format(self.mode, self.epoch, self.cur_capital, v_ep, v, np.round(np.array(phist_df['cputime'])[-1], 2), np.round(cputime_avg, 2), np.round(np.array(phist_df['systime'])[-1], 2), np.round(systime_avg, 2))
-            log_str = "Mode: {}, Ep: {}, Current epoch capital: {}, historical best captial ({} ep): {} | solvable: {}, insolvable: {} | step count: {} | cputime cur: {} s, avg: {} s, system time cur: {} s/ep, avg: {} s/ep..".format(self.mode, self.epoch, self.cur_capital, v_ep, v, np.array(phist_df['solver_solvable'])[-1], np.array(phist_df['solver_insolvable'])[-1], self.stepcount, np.round(np.array(phist_df['cputime'])[-1], 2), np.round(cputime_avg, 2), np.round(np.array(phist_df['systime'])[-1], 2), np.round(systime_avg, 2))
+            log_str = "Mode: {}, Ep: {}, Current epoch capital: {}, historical best captial ({} ep): {} | solvable: {}, insolvable: {}, fallback: {} | step count: {} | solves: {}, solver iterations: {}, solve time p50/p95/p99: {}/{}/{} ms | cputime cur: {} s, avg: {} s, system time cur: {} s/ep, avg: {} s/ep..".format(self.res_name, self.epoch, self.cur_capital, v_ep, v, np.array(phist_df['solver_solvable'])[-1], np.array(phist_df['solver_insolvable'])[-1], np.array(phist_df['solver_fallback'])[-1], self.stepcount, np.array(phist_df['solver_solve_cnt'])[-1], np.array(phist_df['solver_iters'])[-1], np.round(np.array(phist_df['solve_time_p50'])[-1], 3), np.round(np.array(phist_df['solve_time_p95'])[-1], 3), np.round(np.array(phist_df['solve_time_p99'])[-1], 3), np.round(np.array(phist_df['cputime'])[-1], 2), np.round(cputime_avg, 2), np.round(np.array(phist_df['systime'])[-1], 2), np.round(systime_avg, 2))
             print(log_str)
+        # Per-day controller telemetry of this epoch, appended to the table of all epochs.
+        if self.solver_telemetry.size > 0:
+            telemetry_df = self.solver_telemetry.to_df()
+            telemetry_df.insert(0, 'ep', self.epoch)
+            telemetry_df.insert(2, 'date', [self.date_memory[i] if i < len(self.date_memory) else None for i in telemetry_df['trade_day']])
+            fpath = os.path.join(self.config.res_dir, '{}_solver_telemetry.csv'.format(self.res_name))
+            telemetry_df.to_csv(fpath, mode='a', header=(not os.path.exists(fpath)), index=False)
         bestmodel_df = pd.DataFrame([bestmodel_dict])
-        bestmodel_df.to_csv(os.path.join(self.config.res_dir, '{}_bestmodel.csv'.format(self.mode)), index=False)
+        bestmodel_df.to_csv(os.path.join(self.config.res_dir, '{}_bestmodel.csv'.format(self.res_name)), index=False)
 
         # save data of each step in 1st/best/last model
-        fpath = os.path.join(self.config.res_dir, '{}_stepdata.csv'.format(self.mode))
+        fpath = os.path.join(self.config.res_dir, '{}_stepdata.csv'.format(self.res_name))
         if not os.path.exists(fpath):
             step_data = {'capital_policy_1': invest_profile['asset_lst'], 'dailyReturn_policy_1': invest_profile['daily_return_lst'],
                         'reward_policy_1': invest_profile['reward_lst'], 'strategyVolatility_policy_1': invest_profile['stg_vol_lst'],
@@ -873,7 +972,7 @@ class StockPortfolioEnv_cash(StockPortfolioEnv):
             invest_profile = self.get_results()
             self.save_profile(invest_profile=invest_profile)
 
-            return self.state, self.reward, self.terminal, {}
+            return self.state, self.reward, self.terminal, {'obs_trade_day': self.curTradeDay, 'trade_day': self.curTradeDay}
         else:
             actions = np.reshape(actions, (-1)) # [1, num_of_stocks] or [num_of_stocks, ]
             weights = self.weights_normalization(actions=actions) # Unnormalized weights -> normalized weights 
@@ -932,7 +1031,7 @@ class StockPortfolioEnv_cash(StockPortfolioEnv):
             cur_date = self.curData['date'].unique()[0]
             self.date_memory.append(cur_date)
 
-            self.cur_slippage_drift = np.random.random(self.stock_num) * (self.slippage * 2) - self.slippage
+            self.cur_slippage_drift = self.np_random.random(self.stock_num) * (self.slippage * 2) - self.slippage
             curDay_ClosePrice_withSlippage = np.array(self.curData['close'].values) * (1 + self.cur_slippage_drift)
             lastDay_ClosePrice_withSlippage = np.array(self.lastDayData['close'].values) * (1 + self.last_slippage_drift)
             rate_of_price_change = curDay_ClosePrice_withSlippage / lastDay_ClosePrice_withSlippage
@@ -961,9 +1060,7 @@ class StockPortfolioEnv_cash(StockPortfolioEnv):
 
             # For debugging
             daily_return_ay = np.array(list(self.curData['DAILYRETURNS-{}'.format(self.config.dailyRetun_lookback)].values))
-            cur_cov = np.cov(daily_return_ay) 
-            if np.isscalar(cur_cov):
-                cur_cov = np.array([[cur_cov]], dtype=float)
+            cur_cov = self.get_cur_cov() # Covariance of the DAILYRETURNS window of the day, by config.cov_estimator
             self.risk_cbf_lst.append(np.sqrt(np.matmul(np.matmul(weights[1:], cur_cov), weights[1:].T)))
             w_rl = self.action_rl_memory[-1] # Not applicable # weights[1:] - self.action_cbf_memeory[-1]
             w_rl = w_rl / np.sum(np.abs(w_rl))
@@ -985,9 +1082,12 @@ class StockPortfolioEnv_cash(StockPortfolioEnv):
             expected_r_prev = np.mean(expected_r_series[:, -1:], axis=1)
             expected_r_prev = np.where((expected_r_prev>=1)&(weights[1:]<0), 1, expected_r_prev)
             expected_r = np.sum(np.reshape(expected_r_prev, (1, -1)) @ np.reshape(weights[1:], (-1, 1)))
-            expected_cov = np.cov(expected_r_series)
-            if np.isscalar(expected_cov):
-                expected_cov = np.array([[expected_cov]], dtype=float)
+            if np.shape(expected_r_series)[1] == np.shape(daily_return_ay)[1]:
+                expected_cov = cur_cov # The same window
+            else:
+                expected_cov = np.cov(expected_r_series)
+                if np.isscalar(expected_cov):
+                    expected_cov = np.array([[expected_cov]], dtype=float)
             expected_std = np.sum(np.sqrt(np.reshape(weights[1:], (1, -1)) @ expected_cov @ np.reshape(weights[1:], (-1, 1))))
             cvar_lz = spstats.norm.ppf(1-0.05) # positive 1.65 for 95%(=1-alpha) confidence level.
             cvar_Z = np.exp(-0.5*np.power(cvar_lz, 2)) / 0.05 / np.sqrt(2*np.pi)
@@ -1030,9 +1130,7 @@ class StockPortfolioEnv_cash(StockPortfolioEnv):
 
             elif (self.config.mode == 'RLonly') and (self.config.trained_best_model_type == 'pr_loss'):
                 # overall return maximisation + risk minimisation
-                cov_r_t0 = np.cov(self.ctl_state['DAILYRETURNS-{}'.format(self.config.dailyRetun_lookback)])
-                if np.isscalar(cov_r_t0):
-                    cov_r_t0 = np.array([[cov_r_t0]], dtype=float)
+                cov_r_t0 = self.get_cur_cov()
                 risk_part = np.sqrt(np.matmul(np.matmul(np.array([weights[1:]]), cov_r_t0), np.array([weights[1:]]).T)[0][0])
                 scaled_risk_part = (-1) * risk_part * 50
                 scaled_profit_part = profit_part * self.config.lambda_1
@@ -1040,9 +1138,7 @@ class StockPortfolioEnv_cash(StockPortfolioEnv):
 
             elif (self.config.mode == 'RLonly') and (self.config.trained_best_model_type == 'sr_loss'):
                 # Sharpe ratio maximisation                
-                cov_r_t0 = np.cov(self.ctl_state['DAILYRETURNS-{}'.format(self.config.dailyRetun_lookback)])
-                if np.isscalar(cov_r_t0):
-                    cov_r_t0 = np.array([[cov_r_t0]], dtype=float)
+                cov_r_t0 = self.get_cur_cov()
                 risk_part = np.sqrt(np.matmul(np.matmul(np.array([weights[1:]]), cov_r_t0), np.array([weights[1:]]).T)[0][0])
                 profit_part = poDayReturn_withcost
                 scaled_profit_part = profit_part
@@ -1061,4 +1157,4 @@ class StockPortfolioEnv_cash(StockPortfolioEnv):
             self.reward_lst.append(self.reward)
             self.model_save_flag = False
 
-            return self.state, self.reward, self.terminal, {}
+            return self.state, self.reward, self.terminal, {'obs_trade_day': self.curTradeDay - 1, 'trade_day': self.curTradeDay}